@@ -0,0 +1,71 @@
+import time
+from redis.exceptions import WatchError
+from core.redis import redis, messages_key, event_stream_key
+from core.database import db
+from core.settings import settings
+from helpers.utils.stored_message_codec import decode_stored_message
+from helpers.utils.message_archive import archive_messages, CONVERSATION_ACTIVITY_KEY
+from helpers.utils.job_lock import run_exclusively
+from helpers.utils.task_supervisor import task_supervisor
+from helpers.utils.graceful_shutdown import shutting_down, wait_for_shutdown
+
+# ZREM only while the member is still idle, a message that arrived meanwhile re-scored it
+remove_if_idle = redis.register_script("""
+local score = redis.call('ZSCORE', KEYS[1], ARGV[1])
+if score and tonumber(score) <= tonumber(ARGV[2]) then
+  return redis.call('ZREM', KEYS[1], ARGV[1])
+end
+return 0
+""")
+
+async def archive_conversation(member: str, idle_before: float):
+  """
+  Move the whole redis tail of an idle conversation into a mongo bucket and free its keys.
+  Runs under WATCH, if a message arrives meanwhile the bucket is dropped again and the
+  conversation stays in redis.
+  """
+  kind, chat_or_group_id = member.split(":")
+  key = messages_key(chat_or_group_id, kind == "group")
+
+  async with redis.pipeline(transaction=True) as pipe:
+    await pipe.watch(key)
+    messages = [decode_stored_message(message) for message in await pipe.lrange(key, 0, -1)]
+
+    inserted = None
+    if messages:
+      inserted = await archive_messages(chat_or_group_id, kind == "group", messages)
+
+    try:
+      pipe.multi()
+      pipe.delete(key, event_stream_key(chat_or_group_id, kind == "group"))
+      await pipe.execute()
+    except WatchError:
+      if inserted:
+        await db.messages.delete_one({"_id": inserted.inserted_id})
+      return
+
+  # The activity set lives on another cluster slot than the conversation, so it can't be
+  # part of the MULTI
+  await remove_if_idle(keys=[CONVERSATION_ACTIVITY_KEY], args=[member, idle_before])
+
+async def archive_idle_pass():
+  idle_before = time.time() - settings.IDLE_CONVERSATION_ARCHIVE_AGE * 24 * 60 * 60
+
+  # Oldest first, in pages so a large backlog doesn't pin one pass forever
+  while True:
+    members = await redis.zrangebyscore(CONVERSATION_ACTIVITY_KEY, "-inf", idle_before, start=0, num=500)
+    if not members:
+      break
+
+    for member in members:
+      # Stop between conversations on shutdown, the next pass picks up the rest
+      if shutting_down.is_set():
+        return
+      task_supervisor.beat("archive_idle_conversations")
+      await archive_conversation(member.decode('utf-8'), idle_before)
+
+async def archive_idle_conversations():
+  while not await wait_for_shutdown(settings.IDLE_CONVERSATION_ARCHIVE_INTERVAL):
+    # Every worker runs this loop, one of them does the pass
+    await run_exclusively("archive_idle_conversations", archive_idle_pass)
+    task_supervisor.beat("archive_idle_conversations")
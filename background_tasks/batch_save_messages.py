@@ -1,89 +1,68 @@
-from datetime import datetime
-import asyncio
-import json
-from core.redis import redis
+from redis.exceptions import WatchError
+from core.redis import redis, messages_key
 from core.database import db
-
-async def get_last_message_bucket_sequence(group_or_chat_id: str, is_group: bool) -> int:
-  latest_chat = await db.messages.find_one(
-    {"group_id": group_or_chat_id} if is_group else {"chat_id": group_or_chat_id},
-    sort=[("message_bucket_sequence", -1)]
-  )
-  if latest_chat and "message_bucket_sequence" in latest_chat:
-    return latest_chat["message_bucket_sequence"] + 1
-  else:
-    return 0
+from helpers.utils.stored_message_codec import decode_stored_message
+from helpers.utils.message_archive import archive_messages, CONVERSATION_ACTIVITY_KEY
+from helpers.utils.job_lock import run_exclusively
+from helpers.utils.graceful_shutdown import shutting_down, wait_for_shutdown
+from helpers.utils.task_supervisor import task_supervisor
+from helpers.utils.metrics import flush_backlog, redis_list_length
+
+# Messages kept in redis once a conversation's list is flushed, by conversation kind
+FLUSH_THRESHOLD = {"chat": 250, "group": 300}
+KEEP_IN_REDIS = {"chat": 50, "group": 100}
+# A busy conversation can be written to during the bucket insert, it is read again
+FLUSH_ATTEMPTS = 3
+
+async def save_conversation_messages(member: str) -> bool:
+  """
+  Move all but the newest messages of an activity set member ("chat:{id}") to a mongo
+  bucket once its redis list is over the flush threshold. True if it was flushed.
+  Runs under WATCH: a message appended, edited or unsent between the read and the trim
+  drops the bucket again and the list is read anew.
+  """
+  kind, chat_or_group_id = member.split(":")
+  key = messages_key(chat_or_group_id, kind == "group")
+
+  for _ in range(FLUSH_ATTEMPTS):
+    async with redis.pipeline(transaction=True) as pipe:
+      await pipe.watch(key)
+      messages = await pipe.lrange(key, 0, -1)
+      redis_list_length.observe(len(messages))
+
+      if len(messages) <= FLUSH_THRESHOLD[kind]:
+        return False
+
+      messages_to_save = [decode_stored_message(message) for message in messages[:-KEEP_IN_REDIS[kind]]]
+      inserted = await archive_messages(chat_or_group_id, kind == "group", messages_to_save)
+
+      try:
+        # Only the archived head goes, the tail stays as it is in redis
+        pipe.multi()
+        pipe.ltrim(key, len(messages_to_save), -1)
+        await pipe.execute()
+        return True
+      except WatchError:
+        await db.messages.delete_one({"_id": inserted.inserted_id})
+  return False
+
+async def save_message_batches():
+  backlog = 0
+
+  # Every conversation with messages in redis is in the activity set; walking it works
+  # the same on a cluster, where a KEYS or SCAN would have to visit every node
+  async for member, _ in redis.zscan_iter(CONVERSATION_ACTIVITY_KEY, count=500):
+    # Stop between conversations on shutdown, the next pass picks up the rest
+    if shutting_down.is_set():
+      break
+    task_supervisor.beat("batch_save_messages")
+    if await save_conversation_messages(member.decode('utf-8')):
+      backlog += 1
+
+  flush_backlog.set(backlog)
 
 async def batch_save_messages():
-  while True:
-    await asyncio.sleep(100)  # Run every 15 minutes
-
-    # Process chat messages
-    chat_keys = await redis.keys("chat:*")
-    chat_keys = [key.decode('utf-8') for key in chat_keys]
-
-    for key in chat_keys:
-      chat_id = key.split(":")[1]
-      messages = await redis.lrange(key, 0, -1)
-      messages = [json.loads(message.decode('utf-8')) for message in messages]
-
-      if len(messages) > 250:
-        messages_to_save = messages[:-50]
-        remaining_messages = messages[-50:]
-
-        # Check for unseen messages in the batch
-        has_unseen = any(msg for msg in messages_to_save if not msg.get("seen", False))
-
-        # Update Redis with the unseen flag if needed
-        if has_unseen:
-          await redis.set(f"chat:{chat_id}:unseen_in_mongo", 1)
-
-        # Move messages to MongoDB
-        message_bucket_sequence = await get_last_message_bucket_sequence(chat_id, False)
-        document = {
-          "chat_id": chat_id,
-          "messages": messages_to_save,
-          "message_bucket_sequence": message_bucket_sequence,
-          "created_at": datetime.now().isoformat()
-        }
-        await db.messages.insert_one(document)
-
-        # Clear and repopulate Redis with remaining messages
-        await redis.delete(key)
-        for message in remaining_messages:
-          await redis.rpush(f"chat:{chat_id}:messages", json.dumps(message))
-
-    # Process group messages
-    group_keys = await redis.keys("group:*")
-    group_keys = [key.decode('utf-8') for key in group_keys]
-
-    for key in group_keys:
-      group_id = key.split(":")[1]
-      messages = await redis.lrange(key, 0, -1)
-      messages = [json.loads(message.decode('utf-8')) for message in messages]
-
-      if len(messages) > 300:
-        messages_to_save = messages[:-100]
-        remaining_messages = messages[-100:]
-
-        # Check for unseen messages in the batch
-        has_unseen = any(msg for msg in messages_to_save if not msg.get("seen", False))
-
-        # Update Redis with the unseen flag if needed
-        if has_unseen:
-          await redis.set(f"group:{group_id}:unseen_in_mongo", 1)
-
-        # Move messages to MongoDB
-        message_bucket_sequence = await get_last_message_bucket_sequence(group_id, True)
-        document = {
-          "group_id": group_id,
-          "messages": messages_to_save,
-          "message_bucket_sequence": message_bucket_sequence,
-          "created_at": datetime.now().isoformat()
-        }
-        await db.messages.insert_one(document)
-
-        # Clear and repopulate Redis with remaining messages
-        await redis.delete(key)
-        for message in remaining_messages:
-          await redis.rpush(f"group:{group_id}:messages", json.dumps(message))
+  while not await wait_for_shutdown(100):  # Run every 15 minutes
+    # Every worker runs this loop, one of them does the pass
+    await run_exclusively("batch_save_messages", save_message_batches)
+    task_supervisor.beat("batch_save_messages")
@@ -0,0 +1,67 @@
+"""
+Move the inbox embedded in user documents into the inbox collection.
+
+  python -m background_tasks.migrate_inbox
+
+Every entry of a user's inbox.chats and inbox.groups becomes an inbox document, then the
+embedded inbox is removed from the user. Entries are upserted without overwriting, so the
+tool can run while the new code serves traffic and can be run again after a failure.
+Deploy the code that reads the inbox collection first, user inboxes show up there as the
+tool gets to them.
+"""
+import asyncio
+from bson import ObjectId
+from datetime import datetime
+from pymongo import UpdateOne
+from core.database import db
+from helpers.utils.inbox import ensure_inbox_indexes
+
+def last_activity_of(entry: dict, conversation_id: ObjectId) -> datetime:
+  # The last message's time where there was one, else when the conversation was created
+  created_at = (entry.get("last_message") or {}).get("created_at")
+  if isinstance(created_at, datetime):
+    return created_at
+  if isinstance(created_at, str):
+    try:
+      return datetime.fromisoformat(created_at.replace("Z", "+00:00")).replace(tzinfo=None)
+    except ValueError:
+      pass
+  return conversation_id.generation_time.replace(tzinfo=None)
+
+def inbox_documents(user: dict):
+  inbox = user.get("inbox") or {}
+  for kind, id_field in (("chat", "chat_id"), ("group", "group_id")):
+    for entry in inbox.get(f"{kind}s", []):
+      conversation_id = ObjectId(entry[id_field])
+      document = {
+        "kind": kind,
+        "last_message": entry.get("last_message"),
+        "last_activity": last_activity_of(entry, conversation_id)
+      }
+      if entry.get("participant_id"):
+        document["participant_id"] = ObjectId(entry["participant_id"])
+      if entry.get("deleted"):
+        document["deleted"] = True
+      yield UpdateOne(
+        {"user_id": user["_id"], "conversation_id": conversation_id},
+        {"$setOnInsert": document},
+        upsert=True
+      )
+
+async def migrate():
+  await ensure_inbox_indexes()
+
+  users = 0
+  entries = 0
+  async for user in db.users.find({"inbox": {"$exists": True}}, {"inbox": 1}):
+    upserts = list(inbox_documents(user))
+    if upserts:
+      await db.inbox.bulk_write(upserts, ordered=False)
+    # Only once its entries are in, a failed run leaves the user to the next one
+    await db.users.update_one({"_id": user["_id"]}, {"$unset": {"inbox": ""}})
+    users += 1
+    entries += len(upserts)
+  print(f"Moved {entries} inbox entries of {users} users")
+
+if __name__ == "__main__":
+  asyncio.run(migrate())
@@ -0,0 +1,41 @@
+"""
+Rename the conversation keys of a single redis instance to the hash-tagged layout.
+
+  python -m background_tasks.migrate_key_layout
+
+"chat:<id>:messages" becomes "chat:{<id>}:messages", likewise for the events streams and
+unseen_in_mongo flags of chats and groups, and every conversation with a messages list
+is added to the activity set the background jobs walk. Run it once against the single
+instance with the app stopped while deploying the new layout, and before moving the data
+to a cluster: RENAME can't move keys between slots there.
+"""
+import asyncio
+import time
+from core.redis import redis, conversation_prefix
+from helpers.utils.message_archive import CONVERSATION_ACTIVITY_KEY
+
+async def migrate():
+  renamed = 0
+  skipped = []
+  for kind in ("chat", "group"):
+    for suffix in ("messages", "events", "unseen_in_mongo"):
+      async for key in redis.scan_iter(match=f"{kind}:*:{suffix}", count=500):
+        key = key.decode('utf-8')
+        chat_or_group_id = key.split(":")[1]
+        if chat_or_group_id.startswith("{"):
+          continue  # Already in the new layout
+
+        new_key = f"{conversation_prefix(chat_or_group_id, kind == 'group')}:{suffix}"
+        # Never overwrite what the new code already wrote under the new name
+        if await redis.renamenx(key, new_key):
+          renamed += 1
+        else:
+          skipped.append(key)
+        if suffix == "messages":
+          await redis.zadd(CONVERSATION_ACTIVITY_KEY, {f"{kind}:{chat_or_group_id}": time.time()}, nx=True)
+  print(f"Renamed {renamed} keys")
+  if skipped:
+    print(f"Left {len(skipped)} keys whose new name already exists: {', '.join(skipped)}")
+
+if __name__ == "__main__":
+  asyncio.run(migrate())
@@ -0,0 +1,49 @@
+"""
+Rewrite the redis messages lists into another stored message encoding.
+
+  python -m background_tasks.migrate_message_encoding --to tuple
+
+Set REDIS_MESSAGE_ENCODING to the target encoding on every node first: readers decode
+every format, so lists can be migrated while the app is running, and new messages
+are already written in the target format. Run with --to json to roll back.
+"""
+import argparse
+import asyncio
+from redis.exceptions import WatchError
+from core.redis import redis, messages_key
+from helpers.utils.stored_message_codec import encode_stored_message, decode_stored_message
+from helpers.utils.message_archive import CONVERSATION_ACTIVITY_KEY
+
+async def migrate_list(key: str, encoding: str) -> int:
+  # WATCH makes sure no message is appended or edited while the list is rewritten
+  while True:
+    async with redis.pipeline(transaction=True) as pipe:
+      try:
+        await pipe.watch(key)
+        messages = await pipe.lrange(key, 0, -1)
+        encoded = [encode_stored_message(decode_stored_message(message), encoding=encoding) for message in messages]
+
+        pipe.multi()
+        pipe.delete(key)
+        if encoded:
+          pipe.rpush(key, *encoded)
+        await pipe.execute()
+        return len(encoded)
+      except WatchError:
+        continue
+
+async def migrate(encoding: str):
+  keys = 0
+  messages = 0
+  # The activity set names every conversation with a messages list, on a cluster too
+  async for member, _ in redis.zscan_iter(CONVERSATION_ACTIVITY_KEY, count=500):
+    kind, chat_or_group_id = member.decode('utf-8').split(":")
+    messages += await migrate_list(messages_key(chat_or_group_id, kind == "group"), encoding)
+    keys += 1
+  print(f"Migrated {messages} messages in {keys} lists to {encoding}")
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--to", choices=["json", "tuple", "msgpack"], required=True)
+  args = parser.parse_args()
+  asyncio.run(migrate(args.to))
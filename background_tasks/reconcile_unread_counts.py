@@ -0,0 +1,63 @@
+from bson import ObjectId
+from pymongo import UpdateMany, UpdateOne
+from core.redis import redis, unread_counts_key
+from core.database import db
+from core.settings import settings
+from helpers.utils.unread_counters import UNREAD_DIRTY_KEY, LOADED_FIELD
+from helpers.utils.job_lock import run_exclusively
+from helpers.utils.graceful_shutdown import shutting_down, wait_for_shutdown
+from helpers.utils.task_supervisor import task_supervisor
+
+def reconcile_writes(user_id: ObjectId, counts: dict) -> list:
+  """
+  Writes that make a user's inbox entries carry their redis counters. Counters of a hash
+  that isn't loaded are partial, they are copied once a read merged them.
+  """
+  counts = {field.decode('utf-8'): int(count) for field, count in counts.items()}
+  if LOADED_FIELD not in counts:
+    return []
+  del counts[LOADED_FIELD]
+
+  conversation_ids = [ObjectId(member.split(":")[1]) for member in counts]
+  writes = [
+    UpdateOne({"user_id": user_id, "conversation_id": conversation_id}, {"$set": {"unread_count": count}})
+    for conversation_id, count in zip(conversation_ids, counts.values())
+  ]
+  # Counters read down to zero were removed from the hash
+  writes.append(UpdateMany(
+    {"user_id": user_id, "unread_count": {"$gt": 0}, "conversation_id": {"$nin": conversation_ids}},
+    {"$set": {"unread_count": 0}}
+  ))
+  return writes
+
+async def reconcile_pass():
+  while True:
+    user_ids = await redis.spop(UNREAD_DIRTY_KEY, 500)
+    if not user_ids:
+      return
+
+    try:
+      user_ids = [ObjectId(user_id.decode('utf-8')) for user_id in user_ids]
+      async with redis.pipeline(transaction=False) as pipe:
+        for user_id in user_ids:
+          pipe.hgetall(unread_counts_key(user_id))
+        user_counts = await pipe.execute()
+
+      writes = [write for user_id, counts in zip(user_ids, user_counts) for write in reconcile_writes(user_id, counts)]
+      if writes:
+        await db.inbox.bulk_write(writes, ordered=False)
+    except Exception:
+      # Back in the set for the next pass
+      await redis.sadd(UNREAD_DIRTY_KEY, *[str(user_id) for user_id in user_ids])
+      raise
+
+    task_supervisor.beat("reconcile_unread_counts")
+    # Stop between slices on shutdown, the rest stays in the set
+    if shutting_down.is_set():
+      return
+
+async def reconcile_unread_counts():
+  while not await wait_for_shutdown(settings.UNREAD_RECONCILE_INTERVAL):
+    # Every worker runs this loop, one of them does the pass
+    await run_exclusively("reconcile_unread_counts", reconcile_pass)
+    task_supervisor.beat("reconcile_unread_counts")
@@ -0,0 +1,62 @@
+from bson import ObjectId
+from core.redis import redis, messages_key, event_stream_key, unseen_flag_key, call_session_key
+from core.database import db
+from core.settings import settings
+from helpers.utils.cleanup_jobs import claim_cleanup, complete_cleanup
+from helpers.utils.message_archive import bucket_filter, CONVERSATION_ACTIVITY_KEY
+from helpers.utils.inbox import unindex_conversation
+from helpers.utils.graceful_shutdown import shutting_down, wait_for_shutdown
+from helpers.utils.task_supervisor import task_supervisor
+
+async def delete_conversation_data(job: dict):
+  """
+  Everything a deleted chat or group leaves behind once its document is gone: the redis
+  keys, its activity set entry, the mongo message buckets and its members' inbox
+  entries.
+  """
+  chat_or_group_id = job["conversation_id"]
+  is_group = job["is_group"]
+
+  # The redis keys first, so batch_save can't flush the redis tail into a new bucket
+  # after the buckets are gone. All of them share the conversation's cluster slot
+  keys = [
+    messages_key(chat_or_group_id, is_group),
+    event_stream_key(chat_or_group_id, is_group),
+    unseen_flag_key(chat_or_group_id, is_group)
+  ]
+  if not is_group:
+    keys.append(call_session_key(chat_or_group_id))
+  await redis.delete(*keys)
+  await redis.zrem(CONVERSATION_ACTIVITY_KEY, f"{'group' if is_group else 'chat'}:{chat_or_group_id}")
+
+  await db.messages.delete_many(bucket_filter(chat_or_group_id, is_group))
+
+  # Out of every member's inbox index, then their entries: small documents, a 5,000
+  # member group is one delete_many
+  conversation_id = ObjectId(chat_or_group_id)
+  member_ids = [entry["user_id"] async for entry in db.inbox.find({"conversation_id": conversation_id}, {"user_id": 1})]
+  await unindex_conversation(member_ids, "group" if is_group else "chat", conversation_id)
+  await db.inbox.delete_many({"conversation_id": conversation_id})
+
+CLEANUP_HANDLERS = {
+  "delete_conversation": delete_conversation_data
+}
+
+async def run_cleanup_jobs():
+  # Every worker takes jobs, each job is claimed by one of them at a time
+  while not shutting_down.is_set():
+    task_supervisor.beat("run_cleanup_jobs")
+    claimed = await claim_cleanup()
+    if claimed is None:
+      if await wait_for_shutdown(settings.CLEANUP_JOB_POLL_INTERVAL):
+        return
+      continue
+
+    raw_job, job = claimed
+    try:
+      await CLEANUP_HANDLERS[job["kind"]](job)
+    except Exception as e:
+      # Left claimed, it comes due again once the lease runs out
+      print(f"Error: cleanup job {job['kind']} {job['id']} failed: {str(e)}")
+      continue
+    await complete_cleanup(raw_job)
@@ -0,0 +1,94 @@
+"""
+Messages/sec on one core for the JSON work a chat message costs, before and after
+routing it through helpers.utils.json_codec.
+
+  python -m benchmarks.codec_benchmark --messages 50000 --recipients 2 50
+
+"before" replays the stdlib calls the hot path used to make: decode the frame, encode
+for rpush, encode again for publish, decode in redis_subscriber and encode once per
+recipient in broadcast. "after" decodes the frame, encodes once for both rpush and
+publish and forwards the published text untouched. fetch-recent-chat is timed
+separately for a 50 message redis tail.
+"""
+import argparse
+import json
+import time
+from helpers.utils import json_codec
+
+def sample_frame(sequence: int) -> str:
+  return json.dumps({
+    "id": f"msg-{sequence}",
+    "reply_to_id": None,
+    "reply_to_content": None,
+    "content": "hey, are we still on for tomorrow? " * 2,
+    "action": "message",
+    "created_at": "2024-12-28T10:15:00.000Z"
+  })
+
+def message_data(data: dict, sequence: int) -> dict:
+  return {
+    "id": data["id"],
+    "sender_id": "6770a3f2c1e9b4a1d2f3e4a5",
+    "reply_to_id": data["reply_to_id"],
+    "reply_to_content": data["reply_to_content"],
+    "content": data["content"],
+    "message_sequence": sequence,
+    "seen": False,
+    "seen_timestamp": None,
+    "action": data["action"],
+    "created_at": data["created_at"]
+  }
+
+def before(frames: list, recipients: int):
+  for sequence, frame in enumerate(frames):
+    data = message_data(json.loads(frame), sequence)
+    stored = json.dumps(data)                      # rpush
+    published = json.dumps(data)                   # publish_message
+    received = json.loads(published)               # redis_subscriber
+    for _ in range(recipients):
+      json.dumps(received)                         # broadcast, once per socket
+    del stored
+
+def after(frames: list, recipients: int):
+  for sequence, frame in enumerate(frames):
+    data = message_data(json_codec.loads(frame), sequence)
+    encoded = json_codec.dumpb(data)               # rpush and publish_message
+    encoded.decode("utf-8")                        # redis_subscriber -> broadcast, shared by every socket
+
+def fetch_recent_before(tail: list):
+  json.dumps({"messages": [json.loads(message) for message in tail]})
+
+def fetch_recent_after(tail: list):
+  json_codec.raw_json_array_response("messages", tail)
+
+def rate(function, *args, count: int) -> float:
+  started = time.process_time()
+  function(*args)
+  return count / (time.process_time() - started)
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--messages", type=int, default=50000)
+  parser.add_argument("--recipients", type=int, nargs="+", default=[2, 50])
+  parser.add_argument("--fetches", type=int, default=5000)
+  args = parser.parse_args()
+
+  frames = [sample_frame(sequence) for sequence in range(args.messages)]
+  results = {"encoder": "orjson" if json_codec.orjson else "json", "ingest_and_fanout": {}}
+
+  for recipients in args.recipients:
+    results["ingest_and_fanout"][f"{recipients}_recipients"] = {
+      "before_messages_per_sec": round(rate(before, frames, recipients, count=args.messages)),
+      "after_messages_per_sec": round(rate(after, frames, recipients, count=args.messages))
+    }
+
+  tail = [json.dumps(message_data(json.loads(frame), sequence)).encode("utf-8") for sequence, frame in enumerate(frames[:50])]
+  results["fetch_recent_chat_50_messages"] = {
+    "before_requests_per_sec": round(rate(lambda: [fetch_recent_before(tail) for _ in range(args.fetches)], count=args.fetches)),
+    "after_requests_per_sec": round(rate(lambda: [fetch_recent_after(tail) for _ in range(args.fetches)], count=args.fetches))
+  }
+
+  print(json.dumps(results, indent=2))
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,189 @@
+"""
+Cost of the conversation maintenance paths as a conversation grows.
+
+  python -m benchmarks.conversation_size_benchmark --messages 10,1000,100000 --buckets 1,100,10000 --repeat 5
+
+For every --buckets count a chat gets that many archived mongo buckets of --bucket-size
+messages, and for every --messages count its redis list is filled with that many
+messages. Then each operation is run --repeat times, with the redis list reseeded before
+every run:
+
+  save_conversation_messages  flush of the redis list into a mongo bucket (batch_save_messages)
+  mark_as_seen                the /mark-as-seen route with the unseen_in_mongo flag set
+  unsend_recent_message       the /unsend-recent-message route for a message in the middle of the list
+  fetch_older_messages        the /fetch-older-chat route for the middle bucket
+
+and the result lists the median and max time, the redis round trips (one per command or
+pipeline written to a connection), the commands redis processed and the mongo round
+trips by command, as JSON. Needs the DATABASE_CONNECTION_URL and REDIS_CONNECTION_URL of
+.env; the seeded chat, its buckets and keys are removed again.
+"""
+from pymongo import monitoring
+
+class MongoRoundTrips(monitoring.CommandListener):
+  # Registered before any client exists, every client of this process reports to it
+  def __init__(self):
+    self.commands = {}
+
+  def started(self, event):
+    self.commands[event.command_name] = self.commands.get(event.command_name, 0) + 1
+
+  def succeeded(self, event):
+    pass
+
+  def failed(self, event):
+    pass
+
+mongo_round_trips = MongoRoundTrips()
+monitoring.register(mongo_round_trips)
+
+import argparse
+import asyncio
+import json
+import statistics
+import time
+from bson import ObjectId
+from datetime import datetime
+from redis.asyncio.connection import AbstractConnection
+from core.database import db
+from core.redis import redis, messages_key, event_stream_key, unseen_flag_key
+from helpers.utils.stored_message_codec import encode_stored_message
+from background_tasks.batch_save_messages import save_conversation_messages
+from routes.chats.chat_route import mark_as_seen, unsend_recent_message, fetch_older_messages
+
+redis_round_trips = 0
+send_packed_command = AbstractConnection.send_packed_command
+
+async def counted_send_packed_command(self, command, check_health=True):
+  # A single command and a whole pipeline are both written with one call
+  global redis_round_trips
+  redis_round_trips += 1
+  return await send_packed_command(self, command, check_health)
+
+AbstractConnection.send_packed_command = counted_send_packed_command
+
+def message(index: int, sender_id: ObjectId) -> dict:
+  return {
+    "id": f"bench-{index}",
+    "sender_id": str(sender_id),
+    "reply_to_id": f"bench-{index - 1}" if index % 10 == 0 and index else None,
+    "reply_to_content": "an earlier message" if index % 10 == 0 and index else None,
+    "content": f"conversation size benchmark message {index}",
+    "message_sequence": index,
+    "seen": False,
+    "seen_timestamp": None,
+    "action": "message",
+    "created_at": "2024-12-28T10:15:00.000000"
+  }
+
+async def seed_buckets(chat_id: ObjectId, sender_id: ObjectId, buckets: int, bucket_size: int):
+  documents = [
+    {
+      "chat_id": str(chat_id),
+      "messages": [message(bucket * bucket_size + index, sender_id) for index in range(bucket_size)],
+      "message_bucket_sequence": bucket,
+      "created_at": datetime.now().isoformat()
+    }
+    for bucket in range(buckets)
+  ]
+  for start in range(0, len(documents), 1000):
+    await db.messages.insert_many(documents[start:start + 1000])
+
+async def seed_redis_list(chat_id: ObjectId, sender_id: ObjectId, messages: int, first_sequence: int):
+  key = messages_key(chat_id)
+  await redis.delete(key)
+  for start in range(0, messages, 5000):
+    await redis.rpush(key, *[
+      encode_stored_message(message(first_sequence + index, sender_id))
+      for index in range(start, min(messages, start + 5000))
+    ])
+
+async def commands_processed() -> int:
+  return (await redis.info("stats"))["total_commands_processed"]
+
+async def time_operation(operation, prepare, repeat: int) -> dict:
+  global redis_round_trips
+  timings, redis_trips, redis_commands, mongo_trips = [], [], [], []
+
+  for _ in range(repeat):
+    await prepare()
+    mongo_round_trips.commands = {}
+    redis_round_trips = 0
+    # INFO itself is one of the commands counted between the two reads
+    commands_before = await commands_processed()
+
+    started = time.perf_counter()
+    await operation()
+    timings.append(time.perf_counter() - started)
+
+    redis_trips.append(redis_round_trips - 1)
+    redis_commands.append(await commands_processed() - commands_before - 1)
+    mongo_trips.append(dict(mongo_round_trips.commands))
+
+  return {
+    "median_ms": round(statistics.median(timings) * 1000, 2),
+    "max_ms": round(max(timings) * 1000, 2),
+    "redis_round_trips": max(redis_trips),
+    "redis_commands": max(redis_commands),
+    "mongo_round_trips": mongo_trips[-1]
+  }
+
+async def run_sizes(chat_id: ObjectId, participants: list, buckets: int, message_counts: list, args) -> list:
+  sender_id, reader_id = participants
+  first_sequence = buckets * args.bucket_size
+  results = []
+
+  for messages in message_counts:
+    async def reseed():
+      await seed_redis_list(chat_id, sender_id, messages, first_sequence)
+
+    async def reseed_unseen():
+      await reseed()
+      await redis.set(unseen_flag_key(chat_id), 1)
+
+    async def reseed_and_drop_flushed_bucket():
+      await reseed()
+      await db.messages.delete_many({"chat_id": str(chat_id), "message_bucket_sequence": {"$gte": buckets}})
+
+    middle_message = f"bench-{first_sequence + messages // 2}"
+    operations = {
+      "save_conversation_messages": (lambda: save_conversation_messages(f"chat:{chat_id}"), reseed_and_drop_flushed_bucket),
+      "mark_as_seen": (lambda: mark_as_seen(str(chat_id), datetime.now().isoformat(), reader_id, db), reseed_unseen),
+      "unsend_recent_message": (lambda: unsend_recent_message(str(chat_id), middle_message, db, sender_id), reseed),
+      "fetch_older_messages": (lambda: fetch_older_messages(str(chat_id), buckets // 2, db, reader_id), reseed)
+    }
+    for name, (operation, prepare) in operations.items():
+      result = await time_operation(operation, prepare, args.repeat)
+      results.append({"operation": name, "messages": messages, "buckets": buckets, **result})
+      print(json.dumps(results[-1]))
+
+  await db.messages.delete_many({"chat_id": str(chat_id), "message_bucket_sequence": {"$gte": buckets}})
+  return results
+
+async def main(args):
+  message_counts = [int(count) for count in args.messages.split(",")]
+  results = []
+
+  for buckets in [int(count) for count in args.buckets.split(",")]:
+    participants = [ObjectId(), ObjectId()]
+    chat_id = (await db.chats.insert_one({"participants": participants, "created_at": datetime.now()})).inserted_id
+    try:
+      await seed_buckets(chat_id, participants[0], buckets, args.bucket_size)
+      results += await run_sizes(chat_id, participants, buckets, message_counts, args)
+    finally:
+      await db.chats.delete_one({"_id": chat_id})
+      await db.messages.delete_many({"chat_id": str(chat_id)})
+      await redis.delete(messages_key(chat_id), event_stream_key(chat_id), unseen_flag_key(chat_id))
+
+  if args.output:
+    with open(args.output, "w") as output:
+      json.dump(results, output, indent=2)
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--messages", default="10,1000,100000", help="redis list lengths")
+  parser.add_argument("--buckets", default="1,100,10000", help="archived mongo bucket counts")
+  parser.add_argument("--bucket-size", type=int, default=50, help="messages per archived bucket")
+  parser.add_argument("--repeat", type=int, default=5)
+  parser.add_argument("--output", help="also write the JSON results to this file")
+  asyncio.run(main(parser.parse_args()))
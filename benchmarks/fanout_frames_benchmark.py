@@ -0,0 +1,101 @@
+"""
+Frames and bytes per delivered message on the group fan-out path, by negotiated frame format.
+
+  python -m benchmarks.fanout_frames_benchmark --recipients 200 --messages 2000 --burst 20
+
+Drives helpers.utils.websocket_connection_manager with in-memory sockets the way the
+conversation event reader does: every XREAD response of --burst events is broadcast in
+one go. --send-delay-us makes each socket write take that long, like a client whose
+TCP window is filling up, so events also queue up behind frames still being written.
+"""
+import argparse
+import asyncio
+import json
+import time
+from starlette.websockets import WebSocketState
+from core.settings import settings
+from helpers.utils.json_codec import dumps
+from helpers.utils.websocket_connection_manager import ConnectionManager
+
+FORMATS = {
+  "per_event_text": {},
+  "coalesced_text": {"coalesce": "1"},
+  "coalesced_binary": {"coalesce": "1", "encoding": "binary"},
+  "coalesced_deflate": {"coalesce": "1", "encoding": "deflate"}
+}
+
+class CountingWebSocket:
+  client_state = WebSocketState.CONNECTED
+
+  def __init__(self, query_params: dict, send_delay: float):
+    self.query_params = query_params
+    self.send_delay = send_delay
+    self.frames = 0
+    self.bytes = 0
+
+  async def accept(self):
+    pass
+
+  async def send(self, size: int):
+    self.frames += 1
+    self.bytes += size
+    await asyncio.sleep(self.send_delay)
+
+  async def send_text(self, text: str):
+    await self.send(len(text.encode('utf-8')))
+
+  async def send_bytes(self, data: bytes):
+    await self.send(len(data))
+
+def event(index: int) -> str:
+  return dumps({
+    "event_id": f"{1735380900000 + index}-0",
+    "id": f"msg{index:06d}",
+    "sender_id": "6770a3f2c1e9b4a1d2f3e4a5",
+    "reply_to_id": None,
+    "content": f"did anyone else get the update for build {index}? it keeps asking me to restart",
+    "message_sequence": index,
+    "created_at": "2024-12-28T10:15:00.000000"
+  })
+
+async def run(query_params: dict, recipients: int, messages: int, burst: int, send_delay: float) -> dict:
+  manager = ConnectionManager()
+  sockets = [CountingWebSocket(query_params, send_delay) for _ in range(recipients)]
+  for index, websocket in enumerate(sockets):
+    await manager.connect(websocket, "group", f"socket-{index}")
+
+  events = [(event(index), f"{1735380900000 + index}-0") for index in range(messages)]
+  started = time.perf_counter()
+  for offset in range(0, messages, burst):
+    for text, event_id in events[offset:offset + burst]:
+      await manager.broadcast("group", text, event_id)
+    await asyncio.sleep(0)  # The reader awaits its next XREAD here
+
+  # Wait for every flush task to finish writing
+  while any(connection["flushing"] for connection in manager.active_connections["group"]):
+    await asyncio.sleep(0.001)
+  elapsed = time.perf_counter() - started
+
+  delivered = recipients * messages
+  return {
+    "frames_per_message": round(sum(websocket.frames for websocket in sockets) / delivered, 3),
+    "bytes_per_message": round(sum(websocket.bytes for websocket in sockets) / delivered, 1),
+    "delivered_per_sec": round(delivered / elapsed)
+  }
+
+async def main(recipients: int, messages: int, burst: int, send_delay_us: int, window_ms: int):
+  settings.OUTBOUND_COALESCE_WINDOW_MS = window_ms
+  results = {"recipients": recipients, "messages": messages, "burst": burst, "send_delay_us": send_delay_us, "window_ms": window_ms}
+  for name, query_params in FORMATS.items():
+    results[name] = await run(query_params, recipients, messages, burst, send_delay_us / 1_000_000)
+  print(json.dumps(results, indent=2))
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--recipients", type=int, default=200)
+  parser.add_argument("--messages", type=int, default=2000)
+  parser.add_argument("--burst", type=int, default=20)
+  parser.add_argument("--send-delay-us", type=int, default=0)
+  parser.add_argument("--window-ms", type=int, default=0)
+  args = parser.parse_args()
+  asyncio.run(main(args.recipients, args.messages, args.burst, args.send_delay_us, args.window_ms))
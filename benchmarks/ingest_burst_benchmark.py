@@ -0,0 +1,108 @@
+"""
+Group ingest throughput for a paced burst, per-message writes vs the ingest batcher.
+
+  python -m benchmarks.ingest_burst_benchmark --rate 1000 --seconds 5
+
+Uses REDIS_CONNECTION_URL and only touches the keys of the `bench-ingest-*` groups. "per_message"
+replays what the receive loop used to do for every frame (LINDEX for the sequence,
+RPUSH, publish, activity ZADD, each awaited); "batched" hands the same frames to
+helpers.utils.ingest_batcher. Reported latency is frame arrival to commit.
+"""
+import argparse
+import asyncio
+import json
+import time
+from core.redis import redis, messages_key, event_stream_key
+from helpers.utils.ingest_batcher import ingest_batcher
+from helpers.utils.json_codec import dumpb
+from helpers.utils.message_archive import CONVERSATION_ACTIVITY_KEY
+from helpers.utils.redis_pubsub import publish_message
+from helpers.utils.stored_message_codec import encode_stored_message, decode_stored_message
+
+def frame(index: int) -> dict:
+  return {
+    "id": f"bench-{index}",
+    "sender_id": "6770a3f2c1e9b4a1d2f3e4a5",
+    "reply_to_id": None,
+    "content": f"forwarded message number {index}",
+    "message_sequence": None,
+    "created_at": "2024-12-28T10:15:00.000000"
+  }
+
+def percentile(samples: list, fraction: float) -> float:
+  samples = sorted(samples)
+  return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+async def commands_processed() -> int:
+  return (await redis.info("stats"))["total_commands_processed"]
+
+async def per_message(group_id: str, queue: asyncio.Queue, latencies: list, total: int):
+  key = messages_key(group_id, True)
+  for _ in range(total):
+    arrived, message_data = await queue.get()
+    last_message = await redis.lindex(key, -1)
+    message_data["message_sequence"] = decode_stored_message(last_message)["message_sequence"] + 1
+    encoded = dumpb(message_data)
+    await redis.rpush(key, encode_stored_message(message_data, encoded))
+    await publish_message(group_id, encoded, is_group=True)
+    await redis.zadd(CONVERSATION_ACTIVITY_KEY, {f"group:{group_id}": time.time()})
+    latencies.append(time.perf_counter() - arrived)
+
+async def run(mode: str, rate: int, seconds: int) -> dict:
+  group_id = f"bench-ingest-{mode}"
+  await redis.delete(messages_key(group_id, True), event_stream_key(group_id, True))
+  seed = frame(-1)
+  seed["message_sequence"] = 0
+  await redis.rpush(messages_key(group_id, True), encode_stored_message(seed))
+
+  total = rate * seconds
+  latencies = []
+  queue = asyncio.Queue()
+  pending = []
+  consumer = asyncio.create_task(per_message(group_id, queue, latencies, total)) if mode == "per_message" else None
+
+  def on_commit(arrived):
+    return lambda _: latencies.append(time.perf_counter() - arrived)
+
+  commands_before = await commands_processed()
+  started = time.perf_counter()
+  for index in range(total):
+    # Open-loop pacing: frames arrive on schedule whether or not ingest keeps up
+    delay = started + index / rate - time.perf_counter()
+    if delay > 0:
+      await asyncio.sleep(delay)
+    arrived = time.perf_counter()
+    if mode == "per_message":
+      queue.put_nowait((arrived, frame(index)))
+    else:
+      future = ingest_batcher.submit(group_id, True, frame(index))
+      future.add_done_callback(on_commit(arrived))
+      pending.append(future)
+
+  await (consumer if consumer else asyncio.gather(*pending))
+  elapsed = time.perf_counter() - started
+  commands = await commands_processed() - commands_before
+
+  await redis.delete(messages_key(group_id, True), event_stream_key(group_id, True))
+  await redis.zrem(CONVERSATION_ACTIVITY_KEY, f"group:{group_id}")
+
+  return {
+    "messages": total,
+    "committed_per_sec": round(total / elapsed),
+    "p50_commit_latency_ms": round(percentile(latencies, 0.50) * 1000, 2),
+    "p99_commit_latency_ms": round(percentile(latencies, 0.99) * 1000, 2),
+    "redis_commands_per_message": round(commands / total, 2)
+  }
+
+async def main(rate: int, seconds: int):
+  results = {"rate": rate, "seconds": seconds}
+  for mode in ("per_message", "batched"):
+    results[mode] = await run(mode, rate, seconds)
+  print(json.dumps(results, indent=2))
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--rate", type=int, default=1000)
+  parser.add_argument("--seconds", type=int, default=5)
+  args = parser.parse_args()
+  asyncio.run(main(args.rate, args.seconds))
@@ -0,0 +1,91 @@
+"""
+Bytes per message for each REDIS_MESSAGE_ENCODING on a synthetic 1M message workload.
+
+  python -m benchmarks.message_encoding_benchmark --messages 1000000
+  python -m benchmarks.message_encoding_benchmark --redis-url redis://localhost:6379/15
+
+With --redis-url the messages are also loaded into `bench:encoding:*` lists (100 per
+conversation, like a flushed hot tail) and the used_memory growth is reported per
+encoding. RSS isn't: the allocator keeps the pages of the previous encoding's deleted
+keys, so its growth depends on the order encodings run in. Only the bench keys are
+touched and they are deleted afterwards.
+"""
+import argparse
+import asyncio
+import json
+import random
+import string
+from uuid import uuid4
+from helpers.utils.stored_message_codec import encode_stored_message, msgpack
+
+MESSAGES_PER_CONVERSATION = 100
+
+def synthetic_message(rng: random.Random, sequence: int) -> dict:
+  words = rng.randint(1, 20)
+  content = " ".join("".join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(2, 8))) for _ in range(words))
+  replying = rng.random() < 0.15
+  seen = rng.random() < 0.7
+  return {
+    "id": str(uuid4()),
+    "sender_id": "%024x" % rng.getrandbits(96),
+    "reply_to_id": str(uuid4()) if replying else None,
+    "reply_to_content": content[:30] if replying else None,
+    "content": content,
+    "message_sequence": sequence,
+    "seen": seen,
+    "seen_timestamp": "2024-12-28T10:16:03.512Z" if seen else None,
+    "action": "message",
+    "created_at": "2024-12-28T10:15:00.000Z"
+  }
+
+async def redis_memory(url: str, encoded: list, encoding: str) -> dict:
+  import redis.asyncio as redis_asyncio
+
+  client = redis_asyncio.from_url(url)
+  before = await client.info("memory")
+
+  keys = []
+  for start in range(0, len(encoded), MESSAGES_PER_CONVERSATION):
+    key = f"bench:encoding:{encoding}:{start // MESSAGES_PER_CONVERSATION}"
+    keys.append(key)
+    await client.rpush(key, *encoded[start:start + MESSAGES_PER_CONVERSATION])
+
+  after = await client.info("memory")
+  for start in range(0, len(keys), 1000):
+    await client.delete(*keys[start:start + 1000])
+  await client.aclose()
+
+  growth = after["used_memory"] - before["used_memory"]
+  return {
+    "used_memory_bytes_per_message": round(growth / len(encoded), 1),
+    "used_memory_growth_mb": round(growth / 2 ** 20, 1)
+  }
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--messages", type=int, default=1_000_000)
+  parser.add_argument("--seed", type=int, default=7)
+  parser.add_argument("--redis-url")
+  args = parser.parse_args()
+
+  rng = random.Random(args.seed)
+  messages = [synthetic_message(rng, sequence % MESSAGES_PER_CONVERSATION) for sequence in range(args.messages)]
+
+  encodings = ["json", "tuple"] + (["msgpack"] if msgpack else [])
+  results = {"messages": args.messages, "encodings": {}}
+
+  for encoding in encodings:
+    encoded = [encode_stored_message(message, encoding=encoding) for message in messages]
+    total = sum(len(entry) for entry in encoded)
+    result = {
+      "bytes_per_message": round(total / len(encoded), 1),
+      "payload_mb": round(total / 2 ** 20, 1)
+    }
+    if args.redis_url:
+      result["redis"] = asyncio.run(redis_memory(args.redis_url, encoded, encoding))
+    results["encodings"][encoding] = result
+
+  print(json.dumps(results, indent=2))
+
+if __name__ == "__main__":
+  main()
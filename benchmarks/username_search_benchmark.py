@@ -0,0 +1,113 @@
+"""
+p50/p99 latency of the local username index with 1M synthetic usernames.
+
+  python -m benchmarks.username_search_benchmark --users 1000000 --queries 2000
+
+Pass --compare-aggregation to also time the Atlas `$search` pipeline used by
+/api/search/search-users against DATABASE_CONNECTION_URL with the same queries.
+"""
+import argparse
+import asyncio
+import json
+import random
+import string
+import time
+from helpers.utils.username_search_index import UsernameSearchIndex
+
+SYLLABLES = [
+  "al", "an", "ar", "ba", "be", "ca", "da", "de", "el", "en", "fa", "ha", "ia", "is", "ja",
+  "ka", "la", "le", "li", "ma", "mi", "na", "ne", "no", "ra", "ri", "sa", "se", "ta", "to",
+  "ur", "va", "yo", "za", "zi", "ki", "mo", "ro", "lu", "an"
+]
+
+def synthetic_username(rng: random.Random) -> str:
+  username = "".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 5)))
+  if rng.random() < 0.5:
+    username += str(rng.randint(0, 9999))
+  return username[:16]
+
+def with_typo(rng: random.Random, username: str) -> str:
+  position = rng.randrange(len(username))
+  edit = rng.choice(("replace", "delete", "insert"))
+  if edit == "replace":
+    return username[:position] + rng.choice(string.ascii_lowercase) + username[position + 1:]
+  if edit == "delete":
+    return username[:position] + username[position + 1:]
+  return username[:position] + rng.choice(string.ascii_lowercase) + username[position:]
+
+def build_queries(rng: random.Random, usernames: list, count: int) -> list:
+  # Mix of what a search box sees: keystroke prefixes, exact names and typos
+  queries = []
+  for _ in range(count):
+    username = rng.choice(usernames)
+    kind = rng.random()
+    if kind < 0.4:
+      queries.append(username[:rng.randint(1, len(username))])
+    elif kind < 0.6:
+      queries.append(username)
+    else:
+      queries.append(with_typo(rng, username))
+  return queries
+
+def percentile(samples: list, fraction: float) -> float:
+  samples = sorted(samples)
+  return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+def summarize(samples: list) -> dict:
+  return {
+    "p50_ms": round(percentile(samples, 0.50) * 1000, 3),
+    "p99_ms": round(percentile(samples, 0.99) * 1000, 3),
+    "max_ms": round(max(samples) * 1000, 3)
+  }
+
+def run_local(usernames: list, queries: list) -> dict:
+  index = UsernameSearchIndex(query_cache_size=0)
+
+  started = time.perf_counter()
+  index.add_many((str(user_id), username) for user_id, username in enumerate(usernames))
+  build_seconds = time.perf_counter() - started
+
+  samples = []
+  for query in queries:
+    started = time.perf_counter()
+    index.search(query)
+    samples.append(time.perf_counter() - started)
+
+  return {"build_seconds": round(build_seconds, 2), **summarize(samples)}
+
+async def run_aggregation(queries: list) -> dict:
+  from core.database import db
+
+  samples = []
+  for query in queries:
+    started = time.perf_counter()
+    cursor = db.users.aggregate([
+      {"$search": {"index": "username_idx", "compound": {"should": [{"text": {"query": query, "path": "username", "fuzzy": {"maxEdits": 2}}}], "minimumShouldMatch": 1}}},
+      {"$project": {"username": 1, "profile_image": 1}},
+      {"$limit": 10}
+    ])
+    await cursor.to_list(length=10)
+    samples.append(time.perf_counter() - started)
+
+  return summarize(samples)
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--users", type=int, default=1_000_000)
+  parser.add_argument("--queries", type=int, default=2000)
+  parser.add_argument("--seed", type=int, default=7)
+  parser.add_argument("--compare-aggregation", action="store_true")
+  args = parser.parse_args()
+
+  rng = random.Random(args.seed)
+  usernames = [synthetic_username(rng) for _ in range(args.users)]
+  queries = build_queries(rng, usernames, args.queries)
+
+  results = {"users": args.users, "queries": args.queries, "local_index": run_local(usernames, queries)}
+  if args.compare_aggregation:
+    results["atlas_aggregation"] = asyncio.run(run_aggregation(queries))
+
+  print(json.dumps(results, indent=2))
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,266 @@
+"""
+Load test of the socket and HTTP hot paths with many simulated clients.
+
+  python -m benchmarks.websocket_load_benchmark --chats 500 --groups 50 --group-size 10 --messages 20 --rate 2 --http-clients 20 --output load.json
+
+main.py is started on --port with --workers processes (or --url points at a running
+server) and --chats two-person chats and --groups groups of --group-size are seeded. Every
+participant connects through /api/chat/continue-chat or /api/group/continue-group-chat
+and sends --messages messages at --rate per second, resending refused frames, while
+--http-clients clients loop over fetch-recent-chat and mark-as-seen of random chats.
+
+Delivery latency is send to receipt at every other socket of the conversation, taken
+from the send time each message carries in its content. The JSON result holds messages
+per second, p50/p99/max delivery and HTTP latency, HTTP status counts and CPU and peak
+memory of every server process and of this client. Needs the DATABASE_CONNECTION_URL and
+REDIS_CONNECTION_URL of .env (local Redis and Mongo); seeded documents and keys are
+removed again. One client process tops out around a few thousand sockets, run more
+copies against --url for more.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+import httpx
+import psutil
+import websockets
+from bson import ObjectId
+from datetime import datetime
+from core.database import db
+from core.redis import redis, messages_key, event_stream_key, unseen_flag_key
+from helpers.utils.message_archive import CONVERSATION_ACTIVITY_KEY
+from core.settings import settings
+from benchmarks.worker_scaling_benchmark import auth_token, seed_groups, remove_groups, wait_until_up
+
+def percentiles(samples: list) -> dict:
+  if not samples:
+    return {"count": 0}
+  samples = sorted(samples)
+  pick = lambda fraction: round(samples[min(len(samples) - 1, int(len(samples) * fraction))] * 1000, 2)
+  return {"count": len(samples), "p50_ms": pick(0.5), "p99_ms": pick(0.99), "max_ms": round(samples[-1] * 1000, 2)}
+
+def message_events(frame) -> tuple:
+  # (message events, backpressure refusals) in one frame, coalesced or not
+  events = json.loads(frame)
+  messages, refused = [], 0
+  for event in events if isinstance(events, list) else [events]:
+    if event.get("action") == "batch":
+      messages.extend(event["messages"])
+    elif event.get("action") == "backpressure":
+      refused += 1
+    elif "message_sequence" in event:
+      messages.append(event)
+  return messages, refused
+
+async def seed_chats(chats: int) -> list:
+  seeded = []
+  for _ in range(chats):
+    participants = [ObjectId(), ObjectId()]
+    result = await db.chats.insert_one({"participants": participants, "created_at": datetime.now()})
+    seeded.append((result.inserted_id, participants))
+  return seeded
+
+async def remove_chats(seeded: list):
+  for chat_id, _ in seeded:
+    await db.chats.delete_one({"_id": chat_id})
+    await db.messages.delete_many({"chat_id": str(chat_id)})
+    await redis.delete(messages_key(chat_id), event_stream_key(chat_id), unseen_flag_key(chat_id))
+    await redis.zrem(CONVERSATION_ACTIVITY_KEY, f"chat:{chat_id}")
+
+def chat_frame(index: int) -> str:
+  return json.dumps({
+    "id": f"load-{os.urandom(6).hex()}",
+    "reply_to_id": None,
+    "reply_to_content": None,
+    "content": f"{time.perf_counter():.6f}",
+    "action": "message",
+    "created_at": datetime.now().isoformat()
+  })
+
+def group_frame(index: int) -> str:
+  return json.dumps({"reply_to_id": None, "content": f"{time.perf_counter():.6f}"})
+
+async def run_socket(url: str, user_id: ObjectId, make_frame, messages: int, rate: float, expected: int, state: dict):
+  async with websockets.connect(url, max_size=None, open_timeout=60) as websocket:
+    async def send(count: int, paced: bool):
+      for index in range(count):
+        await websocket.send(make_frame(index))
+        if paced:
+          await asyncio.sleep(1 / rate)
+
+    state["connected"] += 1
+    await state["start"].wait()
+    # Spread the senders over the first interval so they don't send in lockstep
+    await asyncio.sleep(random.random() / rate)
+    sender = asyncio.create_task(send(messages, True))
+
+    received = 0
+    while received < expected:
+      events, refused = message_events(await websocket.recv())
+      now = time.perf_counter()
+      received += len(events)
+      state["delivered"] += len(events)
+      for event in events:
+        if event["sender_id"] != str(user_id):
+          state["latencies"].append(now - float(event["content"]))
+      if refused:
+        state["refused"] += refused
+        await asyncio.sleep(settings.INGEST_BACKPRESSURE_RETRY_MS / 1000)
+        await send(refused, False)
+    await sender
+
+async def run_http_client(base_url: str, seeded_chats: list, state: dict, stop: asyncio.Event):
+  async with httpx.AsyncClient(base_url=base_url, timeout=30) as client:
+    await state["start"].wait()
+    while not stop.is_set():
+      chat_id, participants = random.choice(seeded_chats)
+      headers = {"Authorization": f"Bearer {auth_token(random.choice(participants))}"}
+      for endpoint, request in (
+        ("fetch-recent-chat", lambda: client.get(f"/api/chat/fetch-recent-chat/{chat_id}", headers=headers)),
+        ("mark-as-seen", lambda: client.post(f"/api/chat/mark-as-seen/{chat_id}/{datetime.now().isoformat()}", headers=headers))
+      ):
+        started = time.perf_counter()
+        response = await request()
+        state["http"][endpoint]["latencies"].append(time.perf_counter() - started)
+        statuses = state["http"][endpoint]["statuses"]
+        statuses[str(response.status_code)] = statuses.get(str(response.status_code), 0) + 1
+
+class ProcessSampler:
+  """
+  CPU time and peak resident memory of the server processes and of this client,
+  sampled while the load runs.
+  """
+
+  def __init__(self, server_pid):
+    self.processes = {"client": psutil.Process()}
+    if server_pid:
+      server = psutil.Process(server_pid)
+      self.processes["server"] = server
+      # uvicorn runs the workers as children of the process main.py started
+      for child in server.children(recursive=True):
+        self.processes[f"worker-{child.pid}"] = child
+    self.cpu_started = {name: sum(process.cpu_times()[:2]) for name, process in self.processes.items()}
+    self.peak_rss = {name: 0 for name in self.processes}
+
+  async def run(self, stop: asyncio.Event):
+    while not stop.is_set():
+      for name, process in self.processes.items():
+        self.peak_rss[name] = max(self.peak_rss[name], process.memory_info().rss)
+      await asyncio.sleep(0.5)
+
+  def result(self, elapsed: float) -> dict:
+    result = {}
+    for name, process in self.processes.items():
+      cpu_seconds = sum(process.cpu_times()[:2]) - self.cpu_started[name]
+      result[name] = {
+        "pid": process.pid,
+        "cpu_seconds": round(cpu_seconds, 2),
+        "cpu_percent": round(cpu_seconds / elapsed * 100, 1),
+        "peak_rss_mb": round(self.peak_rss[name] / 2 ** 20, 1)
+      }
+    return result
+
+async def measure(base_url: str, server_pid, seeded_chats: list, seeded_groups: list, args) -> dict:
+  ws_url = base_url.replace("http", "ws", 1)
+  state = {
+    "connected": 0,
+    "delivered": 0,
+    "refused": 0,
+    "latencies": [],
+    "start": asyncio.Event(),
+    "http": {endpoint: {"latencies": [], "statuses": {}} for endpoint in ("fetch-recent-chat", "mark-as-seen")}
+  }
+
+  sockets = []
+  for path, seeded, make_frame in (
+    ("/api/chat/continue-chat", seeded_chats, chat_frame),
+    ("/api/group/continue-group-chat", seeded_groups, group_frame)
+  ):
+    for conversation_id, participants in seeded:
+      expected = len(participants) * args.messages
+      for user_id in participants:
+        url = f"{ws_url}{path}/{conversation_id}?authToken={auth_token(user_id)}&coalesce=1"
+        sockets.append(asyncio.create_task(run_socket(url, user_id, make_frame, args.messages, args.rate, expected, state)))
+
+  while state["connected"] < len(sockets):
+    failed = [socket for socket in sockets if socket.done() and socket.exception()]
+    if failed:
+      raise failed[0].exception()
+    await asyncio.sleep(0.1)
+
+  stop = asyncio.Event()
+  sampler = ProcessSampler(server_pid)
+  background = [asyncio.create_task(sampler.run(stop))]
+  if seeded_chats:
+    background += [asyncio.create_task(run_http_client(base_url, seeded_chats, state, stop)) for _ in range(args.http_clients)]
+
+  started = time.perf_counter()
+  state["start"].set()
+  await asyncio.wait_for(asyncio.gather(*sockets), args.timeout)
+  elapsed = time.perf_counter() - started
+  stop.set()
+  await asyncio.gather(*background)
+
+  sent = sum(len(participants) for _, participants in seeded_chats + seeded_groups) * args.messages
+  return {
+    "sockets": len(sockets),
+    "messages_sent": sent,
+    "deliveries": state["delivered"],
+    "refused_frames": state["refused"],
+    "seconds": round(elapsed, 2),
+    "messages_per_sec": round(sent / elapsed),
+    "deliveries_per_sec": round(state["delivered"] / elapsed),
+    "delivery_latency": percentiles(state["latencies"]),
+    "http": {
+      endpoint: {**percentiles(result["latencies"]), "statuses": result["statuses"]}
+      for endpoint, result in state["http"].items()
+    },
+    "processes": sampler.result(elapsed)
+  }
+
+async def main(args):
+  seeded_chats = await seed_chats(args.chats)
+  seeded_groups = await seed_groups(args.groups, args.group_size)
+  server = None
+  try:
+    if args.url:
+      base_url = args.url.rstrip("/")
+    else:
+      base_url = f"http://127.0.0.1:{args.port}"
+      server = subprocess.Popen([sys.executable, "main.py", "--port", str(args.port), "--workers", str(args.workers)])
+      await wait_until_up(args.port)
+      # Give the workers their own startup before counting CPU
+      await asyncio.sleep(1)
+
+    result = await measure(base_url, server.pid if server else None, seeded_chats, seeded_groups, args)
+    result["config"] = {key: value for key, value in vars(args).items() if key != "output"}
+  finally:
+    if server:
+      server.terminate()
+      server.wait()
+    await remove_chats(seeded_chats)
+    await remove_groups(seeded_groups)
+
+  print(json.dumps(result, indent=2))
+  if args.output:
+    with open(args.output, "w") as output:
+      json.dump(result, output, indent=2)
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--url", help="base url of a running server, main.py is not started")
+  parser.add_argument("--port", type=int, default=8100)
+  parser.add_argument("--workers", type=int, default=1)
+  parser.add_argument("--chats", type=int, default=500)
+  parser.add_argument("--groups", type=int, default=50)
+  parser.add_argument("--group-size", type=int, default=10)
+  parser.add_argument("--messages", type=int, default=20, help="messages per socket")
+  parser.add_argument("--rate", type=float, default=2, help="messages per second per socket")
+  parser.add_argument("--http-clients", type=int, default=20)
+  parser.add_argument("--timeout", type=float, default=300, help="seconds before an unfinished run fails")
+  parser.add_argument("--output", help="also write the JSON result to this file")
+  asyncio.run(main(parser.parse_args()))
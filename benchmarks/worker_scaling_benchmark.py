@@ -0,0 +1,139 @@
+"""
+Group messages per second through the whole server, by number of worker processes.
+
+  python -m benchmarks.worker_scaling_benchmark --workers 1,2,4 --groups 8 --senders 4 --messages 500
+
+For every worker count main.py is started on --port, --groups groups with --senders
+sockets each are opened against it and every sender writes --messages messages as fast
+as the server accepts them (refused frames are resent). Throughput counts a message once
+every socket of its group has received it. Needs the DATABASE_CONNECTION_URL and
+REDIS_CONNECTION_URL of .env; the seeded groups and their redis keys are removed again.
+"""
+import argparse
+import asyncio
+import json
+import subprocess
+import sys
+import time
+import jwt
+import httpx
+import websockets
+from bson import ObjectId
+from datetime import datetime, timedelta
+from core.database import db
+from core.redis import redis, messages_key, event_stream_key
+from core.settings import settings
+from helpers.utils.message_archive import CONVERSATION_ACTIVITY_KEY
+
+def auth_token(user_id: ObjectId) -> str:
+  payload = {"user_id": str(user_id), "exp": datetime.utcnow() + timedelta(hours=1)}
+  return jwt.encode(payload, settings.JWT_SECRET_KEY, algorithm=settings.JWT_ALGORITHM)
+
+def count_messages(frame) -> tuple:
+  # (delivered messages, backpressure refusals) in one frame, coalesced or not
+  events = json.loads(frame)
+  delivered = refused = 0
+  for event in events if isinstance(events, list) else [events]:
+    if event.get("action") == "batch":
+      delivered += len(event["messages"])
+    elif event.get("action") == "backpressure":
+      refused += 1
+    elif "message_sequence" in event:
+      delivered += 1
+  return delivered, refused
+
+async def seed_groups(groups: int, senders: int) -> list:
+  seeded = []
+  for _ in range(groups):
+    participants = [ObjectId() for _ in range(senders)]
+    result = await db.groups.insert_one({
+      "group_name": "scaling benchmark",
+      "participants": participants,
+      "group_admin": participants[0]
+    })
+    seeded.append((result.inserted_id, participants))
+  return seeded
+
+async def remove_groups(seeded: list):
+  for group_id, _ in seeded:
+    await db.groups.delete_one({"_id": group_id})
+    await db.messages.delete_many({"group_id": str(group_id)})
+    await redis.delete(messages_key(group_id, True), event_stream_key(group_id, True))
+    await redis.zrem(CONVERSATION_ACTIVITY_KEY, f"group:{group_id}")
+
+async def wait_until_up(port: int):
+  async with httpx.AsyncClient() as client:
+    for _ in range(300):
+      try:
+        await client.get(f"http://127.0.0.1:{port}/")
+        return
+      except httpx.TransportError:
+        await asyncio.sleep(0.1)
+  raise RuntimeError("server did not come up")
+
+async def run_socket(url: str, messages: int, expected: int, state: dict):
+  async with websockets.connect(url, max_size=None) as websocket:
+    async def send(count: int):
+      for index in range(count):
+        await websocket.send(json.dumps({"reply_to_id": None, "content": f"benchmark message {index}"}))
+
+    state["connected"] += 1
+    await state["start"].wait()
+    sender = asyncio.create_task(send(messages))
+
+    received = 0
+    while received < expected:
+      delivered, refused = count_messages(await websocket.recv())
+      received += delivered
+      if refused:
+        await asyncio.sleep(settings.INGEST_BACKPRESSURE_RETRY_MS / 1000)
+        await send(refused)
+    await sender
+
+async def measure(port: int, seeded: list, messages: int) -> dict:
+  state = {"connected": 0, "start": asyncio.Event()}
+  sockets = []
+  for group_id, participants in seeded:
+    expected = len(participants) * messages
+    for user_id in participants:
+      url = f"ws://127.0.0.1:{port}/api/group/continue-group-chat/{group_id}?authToken={auth_token(user_id)}&coalesce=1"
+      sockets.append(asyncio.create_task(run_socket(url, messages, expected, state)))
+
+  while state["connected"] < len(sockets):
+    await asyncio.sleep(0.05)
+
+  started = time.perf_counter()
+  state["start"].set()
+  await asyncio.gather(*sockets)
+  elapsed = time.perf_counter() - started
+
+  total = sum(len(participants) for _, participants in seeded) * messages
+  return {"messages": total, "seconds": round(elapsed, 2), "messages_per_sec": round(total / elapsed)}
+
+async def main(worker_counts: list, port: int, groups: int, senders: int, messages: int):
+  results = {}
+  for workers in worker_counts:
+    seeded = await seed_groups(groups, senders)
+    server = subprocess.Popen([sys.executable, "main.py", "--port", str(port), "--workers", str(workers)])
+    try:
+      await wait_until_up(port)
+      results[workers] = await measure(port, seeded, messages)
+    finally:
+      server.terminate()
+      server.wait()
+      await remove_groups(seeded)
+
+  baseline = results[worker_counts[0]]["messages_per_sec"]
+  for workers, result in results.items():
+    result["speedup"] = round(result["messages_per_sec"] / baseline, 2)
+  print(json.dumps(results, indent=2))
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--workers", default="1,2,4")
+  parser.add_argument("--port", type=int, default=8100)
+  parser.add_argument("--groups", type=int, default=8)
+  parser.add_argument("--senders", type=int, default=4)
+  parser.add_argument("--messages", type=int, default=500)
+  args = parser.parse_args()
+  asyncio.run(main([int(workers) for workers in args.workers.split(",")], args.port, args.groups, args.senders, args.messages))
@@ -1,11 +1,102 @@
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import monitoring
+from pymongo.read_preferences import make_read_preference, read_pref_mode_from_name
 from .settings import settings
 
+DATABASE_NAME = "talk-app-db"
+
+class PoolStatsListener(monitoring.ConnectionPoolListener):
+  """
+  Counts what the mongo connection pools do, so pool queueing and checkout timeouts can
+  be told apart from slow queries.
+  """
+
+  def __init__(self):
+    self.open = 0
+    self.in_use = 0
+    self.waiting = 0  # Operations queued for a connection right now
+    self.checkouts = 0
+    self.checkout_failures = {}  # {reason: count}, "timeout" means the wait queue timed out
+    self.max_checkout_ms = 0.0
+
+  def stats(self) -> dict:
+    return {
+      "open": self.open,
+      "in_use": self.in_use,
+      "waiting": self.waiting,
+      "max": settings.MONGO_MAX_POOL_SIZE,
+      "checkouts": self.checkouts,
+      "checkout_failures": dict(self.checkout_failures),
+      "max_checkout_ms": round(self.max_checkout_ms, 2)
+    }
+
+  def connection_check_out_started(self, event):
+    self.waiting += 1
+
+  def connection_checked_out(self, event):
+    self.waiting -= 1
+    self.in_use += 1
+    self.checkouts += 1
+    self.max_checkout_ms = max(self.max_checkout_ms, event.duration * 1000)
+
+  def connection_check_out_failed(self, event):
+    self.waiting -= 1
+    self.checkout_failures[event.reason] = self.checkout_failures.get(event.reason, 0) + 1
+
+  def connection_checked_in(self, event):
+    self.in_use -= 1
+
+  def connection_created(self, event):
+    self.open += 1
+
+  def connection_closed(self, event):
+    self.open -= 1
+
+  def connection_ready(self, event):
+    pass
+
+  def pool_created(self, event):
+    pass
+
+  def pool_ready(self, event):
+    pass
+
+  def pool_cleared(self, event):
+    pass
+
+  def pool_closed(self, event):
+    pass
+
+mongo_pool_stats = PoolStatsListener()
+
+def create_mongo_client() -> AsyncIOMotorClient:
+  """
+  MongoDB client with pool sizes, timeouts and wire compression from Settings.
+  Compressors whose python package (zstandard, python-snappy) is missing are skipped.
+  """
+  return AsyncIOMotorClient(
+    settings.DATABASE_CONNECTION_URL,
+    maxPoolSize=settings.MONGO_MAX_POOL_SIZE,
+    minPoolSize=settings.MONGO_MIN_POOL_SIZE,
+    waitQueueTimeoutMS=settings.MONGO_WAIT_QUEUE_TIMEOUT_MS,
+    serverSelectionTimeoutMS=settings.MONGO_SERVER_SELECTION_TIMEOUT_MS,
+    connectTimeoutMS=settings.MONGO_CONNECT_TIMEOUT_MS,
+    socketTimeoutMS=settings.MONGO_SOCKET_TIMEOUT_MS,
+    compressors=settings.MONGO_COMPRESSORS,
+    event_listeners=[mongo_pool_stats]
+  )
+
+def read_preference(name: str):
+  return make_read_preference(read_pref_mode_from_name(name), None)
+
 # Create the MongoDB client
-client = AsyncIOMotorClient(settings.DATABASE_CONNECTION_URL)
+client = create_mongo_client()
 
 # Get the database
-db = client["talk-app-db"]
+db = client.get_database(DATABASE_NAME, read_preference=read_preference(settings.MONGO_READ_PREFERENCE))
+
+# Same database for reading archived message buckets, which can tolerate replica lag
+archive_db = client.get_database(DATABASE_NAME, read_preference=read_preference(settings.MONGO_ARCHIVE_READ_PREFERENCE))
 
 def get_db():
   return db
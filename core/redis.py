@@ -1,4 +1,91 @@
-import redis.asyncio as redis
+import redis.asyncio as redis_asyncio
+from redis.asyncio import BlockingConnectionPool
+from redis.asyncio.cluster import RedisCluster
 from core.settings import settings
+from typing import List, Tuple
 
-redis = redis.from_url(settings.REDIS_CONNECTION_URL)
+def create_redis_client():
+  """
+  Redis client sized and timed out by Settings. On a single instance callers wait up to
+  REDIS_POOL_TIMEOUT for a free connection once REDIS_MAX_CONNECTIONS are in use, instead
+  of opening connections without bound.
+  """
+  options = {
+    "socket_timeout": settings.REDIS_SOCKET_TIMEOUT,
+    "socket_connect_timeout": settings.REDIS_SOCKET_CONNECT_TIMEOUT,
+    "health_check_interval": settings.REDIS_HEALTH_CHECK_INTERVAL
+  }
+  if settings.REDIS_CLUSTER:
+    # max_connections applies per cluster node
+    return RedisCluster.from_url(settings.REDIS_CONNECTION_URL, max_connections=settings.REDIS_MAX_CONNECTIONS, **options)
+
+  pool = BlockingConnectionPool.from_url(
+    settings.REDIS_CONNECTION_URL,
+    max_connections=settings.REDIS_MAX_CONNECTIONS,
+    timeout=settings.REDIS_POOL_TIMEOUT,
+    **options
+  )
+  return redis_asyncio.Redis(connection_pool=pool)
+
+redis = create_redis_client()
+
+def cluster_node_stats(node) -> dict:
+  connections, free = getattr(node, "_connections", None), getattr(node, "_free", None)
+  if connections is None or free is None:
+    return {"open": None, "in_use": None, "max": node.max_connections}
+  return {"open": len(connections), "in_use": len(connections) - len(free), "max": node.max_connections}
+
+def redis_pool_stats() -> dict:
+  if settings.REDIS_CLUSTER:
+    # The cluster client keeps one pool per node. redis-py has no public counters for
+    # them, so they are read from its internals and left out if a release renames those
+    return {node.name: cluster_node_stats(node) for node in redis.get_nodes()}
+
+  pool = redis.connection_pool
+  (idle, _), (in_use, _) = pool.get_connection_count()
+  return {"open": idle + in_use, "in_use": in_use, "max": pool.max_connections}
+
+# Key layout. The conversation id is the hash tag of every key of a conversation, so
+# its messages, events and flags land on one cluster slot and can share a MULTI,
+# WATCH or multi-key command.
+
+def conversation_prefix(chat_or_group_id, is_group: bool = False) -> str:
+  return f"{'group' if is_group else 'chat'}:{{{chat_or_group_id}}}"
+
+def messages_key(chat_or_group_id, is_group: bool = False) -> str:
+  return f"{conversation_prefix(chat_or_group_id, is_group)}:messages"
+
+def event_stream_key(chat_or_group_id, is_group: bool = False) -> str:
+  return f"{conversation_prefix(chat_or_group_id, is_group)}:events"
+
+def unseen_flag_key(chat_or_group_id, is_group: bool = False) -> str:
+  return f"{conversation_prefix(chat_or_group_id, is_group)}:unseen_in_mongo"
+
+def call_session_key(chat_id) -> str:
+  return f"{conversation_prefix(chat_id)}:call"
+
+def inbox_fanout_flag_key(group_id) -> str:
+  # Set while a group's last activity was recently copied to its members' inbox indexes
+  return f"{conversation_prefix(group_id, True)}:inbox_fanout"
+
+def inbox_index_key(user_id) -> str:
+  # Per-user keys are tagged with the user id, like the conversation keys with theirs
+  return f"inbox:{{{user_id}}}:conversations"
+
+def unread_counts_key(user_id) -> str:
+  return f"inbox:{{{user_id}}}:unread"
+
+def call_channel(user_id) -> str:
+  # Call signaling is addressed to a user, every node with a call socket of theirs listens
+  return f"call:{{{user_id}}}"
+
+def parse_conversation_key(key: str) -> Tuple[str, str]:
+  # "chat:{id}:messages" -> ("chat", "id")
+  kind, tagged_id = key.split(":")[:2]
+  return kind, tagged_id.strip("{}")
+
+async def mget(keys: List[str]) -> list:
+  # MGET only takes keys of one slot on a cluster, mget_nonatomic splits it up per slot
+  if settings.REDIS_CLUSTER:
+    return await redis.mget_nonatomic(keys)
+  return await redis.mget(keys)
@@ -3,12 +3,71 @@ from pydantic_settings import BaseSettings
 class Settings(BaseSettings):
   DATABASE_CONNECTION_URL: str
   REDIS_CONNECTION_URL: str
+  REDIS_CLUSTER: bool = False # REDIS_CONNECTION_URL points at a redis cluster node instead of a single instance
+  REDIS_MAX_CONNECTIONS: int = 100 # redis connections per process (per node on a cluster)
+  REDIS_POOL_TIMEOUT: float = 5 # seconds to wait for a free redis connection before failing
+  REDIS_SOCKET_TIMEOUT: float = 5 # seconds a redis reply may take, keep above the event stream XREAD block
+  REDIS_SOCKET_CONNECT_TIMEOUT: float = 2 # seconds to open a redis connection
+  REDIS_HEALTH_CHECK_INTERVAL: int = 30 # seconds idle before a pooled redis connection is pinged on checkout
+  MONGO_MAX_POOL_SIZE: int = 100 # mongo connections per process and server
+  MONGO_MIN_POOL_SIZE: int = 0 # mongo connections kept open while idle
+  MONGO_WAIT_QUEUE_TIMEOUT_MS: int = 2000 # how long an operation waits for a free mongo connection
+  MONGO_SERVER_SELECTION_TIMEOUT_MS: int = 5000 # how long to look for a suitable mongo server
+  MONGO_CONNECT_TIMEOUT_MS: int = 5000 # milliseconds to open a mongo connection
+  MONGO_SOCKET_TIMEOUT_MS: int = 20000 # milliseconds a mongo reply may take before the operation fails
+  MONGO_COMPRESSORS: str = "zstd,snappy,zlib" # wire compressors offered to mongo in order of preference
+  MONGO_READ_PREFERENCE: str = "primary" # read preference of the hot path
+  MONGO_ARCHIVE_READ_PREFERENCE: str = "secondaryPreferred" # read preference for archived message buckets
   JWT_SECRET_KEY: str
   JWT_ALGORITHM: str
   JWT_TOKEN_LIFETIME: int
   CLOUDINARY_CLOUD_NAME: str
   CLOUDINARY_API_KEY: int
   CLOUDINARY_API_SECRET: str
+  PROFILE_SUMMARY_CACHE_TTL: int = 3600 # seconds a cached username/profile_image summary lives in redis
+  REDIS_MESSAGE_ENCODING: str = "json" # "json", "tuple" or "msgpack" for the redis messages lists
+  CONVERSATION_EVENT_STREAM_MAXLEN: int = 1000 # events kept per conversation for reconnecting clients to replay
+  RESUME_TOKEN_LIFETIME: int = 300 # seconds a socket's resume token lets a reconnect skip the token check and membership lookup
+  RECONNECT_DELAY_MAX_MS: int = 10000 # upper bound of the random delay each socket is told to wait before reconnecting after an unannounced disconnect
+  FULL_CONNECTS_PER_SECOND: int = 200 # sockets per second and worker let in without a resume token, the rest are asked to retry later
+  CALL_RING_TIMEOUT: int = 60 # seconds an unanswered call session lives in redis
+  CALL_SESSION_TTL: int = 90 # seconds an answered call session lives without a refresh, the answering socket refreshes it every third of that
+  INGEST_BATCH_MAX_SIZE: int = 100 # most frames of one conversation committed together
+  INGEST_BATCH_MAX_DELAY_MS: int = 2 # how long a batch waits for more frames once it has one
+  INGEST_QUEUE_MAX_SIZE: int = 256 # frames a socket may have waiting for persistence before it gets backpressure frames
+  INGEST_BACKPRESSURE_RETRY_MS: int = 250 # retry delay suggested to clients in backpressure frames
+  OUTBOUND_COALESCE_WINDOW_MS: int = 0 # extra wait before writing a socket's queued events, 0 only coalesces what queued up meanwhile
+  OUTBOUND_DEFLATE_MIN_BYTES: int = 512 # frames smaller than this stay uncompressed text for encoding=deflate sockets
+  OUTBOUND_MAX_QUEUED_EVENTS: int = 1000 # events a socket may have waiting to be written before it is closed to reconnect and replay
+  WEBSOCKET_PER_MESSAGE_DEFLATE: bool = True # let uvicorn negotiate the permessage-deflate extension
+  BACKGROUND_JOB_LOCK_TIMEOUT: int = 900 # seconds one pass of a background job may hold its cross-worker lock
+  TASK_RESTART_BACKOFF_MAX: int = 30 # longest wait before a crashed background task is restarted
+  LIVENESS_FAILING_GRACE: int = 300 # seconds a critical background task may keep crashing before /health/live fails
+  READINESS_MAX_LOOP_LAG_MS: int = 500 # /health/ready fails while recent event loop lag is above this
+  SHUTDOWN_DRAIN_TIMEOUT: int = 25 # seconds a stopping worker has for its sockets, pending writes and the current job pass, keep below the orchestrator's kill timeout
+  SHUTDOWN_RECONNECT_MIN_MS: int = 1000 # reconnect delays handed to sockets sent elsewhere (shutdown, connect overload) are spread between these two
+  SHUTDOWN_RECONNECT_MAX_MS: int = 15000
+  WEB_CONCURRENCY: int = 1 # worker processes started by main.py
+  METRICS_SNAPSHOT_INTERVAL: int = 10 # seconds between the metrics snapshots a worker leaves in redis for /metrics
+  DELIVERY_TRACE_SLOW_MS: int = 250 # deliveries slower than this, end to end, may be logged with their per-hop breakdown
+  DELIVERY_TRACE_LOG_SAMPLE_RATE: float = 0.01 # share of slow deliveries that get logged
+  PROFILING_ENABLED: bool = False # time every HTTP request by route and allow the /debug/profile sampling profiler
+  SLOW_REQUEST_MS: int = 500 # HTTP requests slower than this are logged with their CPU/waiting split when profiling
+  PROFILER_MAX_SECONDS: int = 60 # longest run of the sampling profiler
+  EVENT_LOOP_LAG_CHECK_MS: int = 50 # how often the event loop watchdog ticks
+  EVENT_LOOP_LAG_THRESHOLD_MS: int = 200 # event loop stalls longer than this are logged with the blocking stack, 0 turns the watchdog off
+  ADMIN_USER_IDS: str = "" # comma separated user ids allowed to use the /debug endpoints
+  IDLE_CONVERSATION_ARCHIVE_AGE: int = 30 # days without a message before a conversation is moved out of redis
+  IDLE_CONVERSATION_ARCHIVE_INTERVAL: int = 3600 # seconds between idle conversation archive passes
+  INBOX_PAGE_SIZE: int = 30 # inbox entries per page when the client doesn't ask for a size
+  INBOX_MAX_PAGE_SIZE: int = 100 # largest inbox page a client can ask for
+  INBOX_INDEX_TTL: int = 604800 # seconds a user's redis inbox index and unread counters live without a read, they are rebuilt from mongo after that
+  INBOX_GROUP_ACTIVITY_RESOLUTION: int = 5 # seconds between copies of a busy group's last activity to its members' inboxes
+  GROUP_MEMBERS_CACHE_TTL: int = 30 # seconds a worker reuses a group's member list when counting unread messages
+  UNREAD_RECONCILE_INTERVAL: int = 60 # seconds between copies of changed unread counters to mongo
+  CLEANUP_JOB_POLL_INTERVAL: float = 1 # seconds a worker waits before looking for due cleanup jobs again
+  CLEANUP_JOB_LEASE: int = 300 # seconds a claimed cleanup job stays hidden before it is retried
+  USERNAME_SEARCH_BACKEND: str = "atlas" # "atlas" uses the $search index, "local" the in-process username index
 
   class Config:
     env_file = ".env"
@@ -0,0 +1,50 @@
+from core.settings import settings
+from helpers.utils.metrics import Histogram
+from helpers.utils.profiling import event_loop_watchdog
+import time
+
+request_duration = Histogram("talk_http_request_seconds", "Wall time of an HTTP request by route (profiling middleware)")
+request_cpu = Histogram("talk_http_request_cpu_seconds", "CPU time of the event loop thread while an HTTP request ran, by route (profiling middleware)")
+
+class ProfilingMiddleware:
+  """
+  Records wall and CPU time of every HTTP request by route template, and logs requests
+  slower than SLOW_REQUEST_MS with the split between CPU and waiting. CPU time is the
+  loop thread's, so requests running at the same time share each other's; a request
+  that is mostly CPU while it sat through an event loop stall blocked everyone else.
+  """
+
+  def __init__(self, app):
+    self.app = app
+
+  async def __call__(self, scope, receive, send):
+    if scope["type"] != "http":
+      await self.app(scope, receive, send)
+      return
+
+    status = {"code": 500}
+
+    async def send_with_status(message):
+      if message["type"] == "http.response.start":
+        status["code"] = message["status"]
+      await send(message)
+
+    started = time.perf_counter()
+    cpu_started = time.thread_time()
+    stalls_before = event_loop_watchdog.stalls
+    try:
+      await self.app(scope, receive, send_with_status)
+    finally:
+      wall = time.perf_counter() - started
+      cpu = time.thread_time() - cpu_started
+      # The router puts the matched route in the scope, its template keeps the label set small
+      route = getattr(scope.get("route"), "path", "unmatched")
+      request_duration.observe(wall, route=route, method=scope["method"])
+      request_cpu.observe(cpu, route=route, method=scope["method"])
+
+      if wall * 1000 >= settings.SLOW_REQUEST_MS:
+        print(
+          f"Slow request: {scope['method']} {route} -> {status['code']} took {wall * 1000:.1f}ms "
+          f"(cpu {cpu * 1000:.1f}ms, waiting {max(0, wall - cpu) * 1000:.1f}ms, "
+          f"event loop stalls {event_loop_watchdog.stalls - stalls_before})"
+        )
@@ -0,0 +1,82 @@
+from core.redis import redis, call_channel, call_session_key
+from core.settings import settings
+from fastapi import WebSocket
+from typing import Dict, Optional
+import time
+
+CALL_TYPES = ("audio", "video")
+
+class CallConnections:
+  """
+  Call sockets of this worker by user. Signaling is addressed to the peer, it never goes
+  through the conversation fan-out, the outbox or the event streams.
+  """
+
+  def __init__(self):
+    self.sockets: Dict[str, Dict[str, WebSocket]] = {}  # {user_id: {websocket_id: websocket}}
+
+  def add(self, user_id: str, websocket_id: str, websocket: WebSocket):
+    self.sockets.setdefault(user_id, {})[websocket_id] = websocket
+
+  def remove(self, user_id: str, websocket_id: str):
+    user_sockets = self.sockets.get(user_id, {})
+    user_sockets.pop(websocket_id, None)
+    if not user_sockets:
+      self.sockets.pop(user_id, None)
+
+  async def deliver(self, user_id: str, text: str):
+    # Every device of the user that has a call socket here rings
+    for websocket in list(self.sockets.get(user_id, {}).values()):
+      try:
+        await websocket.send_text(text)
+      except Exception:
+        pass  # Its receive loop notices the disconnect and removes it
+
+call_connections = CallConnections()
+
+async def publish_signal(user_id, payload: bytes):
+  # Fire-and-forget, a signal is worthless once missed. A cluster only delivers sharded
+  # messages within the slot's shard, not on every node
+  if settings.REDIS_CLUSTER:
+    await redis.spublish(call_channel(user_id), payload)
+  else:
+    await redis.publish(call_channel(user_id), payload)
+
+# Call sessions live in redis only and expire on their own: a ringing call after
+# CALL_RING_TIMEOUT, an answered one CALL_SESSION_TTL after the answering socket stopped
+# refreshing it. The socket of each side that took part is recorded, so another device
+# of the same user going away doesn't end the call.
+
+async def get_call_session(chat_id) -> Optional[Dict[str, str]]:
+  session = await redis.hgetall(call_session_key(chat_id))
+  return {field.decode('utf-8'): value.decode('utf-8') for field, value in session.items()} or None
+
+async def ring(chat_id, caller_id, callee_id, call_type: str, websocket_id: str):
+  # An offer during a call is a renegotiation, the existing session is kept as is. Its
+  # TTL drops to CALL_RING_TIMEOUT until the next keep_call_alive, which comes sooner
+  key = call_session_key(chat_id)
+  async with redis.pipeline(transaction=True) as pipe:
+    pipe.hsetnx(key, "state", "ringing")
+    pipe.hsetnx(key, "caller", str(caller_id))
+    pipe.hsetnx(key, "callee", str(callee_id))
+    pipe.hsetnx(key, "call_type", call_type)
+    pipe.hsetnx(key, "caller_socket", websocket_id)
+    pipe.hsetnx(key, "started_at", str(time.time()))
+    pipe.expire(key, settings.CALL_RING_TIMEOUT)
+    await pipe.execute()
+
+async def answer(chat_id, websocket_id: str):
+  key = call_session_key(chat_id)
+  async with redis.pipeline(transaction=True) as pipe:
+    pipe.hset(key, mapping={"state": "active", "callee_socket": websocket_id, "answered_at": str(time.time())})
+    pipe.expire(key, settings.CALL_SESSION_TTL)
+    await pipe.execute()
+
+async def keep_call_alive(chat_id):
+  await redis.expire(call_session_key(chat_id), settings.CALL_SESSION_TTL)
+
+async def end_call(chat_id):
+  await redis.delete(call_session_key(chat_id))
+
+def takes_part(session: Optional[Dict[str, str]], websocket_id: str) -> bool:
+  return bool(session) and websocket_id in (session.get("caller_socket"), session.get("callee_socket"))
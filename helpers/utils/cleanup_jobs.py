@@ -0,0 +1,38 @@
+from core.redis import redis
+from core.settings import settings
+from typing import Optional
+from uuid import uuid4
+from .json_codec import dumpb, loads
+import time
+
+# Sorted set of pending cleanup jobs scored by when they are due. A claimed job is
+# re-scored CLEANUP_JOB_LEASE ahead instead of removed, so a job whose worker died or
+# failed comes due again and is retried. Jobs are idempotent.
+CLEANUP_JOBS_KEY = "jobs:cleanup"
+
+# Take the first due job and push it out by the lease
+claim_due_job = redis.register_script("""
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, 1)
+if #due == 0 then
+  return false
+end
+redis.call('ZADD', KEYS[1], ARGV[2], due[1])
+return due[1]
+""")
+
+async def enqueue_cleanup(kind: str, **payload):
+  """
+  Hand slow cleanup after a delete (message buckets, redis keys, inbox entries of many
+  members) to the cleanup job worker so the request returns right away.
+  """
+  job = dumpb({"id": str(uuid4()), "kind": kind, **payload})
+  await redis.zadd(CLEANUP_JOBS_KEY, {job: time.time()})
+
+async def claim_cleanup() -> Optional[tuple]:
+  # (raw job, decoded job) or None when nothing is due
+  now = time.time()
+  job = await claim_due_job(keys=[CLEANUP_JOBS_KEY], args=[now, now + settings.CLEANUP_JOB_LEASE])
+  return (job, loads(job)) if job else None
+
+async def complete_cleanup(job: bytes):
+  await redis.zrem(CLEANUP_JOBS_KEY, job)
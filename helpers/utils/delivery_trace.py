@@ -0,0 +1,59 @@
+from core.settings import settings
+from typing import Dict, List, Optional
+from .json_codec import dumpb, loads
+from .metrics import delivery_stage, delivery_latency
+import os
+import random
+import time
+
+# A trace follows one stream event from the sender's socket to every recipient's socket.
+# It travels next to the event in the stream entry, clients never see it. Hops within a
+# worker are timed with the monotonic clock; only the stream hop between workers, which
+# may run on different nodes, compares wall clocks.
+
+def new_trace(received_at: Optional[float] = None) -> Dict:
+  """
+  Trace for an event about to be added to a stream. received_at is the perf_counter()
+  time its oldest frame came off the sender's socket, None for events without one.
+  """
+  ingest = time.perf_counter() - received_at if received_at is not None else 0
+  return {"id": os.urandom(8).hex(), "ingest": ingest, "published_at": time.time()}
+
+def encode_trace(trace: Dict) -> bytes:
+  return dumpb(trace)
+
+def read_trace(fields: Dict, entry_id: str) -> Dict:
+  """
+  Trace of a stream entry the event reader just got, with the stream hop timed.
+  Entries written before tracing existed are timed from the redis clock in their id.
+  """
+  if b"trace" in fields:
+    trace = loads(fields[b"trace"])
+  else:
+    trace = {"id": None, "ingest": 0, "published_at": int(entry_id.split("-")[0]) / 1000}
+
+  # Clock skew between nodes can make the hop look negative
+  trace["stream"] = max(0, time.time() - trace["published_at"])
+  trace["read_at"] = time.perf_counter()
+  delivery_stage.observe(trace["stream"], stage="stream")
+  return trace
+
+def finish_traces(traces: List[Dict], write_started: float, write_finished: float, chat_or_group_id: str, websocket_id: str):
+  """
+  Record the recipient side of every traced event written in one frame, and log a
+  sample of the slow ones with their per-hop breakdown.
+  """
+  write = write_finished - write_started
+  for trace in traces:
+    fanout = write_started - trace["read_at"]
+    total = trace["ingest"] + trace["stream"] + fanout + write
+    delivery_stage.observe(fanout, stage="fanout")
+    delivery_stage.observe(write, stage="socket_write")
+    delivery_latency.observe(total)
+
+    if total * 1000 >= settings.DELIVERY_TRACE_SLOW_MS and random.random() < settings.DELIVERY_TRACE_LOG_SAMPLE_RATE:
+      print(
+        f"Slow delivery: trace {trace['id']} to socket {websocket_id} of {chat_or_group_id} took {total * 1000:.1f}ms "
+        f"(ingest {trace['ingest'] * 1000:.1f}ms, stream {trace['stream'] * 1000:.1f}ms, "
+        f"fanout {fanout * 1000:.1f}ms, socket_write {write * 1000:.1f}ms)"
+      )
@@ -0,0 +1,92 @@
+from core.settings import settings
+from typing import List
+from .websocket_connection_manager import websocket_connection_manager
+from .ingest_queue import ingest_queues
+from .ingest_batcher import ingest_batcher
+import asyncio
+import signal
+import time
+
+# Set once this worker starts stopping. Background job passes check it between
+# conversations, the next pass on another worker starts over from the activity set.
+shutting_down = asyncio.Event()
+
+# Longest wait for open sockets to take their reconnect frame and let go
+SOCKET_DRAIN_SECONDS = 5
+
+async def wait_for_shutdown(seconds: float) -> bool:
+  """
+  Sleep between background job passes. True as soon as shutdown started.
+  """
+  try:
+    await asyncio.wait_for(shutting_down.wait(), seconds)
+    return True
+  except asyncio.TimeoutError:
+    return False
+
+async def drain_sockets(timeout: float):
+  """
+  Refuse new sockets, send the open ones elsewhere with a jittered reconnect delay, and
+  wait for their receive loops to hand what they had queued to the ingest batcher.
+  """
+  if websocket_connection_manager.draining:
+    return
+  shutting_down.set()
+  deadline = time.monotonic() + timeout
+  await websocket_connection_manager.drain(timeout)
+  while ingest_queues and time.monotonic() < deadline:
+    await asyncio.sleep(0.05)
+
+def drain_before_server_exit():
+  """
+  Put the socket drain in front of the server's own SIGTERM/SIGINT handling. uvicorn
+  (0.29+, signal.signal handlers) closes sockets with a bare 1012 before the lifespan
+  shutdown runs, so the reconnect frames have to go out before it gets the signal.
+  A second signal is passed through right away.
+  """
+  loop = asyncio.get_running_loop()
+
+  for signal_number in (signal.SIGTERM, signal.SIGINT):
+    server_handler = signal.getsignal(signal_number)
+    if not callable(server_handler):
+      continue
+
+    def handle(signal_number, frame, server_handler=server_handler):
+      if shutting_down.is_set():
+        server_handler(signal_number, frame)
+        return
+
+      async def drain_then_exit():
+        try:
+          await drain_sockets(SOCKET_DRAIN_SECONDS)
+        finally:
+          server_handler(signal_number, frame)
+      loop.call_soon_threadsafe(lambda: loop.create_task(drain_then_exit()))
+
+    try:
+      signal.signal(signal_number, handle)
+    except ValueError:
+      return  # Not on the main thread (e.g. the test client), the lifespan shutdown still drains
+
+async def shut_down(background_jobs: List[asyncio.Task], running_tasks: List[asyncio.Task]):
+  """
+  Lifespan shutdown of a worker, within SHUTDOWN_DRAIN_TIMEOUT: drain the sockets if the
+  signal handler didn't already, commit what the ingest batcher holds (with its inbox
+  updates), let background jobs finish the conversation they are on, then stop the rest.
+  """
+  deadline = time.monotonic() + settings.SHUTDOWN_DRAIN_TIMEOUT
+  remaining = lambda: max(0, deadline - time.monotonic())
+
+  await drain_sockets(min(SOCKET_DRAIN_SECONDS, remaining()))
+
+  if not await ingest_batcher.wait_idle(remaining()):
+    print(f"Error: shutdown deadline passed with {ingest_batcher.pending} messages not committed")
+
+  if background_jobs:
+    _, unfinished = await asyncio.wait(background_jobs, timeout=remaining())
+    for task in unfinished:
+      print(f"Error: shutdown deadline passed during {task.get_name()}, cancelling it")
+
+  for task in running_tasks:
+    task.cancel()
+  await asyncio.gather(*running_tasks, return_exceptions=True)
@@ -0,0 +1,264 @@
+from bson import ObjectId
+from core.database import db
+from core.redis import redis, messages_key, inbox_index_key, inbox_fanout_flag_key, unread_counts_key
+from core.settings import settings
+from datetime import datetime, timezone
+from pymongo import ASCENDING, DESCENDING, IndexModel, UpdateOne
+from redis.exceptions import NoScriptError
+from typing import Dict, Iterable, List, Optional, Tuple
+from .stored_message_codec import decode_stored_message
+from .unread_counters import count_unread, load_unread_counts, unread_for
+import asyncio
+import time
+
+# One document per (user, conversation) in the inbox collection:
+#   {user_id, conversation_id, kind: "chat" | "group", participant_id (chats),
+#    last_message, last_activity, deleted (a chat the user deleted on their side)}
+# Per-message updates rewrite these small documents instead of the user document.
+INBOX_INDEXES = [
+  IndexModel([("user_id", ASCENDING), ("conversation_id", ASCENDING)], unique=True),
+  # A user's entries by activity, what a missing redis index is rebuilt from
+  IndexModel([("user_id", ASCENDING), ("last_activity", DESCENDING), ("_id", DESCENDING)]),
+  # Updates and deletes that reach every member of a conversation
+  IndexModel([("conversation_id", ASCENDING)])
+]
+
+async def ensure_inbox_indexes():
+  # create_indexes is a no-op for indexes that already exist
+  await db.inbox.create_indexes(INBOX_INDEXES)
+
+def inbox_entry_upsert(user_id: ObjectId, conversation_id: ObjectId, kind: str, participant_id: Optional[ObjectId] = None) -> UpdateOne:
+  # Upserted so adding someone twice, or the migration running after the new code, keeps one entry
+  entry = {"kind": kind, "last_message": None, "last_activity": datetime.utcnow()}
+  if participant_id is not None:
+    entry["participant_id"] = participant_id
+  return UpdateOne(
+    {"user_id": user_id, "conversation_id": conversation_id},
+    {"$setOnInsert": entry},
+    upsert=True
+  )
+
+async def add_chat_to_inboxes(chat_id: ObjectId, user_id: ObjectId, participant_id: ObjectId):
+  await db.inbox.bulk_write([
+    inbox_entry_upsert(user_id, chat_id, "chat", participant_id),
+    inbox_entry_upsert(participant_id, chat_id, "chat", user_id)
+  ], ordered=False)
+  await index_conversation([user_id, participant_id], "chat", chat_id)
+
+async def add_group_to_inboxes(group_id: ObjectId, member_ids: Iterable[ObjectId]):
+  member_ids = list(member_ids)
+  upserts = [inbox_entry_upsert(member_id, group_id, "group") for member_id in member_ids]
+  if upserts:
+    await db.inbox.bulk_write(upserts, ordered=False)
+    await index_conversation(member_ids, "group", group_id)
+
+async def set_last_message(conversation_id: ObjectId, last_message: dict, touch: bool = True):
+  """
+  Last message of a conversation in the inbox of every member, in one write. touch moves
+  the conversation to the top of the inbox, an unsent message doesn't.
+  """
+  update = {"last_message": last_message}
+  if touch:
+    update["last_activity"] = datetime.utcnow()
+  await db.inbox.update_many({"conversation_id": conversation_id}, {"$set": update})
+
+# Each user's conversations are also ranked in a redis sorted set, "chat:{id}" /
+# "group:{id}" members scored by the unix time of their last activity. An index that
+# exists is complete: writes only go to loaded indexes, a missing one is rebuilt whole
+# from the inbox collection on the next read. GT keeps an older batch committed late
+# from moving a conversation down.
+index_if_loaded = redis.register_script("""
+if redis.call('EXISTS', KEYS[1]) == 1 then
+  return redis.call('ZADD', KEYS[1], 'GT', ARGV[1], ARGV[2])
+end
+return 0
+""")
+
+def index_member(kind: str, conversation_id) -> str:
+  return f"{kind}:{conversation_id}"
+
+def unix_time(value: datetime) -> float:
+  # Mongo hands back naive UTC datetimes
+  return value.replace(tzinfo=timezone.utc).timestamp()
+
+async def index_conversation(user_ids: Iterable[ObjectId], kind: str, conversation_id: ObjectId, activity: Optional[float] = None):
+  score = activity or time.time()
+  keys = [inbox_index_key(user_id) for user_id in user_ids]
+  # Plain EVALSHA in one pipeline: a cluster pipeline can't load scripts, so the keys of
+  # a shard that doesn't know the script yet are retried once it is loaded on every primary
+  for _ in range(2):
+    async with redis.pipeline(transaction=False) as pipe:
+      for key in keys:
+        pipe.evalsha(index_if_loaded.sha, 1, key, score, index_member(kind, conversation_id))
+      results = await pipe.execute(raise_on_error=False)
+    keys = [key for key, result in zip(keys, results) if isinstance(result, NoScriptError)]
+    if not keys:
+      return
+    await redis.script_load(index_if_loaded.script)
+  raise NoScriptError(f"inbox index script missing after loading it, {len(keys)} indexes not updated")
+
+async def unindex_conversation(user_ids: Iterable[ObjectId], kind: str, conversation_id: ObjectId):
+  # Its unread counter goes with it, the mongo count goes with the inbox entry
+  async with redis.pipeline(transaction=False) as pipe:
+    for user_id in user_ids:
+      pipe.zrem(inbox_index_key(user_id), index_member(kind, conversation_id))
+      pipe.hdel(unread_counts_key(user_id), index_member(kind, conversation_id))
+    await pipe.execute()
+
+# {group_id: (expires at, member ids)}, so counting a group batch doesn't query mongo
+group_members_cache: Dict[ObjectId, Tuple[float, List[ObjectId]]] = {}
+GROUP_MEMBERS_CACHE_SIZE = 1024
+
+async def get_group_members(group_id: ObjectId) -> List[ObjectId]:
+  cached = group_members_cache.get(group_id)
+  if cached and cached[0] > time.monotonic():
+    return cached[1]
+
+  member_ids = [entry["user_id"] async for entry in db.inbox.find({"conversation_id": group_id}, {"user_id": 1})]
+  if len(group_members_cache) >= GROUP_MEMBERS_CACHE_SIZE:
+    now = time.monotonic()
+    for expired in [cached_id for cached_id, (expires_at, _) in group_members_cache.items() if expires_at <= now]:
+      del group_members_cache[expired]
+  group_members_cache[group_id] = (time.monotonic() + settings.GROUP_MEMBERS_CACHE_TTL, member_ids)
+  return member_ids
+
+def forget_group_members(group_id: ObjectId):
+  # Membership changed on this worker, the others catch up within GROUP_MEMBERS_CACHE_TTL
+  group_members_cache.pop(group_id, None)
+
+def last_message_data(message: dict) -> dict:
+  return {"content": message["content"], "sent_by": message["sender_id"], "created_at": message["created_at"]}
+
+async def chat_recipients(chat_id: ObjectId, participant_ids: List[ObjectId]) -> List[ObjectId]:
+  # A side that deleted the chat keeps it out of their inbox until they start it again
+  deleted_by = {entry["user_id"] async for entry in db.inbox.find({"conversation_id": chat_id, "deleted": True}, {"user_id": 1})}
+  return [participant_id for participant_id in participant_ids if participant_id not in deleted_by]
+
+async def touch_chat(chat_id: ObjectId, participant_ids: List[ObjectId], messages: List[dict]):
+  # Runs once per committed batch of a chat
+  recipient_ids = await chat_recipients(chat_id, participant_ids)
+  await set_last_message(chat_id, last_message_data(messages[-1]))
+  await index_conversation(recipient_ids, "chat", chat_id)
+  await count_unread("chat", chat_id, unread_for(messages, recipient_ids))
+
+async def touch_group(group_id: ObjectId, messages: List[dict]):
+  """
+  Count a committed group batch as unread for every member, and copy the group's last
+  activity to their inbox entries and indexes at most once per
+  INBOX_GROUP_ACTIVITY_RESOLUTION seconds: a busy group of thousands doesn't rewrite
+  thousands of entries per batch. Pages read the last message itself from redis.
+  """
+  member_ids = await get_group_members(group_id)
+  await count_unread("group", group_id, unread_for(messages, member_ids))
+
+  if not await redis.set(inbox_fanout_flag_key(group_id), 1, nx=True, ex=settings.INBOX_GROUP_ACTIVITY_RESOLUTION):
+    return
+  await set_last_message(group_id, last_message_data(messages[-1]))
+  await index_conversation(member_ids, "group", group_id)
+
+async def load_inbox_index(user_id: ObjectId):
+  # Refresh the TTL of a loaded index, rebuild a missing one from the inbox collection
+  key = inbox_index_key(user_id)
+  if await redis.expire(key, settings.INBOX_INDEX_TTL):
+    return
+
+  scores = {
+    index_member(entry["kind"], entry["conversation_id"]): unix_time(entry["last_activity"])
+    async for entry in db.inbox.find(
+      {"user_id": user_id, "deleted": {"$ne": True}},
+      {"kind": 1, "conversation_id": 1, "last_activity": 1}
+    )
+  }
+  if not scores:
+    return  # Nothing to rank, the next read looks again
+
+  async with redis.pipeline(transaction=True) as pipe:
+    # GT: activity indexed while the entries were read is newer than what mongo returned
+    pipe.zadd(key, scores, gt=True)
+    pipe.expire(key, settings.INBOX_INDEX_TTL)
+    await pipe.execute()
+
+def last_message_of(stored_message: Optional[bytes]) -> Optional[dict]:
+  if not stored_message:
+    return None
+  return last_message_data(decode_stored_message(stored_message))
+
+def encode_inbox_cursor(score: float, member: str) -> str:
+  return f"{score!r}:{member}"
+
+def decode_inbox_cursor(cursor: str) -> Tuple[float, str]:
+  # ValueError on a cursor this didn't hand out
+  score, member = cursor.split(":", 1)
+  return float(score), member
+
+async def read_inbox_index(user_id: ObjectId, limit: int, cursor: Optional[str]) -> List[Tuple[str, float]]:
+  """
+  Up to limit + 1 (member, score) of a user's index after the cursor. Conversations
+  active at the same time share a score, so a page resumes on the cursor's score itself
+  and skips the members of that score up to and including the one it ended on: ties
+  come in reverse member order, those already returned sort at or after it.
+  """
+  key = inbox_index_key(user_id)
+  if not cursor:
+    ranked = await redis.zrevrangebyscore(key, "+inf", "-inf", start=0, num=limit + 1, withscores=True)
+    return [(member.decode('utf-8'), score) for member, score in ranked]
+
+  cursor_score, cursor_member = decode_inbox_cursor(cursor)
+  ranked, offset = [], 0
+  while len(ranked) <= limit:
+    batch = await redis.zrevrangebyscore(key, cursor_score, "-inf", start=offset, num=limit + 1, withscores=True)
+    offset += len(batch)
+    ranked += [
+      (member.decode('utf-8'), score) for member, score in batch
+      if score != cursor_score or member.decode('utf-8') < cursor_member
+    ]
+    if len(batch) <= limit:
+      break
+  return ranked[:limit + 1]
+
+async def fetch_inbox_page(user_id: ObjectId, limit: int, cursor: Optional[str] = None) -> Tuple[List[dict], Optional[str]]:
+  """
+  A page of a user's inbox, most recently active first, and the cursor of the next page
+  (None on the last one): a range of the user's redis index, the page's inbox entries in
+  one query, the newest message of each conversation in one pipeline and the counters in
+  one hash read. Chats the user deleted on their side aren't in the index.
+  """
+  if cursor:
+    decode_inbox_cursor(cursor)  # A bad cursor fails before anything is loaded
+  _, unread_counts = await asyncio.gather(load_inbox_index(user_id), load_unread_counts(user_id))
+
+  ranked = await read_inbox_index(user_id, limit, cursor)
+  next_cursor = encode_inbox_cursor(ranked[limit - 1][1], ranked[limit - 1][0]) if len(ranked) > limit else None
+  ranked = [(member.split(":"), score) for member, score in ranked[:limit]]
+  if not ranked:
+    return [], None
+
+  conversation_ids = [ObjectId(conversation_id) for (_, conversation_id), _ in ranked]
+
+  async def fetch_newest_messages():
+    async with redis.pipeline(transaction=False) as pipe:
+      for (kind, conversation_id), _ in ranked:
+        pipe.lindex(messages_key(conversation_id, kind == "group"), -1)
+      return await pipe.execute()
+
+  newest_messages, entries = await asyncio.gather(
+    fetch_newest_messages(),
+    db.inbox.find({"user_id": user_id, "conversation_id": {"$in": conversation_ids}}).to_list(None)
+  )
+  entries = {entry["conversation_id"]: entry for entry in entries}
+
+  page = []
+  for ((kind, _), score), conversation_id, newest_message in zip(ranked, conversation_ids, newest_messages):
+    entry = entries.get(conversation_id)
+    if entry is None or entry.get("deleted"):
+      continue  # Removed from the inbox, or deleted on the user's side, while the page was read
+    page.append({
+      "conversation_id": conversation_id,
+      "kind": kind,
+      "participant_id": entry.get("participant_id"),
+      # Archived conversations have nothing left in redis, their entry kept the last one
+      "last_message": last_message_of(newest_message) or entry.get("last_message"),
+      "last_activity": score,
+      "unread_count": unread_counts.get(index_member(kind, conversation_id), 0)
+    })
+  return page, next_cursor
@@ -0,0 +1,203 @@
+from core.redis import redis, messages_key
+from core.settings import settings
+from redis.exceptions import WatchError
+from typing import Awaitable, Callable, Dict, List, Optional
+from .json_codec import dumpb
+from .stored_message_codec import encode_stored_message, decode_stored_message
+from .message_archive import CONVERSATION_ACTIVITY_KEY, get_last_archived_message_sequence
+from .redis_pubsub import add_event
+from .delivery_trace import new_trace
+from .metrics import ingest_phase, ingest_batch_size, ingest_watch_retries, delivery_stage
+import asyncio
+import time
+
+# How long a conversation worker waits for more frames before it exits
+WORKER_IDLE_SECONDS = 30
+
+async def get_next_message_sequence(chat_or_group_id: str, is_group: bool, client=redis) -> int:
+  last_message = await client.lindex(messages_key(chat_or_group_id, is_group), -1)  # Get the last message
+  if last_message:
+    return decode_stored_message(last_message)['message_sequence'] + 1
+
+  # The redis tail may have been archived, continue after the newest message in mongo
+  last_archived_sequence = await get_last_archived_message_sequence(chat_or_group_id, is_group)
+  if last_archived_sequence is not None:
+    return last_archived_sequence + 1
+  else:
+    return 0  # If no messages exist, start with sequence 0
+
+class IngestBatcher:
+  """
+  Per-conversation ingest queues. Receive loops hand over frames and a worker per
+  conversation commits up to INGEST_BATCH_MAX_SIZE of them, or whatever arrived within
+  INGEST_BATCH_MAX_DELAY_MS, with one RPUSH and one combined stream event.
+  """
+
+  def __init__(self):
+    self.queues: Dict[tuple, asyncio.Queue] = {}  # {(is_group, chat_or_group_id): queue}
+    self.workers: Dict[tuple, asyncio.Task] = {}
+    self.pending = 0  # Submitted messages not committed (and after_commit not run) yet
+    self.idle = asyncio.Event()
+    self.idle.set()
+
+  def submit(
+    self,
+    chat_or_group_id: str,
+    is_group: bool,
+    message_data: dict,
+    after_commit: Optional[Callable[[List[dict]], Awaitable]] = None,
+    received_at: Optional[float] = None
+  ) -> asyncio.Future:
+    """
+    Queue a message (without message_sequence) for persistence. The returned future
+    resolves with the stored message once its batch is committed. after_commit of the
+    newest message in a batch is awaited with every message of that batch. received_at,
+    the perf_counter() time the frame was read, starts the batch's delivery trace.
+    """
+    conversation = (is_group, str(chat_or_group_id))
+    future = asyncio.get_running_loop().create_future()
+
+    if conversation not in self.queues:
+      self.queues[conversation] = asyncio.Queue()
+    self.queues[conversation].put_nowait((message_data, after_commit, future, received_at))
+    self.pending += 1
+    self.idle.clear()
+
+    if conversation not in self.workers or self.workers[conversation].done():
+      self.workers[conversation] = asyncio.create_task(self.drain(conversation))
+
+    return future
+
+  async def wait_idle(self, timeout: float) -> bool:
+    """
+    Wait until every submitted message is committed and its after_commit has run, for
+    shutdown. False if that took longer than timeout seconds.
+    """
+    try:
+      await asyncio.wait_for(self.idle.wait(), timeout)
+      return True
+    except asyncio.TimeoutError:
+      return False
+
+  def batch_done(self, batch: list):
+    self.pending -= len(batch)
+    if not self.pending:
+      self.idle.set()
+
+  def depths(self) -> Dict[str, int]:
+    # Frames waiting for a commit, per conversation with a backlog
+    return {
+      f"{'group' if is_group else 'chat'}:{chat_or_group_id}": queue.qsize()
+      for (is_group, chat_or_group_id), queue in self.queues.items()
+      if queue.qsize()
+    }
+
+  async def next_batch(self, queue: asyncio.Queue, first) -> list:
+    batch = [first]
+    deadline = time.monotonic() + settings.INGEST_BATCH_MAX_DELAY_MS / 1000
+
+    while len(batch) < settings.INGEST_BATCH_MAX_SIZE:
+      if not queue.empty():
+        batch.append(queue.get_nowait())
+        continue
+      remaining = deadline - time.monotonic()
+      if remaining <= 0:
+        break
+      try:
+        batch.append(await asyncio.wait_for(queue.get(), remaining))
+      except asyncio.TimeoutError:
+        break
+
+    return batch
+
+  async def drain(self, conversation: tuple):
+    queue = self.queues[conversation]
+
+    while True:
+      try:
+        first = await asyncio.wait_for(queue.get(), WORKER_IDLE_SECONDS)
+      except asyncio.TimeoutError:
+        # Nothing can be queued between this check and the cleanup, both run without awaiting
+        if queue.empty():
+          del self.queues[conversation]
+          del self.workers[conversation]
+          return
+        continue
+
+      batch = await self.next_batch(queue, first)
+      try:
+        received = [received_at for _, _, _, received_at in batch if received_at is not None]
+        messages = await self.commit(conversation, [message_data for message_data, _, _, _ in batch], min(received, default=None))
+        for (_, _, future, _), message in zip(batch, messages):
+          if not future.done():
+            future.set_result(message)
+      except Exception as e:
+        print(f"Error: {str(e)}")
+        for _, _, future, _ in batch:
+          if not future.done():
+            future.set_exception(e)
+        self.batch_done(batch)
+        continue
+
+      after_commit = batch[-1][1]
+      if after_commit:
+        try:
+          with ingest_phase.time(phase="mongo"):
+            await after_commit(messages)
+        except Exception as e:
+          print(f"Error: {str(e)}")
+      self.batch_done(batch)
+
+  async def commit(self, conversation: tuple, messages: List[dict], received_at: Optional[float] = None) -> List[dict]:
+    is_group, chat_or_group_id = conversation
+    kind = "group" if is_group else "chat"
+
+    key = messages_key(chat_or_group_id, is_group)
+    ingest_batch_size.observe(len(messages))
+
+    async with redis.pipeline(transaction=True) as pipe:
+      while True:
+        try:
+          started = time.perf_counter()
+          # Other workers and nodes commit to the same conversation; WATCH keeps the
+          # sequences unique and the list in sequence order
+          await pipe.watch(key)
+
+          # One sequence lookup per batch, the batch gets consecutive numbers
+          message_sequence = await get_next_message_sequence(chat_or_group_id, is_group, pipe)
+          ingest_phase.observe(time.perf_counter() - started, phase="sequence")
+          for offset, message_data in enumerate(messages):
+            message_data["message_sequence"] = message_sequence + offset
+
+          encoded_messages = [dumpb(message_data) for message_data in messages]
+
+          # A lone message keeps its usual event shape, bursts go out as one batch event
+          if len(messages) == 1:
+            event = encoded_messages[0]
+          else:
+            event = b'{"action":"batch","messages":[' + b",".join(encoded_messages) + b"]}"
+
+          # The list write and the stream publish share one MULTI, they are timed together
+          with ingest_phase.time(phase="redis_write_publish"):
+            pipe.multi()
+            pipe.rpush(
+              key,
+              *[encode_stored_message(message_data, encoded) for message_data, encoded in zip(messages, encoded_messages)]
+            )
+            trace = new_trace(received_at)
+            add_event(pipe, chat_or_group_id, event, is_group, trace)
+            await pipe.execute()
+          # Recorded once, a retried commit starts a new trace
+          delivery_stage.observe(trace["ingest"], stage="ingest")
+          break
+        except WatchError:
+          ingest_watch_retries.inc()
+          continue
+
+    # The activity set lives on another cluster slot, outside the transaction
+    with ingest_phase.time(phase="activity"):
+      await redis.zadd(CONVERSATION_ACTIVITY_KEY, {f"{kind}:{chat_or_group_id}": time.time()})
+
+    return messages
+
+ingest_batcher = IngestBatcher()
@@ -0,0 +1,127 @@
+from core.settings import settings
+from fastapi import WebSocket
+from typing import Awaitable, Callable, Dict, List, Optional
+from .ingest_batcher import ingest_batcher
+from .json_codec import dumps
+from .metrics import Counter, Gauge, ingest_latency
+import asyncio
+import time
+
+# Open ingest queues by websocket_id, read by ingest_queue_stats()
+ingest_queues: Dict[str, "ConnectionIngestQueue"] = {}
+rejected_frames = 0  # Frames answered with backpressure since startup, closed sockets included
+
+Gauge("talk_ingest_queued_frames", "Frames waiting in socket ingest queues or in flight to the batcher", collect=lambda: {(): sum(ingest_queue.depth for ingest_queue in ingest_queues.values())})
+Counter("talk_ingest_rejected_frames_total", "Frames refused with a backpressure frame", collect=lambda: {(): rejected_frames})
+
+async def send_frame_error(websocket: WebSocket, reason: str, message_id: Optional[str] = None):
+  try:
+    await websocket.send_text(dumps({"action": "error", "id": message_id, "reason": reason}))
+  except Exception:
+    pass  # The socket is going away, its receive loop will notice
+
+class ConnectionIngestQueue:
+  """
+  Bounded hand-off between the receive loop of one socket and its persistence worker.
+  The receive loop never waits on redis or mongo; once INGEST_QUEUE_MAX_SIZE frames are
+  waiting, new frames are refused with a backpressure frame the client can retry on.
+  """
+
+  def __init__(
+    self,
+    websocket: WebSocket,
+    websocket_id: str,
+    chat_or_group_id: str,
+    is_group: bool,
+    after_commit: Optional[Callable[[List[dict]], Awaitable]] = None
+  ):
+    self.websocket = websocket
+    self.websocket_id = websocket_id
+    self.chat_or_group_id = chat_or_group_id
+    self.is_group = is_group
+    self.after_commit = after_commit
+    self.queue: asyncio.Queue = asyncio.Queue(maxsize=settings.INGEST_QUEUE_MAX_SIZE)
+    self.in_flight = 0
+    self.worker: Optional[asyncio.Task] = None
+
+  @property
+  def depth(self) -> int:
+    return self.queue.qsize() + self.in_flight
+
+  def start(self):
+    ingest_queues[self.websocket_id] = self
+    self.worker = asyncio.create_task(self.run())
+
+  async def offer(self, message_data: dict) -> bool:
+    global rejected_frames
+    try:
+      self.queue.put_nowait((message_data, time.perf_counter()))
+      return True
+    except asyncio.QueueFull:
+      rejected_frames += 1
+      try:
+        await self.websocket.send_text(dumps({
+          "action": "backpressure",
+          "id": message_data["id"],
+          "queue_depth": self.depth,
+          "retry_after_ms": settings.INGEST_BACKPRESSURE_RETRY_MS
+        }))
+      except Exception:
+        pass
+      return False
+
+  async def run(self):
+    while True:
+      # Take everything that is waiting so the frames land in the same ingest batch
+      frames = [await self.queue.get()]
+      while not self.queue.empty():
+        frames.append(self.queue.get_nowait())
+
+      self.in_flight = len(frames)
+      futures = [
+        ingest_batcher.submit(self.chat_or_group_id, self.is_group, message_data, after_commit=self.after_commit, received_at=received_at)
+        for message_data, received_at in frames
+      ]
+      results = await asyncio.gather(*futures, return_exceptions=True)
+      self.in_flight = 0
+
+      committed_at = time.perf_counter()
+      for (message_data, received_at), result in zip(frames, results):
+        if isinstance(result, Exception):
+          await send_frame_error(self.websocket, "Message could not be saved", message_data["id"])
+        else:
+          ingest_latency.observe(committed_at - received_at)
+
+  def close(self):
+    """
+    Stop the worker once the socket is gone. Frames it had not handed over yet still go
+    to the batcher, a client that sent and disconnected keeps its messages.
+    """
+    ingest_queues.pop(self.websocket_id, None)
+    if self.worker:
+      self.worker.cancel()
+    while not self.queue.empty():
+      message_data, received_at = self.queue.get_nowait()
+      ingest_batcher.submit(self.chat_or_group_id, self.is_group, message_data, after_commit=self.after_commit, received_at=received_at)
+
+def ingest_queue_stats() -> dict:
+  """
+  Where ingest latency builds up: frames waiting per socket and conversation, and per
+  conversation in the batcher behind them.
+  """
+  conversations: Dict[str, int] = {}
+  for ingest_queue in ingest_queues.values():
+    key = f"{'group' if ingest_queue.is_group else 'chat'}:{ingest_queue.chat_or_group_id}"
+    conversations[key] = conversations.get(key, 0) + ingest_queue.depth
+
+  depths = [ingest_queue.depth for ingest_queue in ingest_queues.values()]
+  busiest = sorted(conversations.items(), key=lambda item: item[1], reverse=True)[:20]
+  return {
+    "connections": len(depths),
+    "queued_frames": sum(depths),
+    "max_connection_depth": max(depths, default=0),
+    "queue_capacity": settings.INGEST_QUEUE_MAX_SIZE,
+    "rejected_frames": rejected_frames,
+    "busiest_conversations": dict(busiest),
+    "batcher_queues": ingest_batcher.depths()
+  }
@@ -0,0 +1,24 @@
+from core.redis import redis
+from core.settings import settings
+from redis.exceptions import LockError
+from .metrics import background_job_duration
+from typing import Awaitable, Callable
+
+async def run_exclusively(job_name: str, job: Callable[[], Awaitable]) -> bool:
+  """
+  Run one pass of a periodic background job unless another worker or node is already
+  running it. Returns whether this process ran the pass.
+  """
+  lock = redis.lock(f"jobs:{job_name}", timeout=settings.BACKGROUND_JOB_LOCK_TIMEOUT)
+  if not await lock.acquire(blocking=False):
+    return False
+
+  try:
+    with background_job_duration.time(job=job_name):
+      await job()
+  finally:
+    try:
+      await lock.release()
+    except LockError:
+      pass  # The pass outlived the lock timeout and the lock expired
+  return True
@@ -0,0 +1,50 @@
+from fastapi.responses import JSONResponse, Response
+from bson import ObjectId
+from datetime import datetime
+from typing import Any, Iterable
+import json
+
+try:
+  import orjson
+except ImportError:  # fall back to the stdlib encoder when orjson is not installed
+  orjson = None
+
+def default(value):
+  """Encode the Mongo types orjson/json don't know about."""
+  if isinstance(value, ObjectId):
+    return str(value)
+  if isinstance(value, datetime):
+    return value.isoformat()
+  raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+def dumpb(value: Any) -> bytes:
+  """Encode to UTF-8 JSON bytes, the form redis and HTTP bodies want."""
+  if orjson:
+    return orjson.dumps(value, default=default)
+  return json.dumps(value, default=default, separators=(",", ":")).encode("utf-8")
+
+def dumps(value: Any) -> str:
+  """Encode to a JSON string, the form websocket.send_text wants."""
+  return dumpb(value).decode("utf-8")
+
+def loads(value) -> Any:
+  if orjson:
+    return orjson.loads(value)
+  return json.loads(value)
+
+class JSONCodecResponse(JSONResponse):
+  """
+  JSONResponse that encodes through the shared codec, so Mongo documents can be
+  returned as they are without convert_to_json_serializeble_object copying them first.
+  """
+
+  def render(self, content: Any) -> bytes:
+    return dumpb(content)
+
+def raw_json_array_response(field: str, encoded_items: Iterable[bytes], status_code: int = 200) -> Response:
+  """
+  Respond with {field: [...]} by splicing already encoded JSON items together,
+  e.g. messages straight out of a redis list, without decoding them first.
+  """
+  body = b'{"' + field.encode("utf-8") + b'":[' + b",".join(encoded_items) + b"]}"
+  return Response(content=body, status_code=status_code, media_type="application/json")
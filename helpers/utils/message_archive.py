@@ -0,0 +1,56 @@
+from core.database import db
+from core.redis import redis, unseen_flag_key
+from datetime import datetime
+from typing import Optional
+
+# Sorted set of "chat:{id}" / "group:{id}" members scored by the unix time of their last message
+CONVERSATION_ACTIVITY_KEY = "conversations:last_activity"
+
+def bucket_filter(chat_or_group_id: str, is_group: bool) -> dict:
+  return {"group_id": str(chat_or_group_id)} if is_group else {"chat_id": str(chat_or_group_id)}
+
+async def get_last_message_bucket_sequence(chat_or_group_id: str, is_group: bool) -> int:
+  latest_bucket = await db.messages.find_one(
+    bucket_filter(chat_or_group_id, is_group),
+    {"message_bucket_sequence": 1},
+    sort=[("message_bucket_sequence", -1)]
+  )
+  if latest_bucket and "message_bucket_sequence" in latest_bucket:
+    return latest_bucket["message_bucket_sequence"] + 1
+  else:
+    return 0
+
+async def fetch_latest_bucket(chat_or_group_id: str, is_group: bool, projection: Optional[dict] = None) -> Optional[dict]:
+  return await db.messages.find_one(
+    bucket_filter(chat_or_group_id, is_group),
+    projection,
+    sort=[("message_bucket_sequence", -1)]
+  )
+
+async def get_last_archived_message_sequence(chat_or_group_id: str, is_group: bool) -> Optional[int]:
+  """
+  message_sequence of the newest message in mongo, used when the redis tail of a
+  conversation is empty because it was archived.
+  """
+  latest_bucket = await fetch_latest_bucket(chat_or_group_id, is_group, {"messages": {"$slice": -1}})
+  if latest_bucket and latest_bucket.get("messages"):
+    return latest_bucket["messages"][-1]["message_sequence"]
+  return None
+
+async def archive_messages(chat_or_group_id: str, is_group: bool, messages: list):
+  """
+  Store messages as the next mongo bucket of a conversation and return the insert result.
+  """
+  # Check for unseen messages in the batch and flag them for mark-as-seen
+  has_unseen = any(msg for msg in messages if not msg.get("seen", False))
+  if has_unseen:
+    await redis.set(unseen_flag_key(chat_or_group_id, is_group), 1)
+
+  message_bucket_sequence = await get_last_message_bucket_sequence(chat_or_group_id, is_group)
+  document = {
+    **bucket_filter(chat_or_group_id, is_group),
+    "messages": messages,
+    "message_bucket_sequence": message_bucket_sequence,
+    "created_at": datetime.now().isoformat()
+  }
+  return await db.messages.insert_one(document)
@@ -0,0 +1,180 @@
+from core.redis import redis
+from core.settings import settings
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Tuple
+from .json_codec import dumpb, loads
+import asyncio
+import bisect
+import math
+import os
+import socket
+import time
+
+# Seconds, from sub-millisecond redis round trips up to stalled requests
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 5000)
+
+# Every metric of this process, in registration order
+registry: List["Metric"] = []
+
+def label_key(labels: Dict[str, str]) -> Tuple:
+  return tuple(sorted(labels.items()))
+
+class Metric:
+  kind = "untyped"
+
+  def __init__(self, name: str, documentation: str, collect: Optional[Callable[[], Dict[Tuple, float]]] = None):
+    """
+    collect, when given, is called on every scrape and returns {label_key: value}, for
+    values that already live elsewhere (socket counts, queue depths).
+    """
+    self.name = name
+    self.documentation = documentation
+    self.collect_values = collect
+    self.values: Dict[Tuple, float] = {}
+    registry.append(self)
+
+  def samples(self) -> list:
+    values = self.collect_values() if self.collect_values else self.values
+    return [[self.name, dict(labels), value] for labels, value in values.items()]
+
+class Counter(Metric):
+  kind = "counter"
+
+  def inc(self, amount: float = 1, **labels):
+    key = label_key(labels)
+    self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+  kind = "gauge"
+
+  def set(self, value: float, **labels):
+    self.values[label_key(labels)] = value
+
+class Histogram(Metric):
+  kind = "histogram"
+
+  def __init__(self, name: str, documentation: str, buckets: Tuple = LATENCY_BUCKETS):
+    super().__init__(name, documentation)
+    self.buckets = buckets
+    self.histograms: Dict[Tuple, list] = {}  # {label_key: [bucket counts..., sum, count]}
+
+  def observe(self, value: float, **labels):
+    key = label_key(labels)
+    if key not in self.histograms:
+      self.histograms[key] = [0] * (len(self.buckets) + 2)
+    histogram = self.histograms[key]
+    # Counts per bucket are made cumulative when rendering, observing stays O(log n)
+    index = bisect.bisect_left(self.buckets, value)
+    if index < len(self.buckets):
+      histogram[index] += 1
+    histogram[-2] += value
+    histogram[-1] += 1
+
+  @contextmanager
+  def time(self, **labels):
+    started = time.perf_counter()
+    try:
+      yield
+    finally:
+      self.observe(time.perf_counter() - started, **labels)
+
+  def samples(self) -> list:
+    samples = []
+    for key, histogram in self.histograms.items():
+      cumulative = 0
+      for bound, count in zip(self.buckets, histogram):
+        cumulative += count
+        samples.append([f"{self.name}_bucket", {**dict(key), "le": str(bound)}, cumulative])
+      samples.append([f"{self.name}_bucket", {**dict(key), "le": "+Inf"}, histogram[-1]])
+      samples.append([f"{self.name}_sum", dict(key), histogram[-2]])
+      samples.append([f"{self.name}_count", dict(key), histogram[-1]])
+    return samples
+
+def collect() -> list:
+  return [
+    {"name": metric.name, "type": metric.kind, "help": metric.documentation, "samples": metric.samples()}
+    for metric in registry
+  ]
+
+def format_value(value: float) -> str:
+  if value == math.inf:
+    return "+Inf"
+  return repr(float(value)) if isinstance(value, float) else str(value)
+
+def render(families: list) -> str:
+  lines = []
+  for family in families:
+    lines.append(f"# HELP {family['name']} {family['help']}")
+    lines.append(f"# TYPE {family['name']} {family['type']}")
+    for name, labels, value in family["samples"]:
+      if labels:
+        label_text = ",".join(f'{label}="{str(label_value)}"' for label, label_value in labels.items())
+        lines.append(f"{name}{{{label_text}}} {format_value(value)}")
+      else:
+        lines.append(f"{name} {format_value(value)}")
+  return "\n".join(lines) + "\n"
+
+# Workers of one host share a port, a scrape lands on any of them. Each worker stores a
+# snapshot in redis and /metrics renders all workers of the host, labelled by worker.
+WORKER_ID = str(os.getpid())
+SNAPSHOT_KEY = f"metrics:{socket.gethostname()}"
+
+def with_worker_label(families: list, worker_id: str) -> list:
+  for family in families:
+    for sample in family["samples"]:
+      sample[1] = {**sample[1], "worker": worker_id}
+  return families
+
+async def push_metrics_snapshots():
+  while True:
+    await asyncio.sleep(settings.METRICS_SNAPSHOT_INTERVAL)
+    try:
+      await redis.hset(SNAPSHOT_KEY, WORKER_ID, dumpb({"at": time.time(), "families": collect()}))
+      await redis.expire(SNAPSHOT_KEY, settings.METRICS_SNAPSHOT_INTERVAL * 3)
+    except Exception as e:
+      print(f"Error: {str(e)}")
+
+async def remove_metrics_snapshot():
+  await redis.hdel(SNAPSHOT_KEY, WORKER_ID)
+
+async def render_host_metrics() -> str:
+  """
+  This worker's live metrics plus the latest snapshot of every other worker on the host.
+  """
+  merged: Dict[str, dict] = {}
+  sources = [(WORKER_ID, collect())]
+
+  for worker_id, snapshot in (await redis.hgetall(SNAPSHOT_KEY)).items():
+    worker_id = worker_id.decode('utf-8')
+    snapshot = loads(snapshot)
+    # Skip this worker and workers that stopped pushing
+    if worker_id != WORKER_ID and time.time() - snapshot["at"] < settings.METRICS_SNAPSHOT_INTERVAL * 3:
+      sources.append((worker_id, snapshot["families"]))
+
+  for worker_id, families in sources:
+    for family in with_worker_label(families, worker_id):
+      if family["name"] in merged:
+        merged[family["name"]]["samples"].extend(family["samples"])
+      else:
+        merged[family["name"]] = family
+  return render(list(merged.values()))
+
+# Hot path metrics, observed by the modules named in their help text
+
+ingest_latency = Histogram("talk_ingest_latency_seconds", "Socket frame received until its message is in redis and published (ingest_queue)")
+ingest_phase = Histogram("talk_ingest_phase_seconds", "Duration of one ingest batch phase: sequence lookup, redis write with stream publish, activity, mongo inbox update (ingest_batcher)")
+ingest_batch_size = Histogram("talk_ingest_batch_messages", "Messages committed per ingest batch (ingest_batcher)", SIZE_BUCKETS)
+ingest_watch_retries = Counter("talk_ingest_watch_retries_total", "Ingest commits retried because another worker wrote the conversation meanwhile (ingest_batcher)")
+broadcast_duration = Histogram("talk_broadcast_seconds", "Time to queue one event for every local socket of a conversation (websocket_connection_manager)")
+broadcast_recipients = Histogram("talk_broadcast_recipients", "Local sockets an event was queued for (websocket_connection_manager)", SIZE_BUCKETS)
+socket_flush_duration = Histogram("talk_socket_flush_seconds", "Time to write one outbound frame to a socket (websocket_connection_manager)")
+socket_frame_events = Histogram("talk_socket_frame_events", "Events written in one outbound frame flush (websocket_connection_manager)", SIZE_BUCKETS)
+socket_drops = Counter("talk_socket_drops_total", "Sockets closed because they fell too far behind or a write failed (websocket_connection_manager)")
+delivery_stage = Histogram("talk_delivery_stage_seconds", "Time a traced event spends in one delivery hop: ingest on the sender's worker, the stream hop to the reader, fanout queueing and socket_write per recipient (delivery_trace)")
+delivery_latency = Histogram("talk_delivery_seconds", "Sender's frame received until the event is written to a recipient's socket (delivery_trace)")
+background_job_duration = Histogram("talk_background_job_seconds", "Duration of one background job pass (job_lock)", LATENCY_BUCKETS + (30, 60, 300, 900))
+flush_backlog = Gauge("talk_flush_backlog_conversations", "Conversations over the flush threshold in the last batch_save_messages pass")
+redis_list_length = Histogram("talk_redis_message_list_length", "Length of the redis messages lists seen by batch_save_messages", SIZE_BUCKETS)
+auth_duration = Histogram("talk_auth_seconds", "Access token validation time (authentication)")
+bcrypt_duration = Histogram("talk_bcrypt_seconds", "bcrypt hash and verify time, spent on the event loop (user_route)", LATENCY_BUCKETS + (30,))
@@ -0,0 +1,49 @@
+from core.redis import redis, mget
+from core.settings import settings
+from bson import ObjectId
+from typing import Dict, List
+from .json_codec import dumpb, loads
+
+def profile_summary_key(user_id) -> str:
+  return f"profile_summary:{user_id}"
+
+async def get_profile_summaries(db, user_ids: List[ObjectId]) -> Dict[str, dict]:
+  """
+  Resolve {_id, username, profile_image} summaries for many users at once.
+  Cached summaries come from one MGET, the misses from a single $in query.
+  """
+  user_ids = list(dict.fromkeys(user_ids))  # drop duplicates but keep the order
+  if not user_ids:
+    return {}
+
+  summaries = {}
+  missing_ids = []
+
+  cached = await mget([profile_summary_key(user_id) for user_id in user_ids])
+  for user_id, summary in zip(user_ids, cached):
+    if summary:
+      summaries[str(user_id)] = loads(summary)
+    else:
+      missing_ids.append(user_id)
+
+  if missing_ids:
+    cursor = db.users.find(
+      {"_id": {"$in": missing_ids}},
+      {"username": 1, "profile_image": 1}
+    )
+
+    pipe = redis.pipeline(transaction=False)
+    async for db_user in cursor:
+      summary = {
+        "_id": str(db_user["_id"]),
+        "username": db_user.get("username"),
+        "profile_image": db_user.get("profile_image")
+      }
+      summaries[summary["_id"]] = summary
+      pipe.set(profile_summary_key(summary["_id"]), dumpb(summary), ex=settings.PROFILE_SUMMARY_CACHE_TTL)
+    await pipe.execute()
+
+  return summaries
+
+async def invalidate_profile_summary(user_id):
+  await redis.delete(profile_summary_key(user_id))
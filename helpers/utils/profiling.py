@@ -0,0 +1,115 @@
+from core.settings import settings
+from typing import Dict, Optional
+from .metrics import Counter, Histogram
+import asyncio
+import collections
+import os
+import sys
+import threading
+import time
+import traceback
+
+event_loop_lag = Histogram("talk_event_loop_lag_seconds", "How late the event loop watchdog's periodic wakeup ran (profiling)")
+event_loop_stalls = Counter("talk_event_loop_stalls_total", "Event loop stalls longer than EVENT_LOOP_LAG_THRESHOLD_MS (profiling)")
+
+# Deepest frames of a blocking stack that get logged
+STALL_STACK_DEPTH = 12
+# Watchdog ticks recent_lag() looks back over
+RECENT_LAG_TICKS = 20
+
+def frame_label(frame) -> str:
+  code = frame.f_code
+  return f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})"
+
+class EventLoopWatchdog:
+  """
+  Finds calls that block the event loop, like a synchronous cloudinary upload or bcrypt.
+  A coroutine ticks every EVENT_LOOP_LAG_CHECK_MS and records how late it woke up; a
+  thread watches the ticks and, once the loop has not ticked for
+  EVENT_LOOP_LAG_THRESHOLD_MS, logs the loop thread's stack while it is still blocked.
+  """
+
+  def __init__(self):
+    self.last_tick = time.monotonic()
+    self.loop_thread_id: Optional[int] = None
+    self.stalls = 0  # Stalls seen since startup, requests compare it to spot stalls they sat through
+    self.recent_lags = collections.deque(maxlen=RECENT_LAG_TICKS)
+    self.stopped = threading.Event()
+
+  async def run(self):
+    if not settings.EVENT_LOOP_LAG_THRESHOLD_MS:
+      return
+    self.loop_thread_id = threading.get_ident()
+    self.stopped.clear()
+    threading.Thread(target=self.watch, name="event-loop-watchdog", daemon=True).start()
+
+    interval = settings.EVENT_LOOP_LAG_CHECK_MS / 1000
+    try:
+      while True:
+        self.last_tick = time.monotonic()
+        await asyncio.sleep(interval)
+        lag = max(0, time.monotonic() - self.last_tick - interval)
+        event_loop_lag.observe(lag)
+        self.recent_lags.append(lag)
+    finally:
+      self.stopped.set()
+
+  def recent_lag(self) -> float:
+    # Worst lag of the last RECENT_LAG_TICKS ticks
+    return max(self.recent_lags, default=0)
+
+  def watch(self):
+    threshold = settings.EVENT_LOOP_LAG_THRESHOLD_MS / 1000
+    reported_tick = None
+    while not self.stopped.wait(settings.EVENT_LOOP_LAG_CHECK_MS / 1000):
+      tick = self.last_tick
+      blocked_for = time.monotonic() - tick
+      # Once per stall; the loop is stuck in whatever frame it is in right now
+      if blocked_for < threshold or tick == reported_tick:
+        continue
+      reported_tick = tick
+      self.stalls += 1
+      event_loop_stalls.inc()
+
+      frame = sys._current_frames().get(self.loop_thread_id)
+      stack = traceback.format_stack(frame)[-STALL_STACK_DEPTH:] if frame else []
+      print(f"Event loop blocked for over {blocked_for * 1000:.0f}ms in:\n{''.join(stack)}", end="")
+
+event_loop_watchdog = EventLoopWatchdog()
+
+class SamplingProfiler:
+  """
+  Samples the stack of every thread of this process and counts identical stacks, in
+  the collapsed format flamegraph.pl and speedscope read ("frame;frame;frame count").
+  Samples are taken from a thread, so the event loop keeps serving while it runs and
+  its own stacks show up in the profile.
+  """
+
+  def __init__(self):
+    self.lock = asyncio.Lock()
+
+  def sample(self, seconds: float, interval: float) -> Dict[str, int]:
+    stacks: Dict[str, int] = collections.Counter()
+    sampler_thread_id = threading.get_ident()
+    thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+    deadline = time.monotonic() + seconds
+
+    while time.monotonic() < deadline:
+      for thread_id, frame in sys._current_frames().items():
+        if thread_id == sampler_thread_id:
+          continue
+        frames = []
+        while frame is not None:
+          frames.append(frame_label(frame))
+          frame = frame.f_back
+        frames.append(thread_names.get(thread_id, str(thread_id)))
+        stacks[";".join(reversed(frames))] += 1
+      time.sleep(interval)
+    return stacks
+
+  async def profile(self, seconds: float, interval_ms: int) -> str:
+    async with self.lock:
+      stacks = await asyncio.to_thread(self.sample, seconds, interval_ms / 1000)
+    return "\n".join(f"{stack} {count}" for stack, count in sorted(stacks.items())) + "\n"
+
+sampling_profiler = SamplingProfiler()
@@ -1,23 +1,238 @@
-from core.redis import redis
-import json
+from core.redis import redis, event_stream_key, call_channel, parse_conversation_key
+from core.settings import settings
 from bson import ObjectId
-from .websocket_connection_manager import websocket_connection_manager
+import asyncio
+from fastapi import WebSocket
+from typing import Dict, Optional, Union
+from .websocket_connection_manager import websocket_connection_manager, stream_id_tuple
+from .json_codec import dumpb, dumps, loads
+from .username_search_index import username_search_index
+from .delivery_trace import new_trace, encode_trace, read_trace
+from .task_supervisor import task_supervisor
+from .call_signaling import call_connections
 
-async def publish_message(chat_or_group_id: ObjectId, message: dict, is_group: bool = False, is_call: bool = False):
-  if is_group:
-    await redis.publish(f'group:{chat_or_group_id}', json.dumps(message))
-  elif is_call:
-    await redis.publish(f'call:{chat_or_group_id}', json.dumps(message))
-  else:
-    await redis.publish(f'chat:{chat_or_group_id}', json.dumps(message))
+USERNAME_INDEX_CHANNEL = 'users:username_index'
+STREAM_READ_BLOCK_MS = 100
+STREAM_READ_COUNT = 500
+
+def with_event_id(data: bytes, event_id: str) -> str:
+  # Splice the stream id into the stored JSON object instead of decoding it
+  text = data.decode('utf-8')
+  return f'{{"event_id":"{event_id}",{text[1:]}' if text != "{}" else f'{{"event_id":"{event_id}"}}'
+
+def add_event(client, chat_or_group_id, payload: bytes, is_group: bool = False, trace: Optional[Dict] = None):
+  # XADD through redis itself (awaitable) or queued on a pipeline, with the delivery trace beside the event
+  return client.xadd(
+    event_stream_key(chat_or_group_id, is_group),
+    {"data": payload, "trace": encode_trace(trace or new_trace())},
+    maxlen=settings.CONVERSATION_EVENT_STREAM_MAXLEN,
+    approximate=True
+  )
+
+async def publish_message(chat_or_group_id: ObjectId, message: Union[dict, bytes], is_group: bool = False):
+  # Callers that already encoded the message (e.g. for redis storage) pass the bytes through
+  payload = message if isinstance(message, bytes) else dumpb(message)
+  # Conversation events go to a capped stream so reconnecting clients can replay them.
+  # Call signaling doesn't come through here, see call_signaling.publish_signal
+  await add_event(redis, chat_or_group_id, payload, is_group)
+
+async def publish_username_change(user_id: ObjectId, username: str):
+  # Keeps the local username index of every node in sync with signups and renames
+  await redis.publish(USERNAME_INDEX_CHANNEL, dumpb({"user_id": str(user_id), "username": username}))
 
 async def redis_subscriber():
   pubsub = redis.pubsub()
-  await pubsub.psubscribe('chat:*')  # Subscribe to all chat channels
-  await pubsub.psubscribe('group:*')  # Subscribe to all group channels
-  await pubsub.psubscribe('call:*')  # Subscribe to all call channels
-  async for message in pubsub.listen():
-    if message['type'] == 'pmessage':
-      chat_or_group_id = message['channel'].decode('utf-8').split(':')[1]
-      data = json.loads(message['data'])
-      await websocket_connection_manager.broadcast(str(chat_or_group_id), data)
+  await pubsub.subscribe(USERNAME_INDEX_CHANNEL)
+  # Username changes are published cluster-wide, call channels are left to call_channel_subscriber
+  if not settings.REDIS_CLUSTER:
+    await pubsub.psubscribe('call:*')  # Subscribe to all per-user call channels
+  while True:
+    # Polled with a timeout instead of listen() so the supervisor sees the loop alive while idle
+    message = await pubsub.get_message(timeout=1.0)
+    task_supervisor.beat("redis_subscriber")
+    if message is None:
+      continue
+    if message['type'] == 'message':
+      if settings.USERNAME_SEARCH_BACKEND == "local":
+        data = loads(message['data'])
+        username_search_index.add(data['user_id'], data['username'])
+    elif message['type'] == 'pmessage':
+      await forward_call_message(message)
+
+async def forward_call_message(message: Dict):
+  _, user_id = parse_conversation_key(message['channel'].decode('utf-8'))
+  # Forward the published JSON untouched, straight to the user's call sockets on this node
+  await call_connections.deliver(user_id, message['data'].decode('utf-8'))
+
+class CallChannelSubscriber:
+  """
+  Sharded call channel subscriptions for REDIS_CLUSTER. Sharded channels can't be
+  pattern-subscribed, so each user with a local call socket is SSUBSCRIBEd to on the
+  shard owning its slot. On a single instance the call:* pattern in redis_subscriber
+  already covers every user and follow() does nothing.
+  """
+
+  def __init__(self):
+    self.pubsub = None
+    self.channels: Dict[str, str] = {}  # {channel: user_id}
+
+  async def follow(self, user_id: str):
+    if not settings.REDIS_CLUSTER or call_channel(user_id) in self.channels:
+      return
+    if self.pubsub is None:
+      self.pubsub = redis.pubsub()
+    self.channels[call_channel(user_id)] = str(user_id)
+    await self.pubsub.ssubscribe(call_channel(user_id))
+
+  async def run(self):
+    if not settings.REDIS_CLUSTER:
+      return
+    while True:
+      task_supervisor.beat("call_channel_subscriber")
+      # Drop channels whose user's last local call socket went away
+      for channel, user_id in list(self.channels.items()):
+        if user_id not in call_connections.sockets:
+          del self.channels[channel]
+          await self.pubsub.sunsubscribe(channel)
+
+      if not self.channels:
+        await asyncio.sleep(STREAM_READ_BLOCK_MS / 1000)
+        continue
+
+      message = await self.pubsub.get_sharded_message(ignore_subscribe_messages=True, timeout=STREAM_READ_BLOCK_MS / 1000)
+      if message and message['type'] == 'smessage':
+        await forward_call_message(message)
+
+call_channel_subscriber = CallChannelSubscriber()
+
+class ConversationEventReader:
+  """
+  Reads the event streams of every conversation that has a socket on this node and
+  broadcasts new entries locally, replacing the old chat/group pub/sub fan-out.
+  """
+
+  def __init__(self):
+    self.cursors: Dict[str, str] = {}  # {stream_key: id of the last entry read}
+
+  async def follow(self, stream_key: str):
+    # Start after the current tip, earlier events are the business of a replay
+    if stream_key not in self.cursors:
+      latest = await redis.xrevrange(stream_key, count=1)
+      self.cursors.setdefault(stream_key, latest[0][0].decode('utf-8') if latest else "0-0")
+
+  async def run(self):
+    while True:
+      task_supervisor.beat("conversation_event_reader")
+      # Stop following conversations whose last local socket went away
+      for stream_key in list(self.cursors):
+        if parse_conversation_key(stream_key)[1] not in websocket_connection_manager.active_connections:
+          del self.cursors[stream_key]
+
+      if not self.cursors:
+        await asyncio.sleep(STREAM_READ_BLOCK_MS / 1000)
+        continue
+
+      if settings.REDIS_CLUSTER:
+        response = await self.read_by_slot()
+      else:
+        response = await redis.xread(dict(self.cursors), count=STREAM_READ_COUNT, block=STREAM_READ_BLOCK_MS)
+
+      for stream_key, entries in response or []:
+        stream_key = stream_key.decode('utf-8')
+        _, chat_or_group_id = parse_conversation_key(stream_key)
+        for entry_id, fields in entries:
+          entry_id = entry_id.decode('utf-8')
+          trace = read_trace(fields, entry_id)
+          if stream_key in self.cursors:
+            self.cursors[stream_key] = entry_id
+          await websocket_connection_manager.broadcast(chat_or_group_id, with_event_id(fields[b"data"], entry_id), entry_id, trace)
+
+  async def read_by_slot(self) -> list:
+    # XREAD can't span slots on a cluster: one non-blocking read per slot, all at once
+    slots: Dict[int, Dict[str, str]] = {}
+    for stream_key, cursor in self.cursors.items():
+      slots.setdefault(redis.keyslot(stream_key), {})[stream_key] = cursor
+
+    responses = await asyncio.gather(*[redis.xread(streams, count=STREAM_READ_COUNT) for streams in slots.values()])
+    response = [stream for slot_response in responses for stream in slot_response or []]
+    if not response:
+      await asyncio.sleep(STREAM_READ_BLOCK_MS / 1000)
+    return response
+
+conversation_event_reader = ConversationEventReader()
+
+async def find_replay_start(stream_key: str, last_event_id: Optional[str], last_message_sequence: Optional[int]) -> Optional[str]:
+  """
+  Exclusive stream id to replay from, or None when the client's position fell out of
+  the capped stream and it has to refetch the history instead.
+  """
+  if last_event_id:
+    try:
+      stream_id_tuple(last_event_id)
+    except ValueError:
+      return None
+
+    if not await redis.exists(stream_key):
+      return last_event_id
+
+    stream_info = await redis.xinfo_stream(stream_key)
+    if "max-deleted-entry-id" in stream_info:
+      # The newest trimmed id (Redis >= 7) tells whether anything after the client's position is gone
+      max_deleted = stream_info["max-deleted-entry-id"]
+      if isinstance(max_deleted, bytes):
+        max_deleted = max_deleted.decode('utf-8')
+      if max_deleted and stream_id_tuple(max_deleted) > stream_id_tuple(last_event_id):
+        return None
+      return last_event_id
+
+    # Redis 6.2 doesn't report trimmed ids. The stream is trimmed from its head, so nothing
+    # after the client's position is gone while its own entry is still there
+    if await redis.xrange(stream_key, last_event_id, last_event_id):
+      return last_event_id
+    return None
+
+  # Map a message_sequence to the stream entry right before the first message the client lacks
+  previous_entry_id = "0-0"
+  first_message = True
+  for entry_id, fields in await redis.xrange(stream_key):
+    event = loads(fields[b"data"])
+    sequences = [message["message_sequence"] for message in event.get("messages", [])] if event.get("action") == "batch" else [event["message_sequence"]] if "message_sequence" in event else []
+    if sequences:
+      if sequences[-1] > last_message_sequence:
+        if first_message and sequences[0] > last_message_sequence + 1:
+          return None  # The messages right after the client's position were trimmed away
+        return previous_entry_id
+      first_message = False
+    previous_entry_id = entry_id.decode('utf-8')
+  return previous_entry_id
+
+def get_resume_position(websocket: WebSocket):
+  """
+  Position a reconnecting client already has, from the lastEventId or lastMessageSequence query params.
+  """
+  last_event_id = websocket.query_params.get('lastEventId')
+  last_message_sequence = websocket.query_params.get('lastMessageSequence')
+  if last_message_sequence is not None:
+    last_message_sequence = int(last_message_sequence) if last_message_sequence.lstrip('-').isdigit() else -1
+  return last_event_id, last_message_sequence
+
+async def replay_conversation_events(
+  websocket: WebSocket,
+  connection: Dict,
+  stream_key: str,
+  last_event_id: Optional[str] = None,
+  last_message_sequence: Optional[int] = None
+):
+  """
+  Send a reconnecting socket the events it missed, then switch it to live delivery.
+  """
+  start = await find_replay_start(stream_key, last_event_id, last_message_sequence)
+
+  if start is None:
+    await websocket.send_text(dumps({"action": "resync"}))
+  else:
+    for entry_id, fields in await redis.xrange(stream_key, min=f"({start}"):
+      entry_id = entry_id.decode('utf-8')
+      websocket_connection_manager.queue_event(parse_conversation_key(stream_key)[1], connection, with_event_id(fields[b"data"], entry_id), entry_id)
+
+  websocket_connection_manager.finish_replay(parse_conversation_key(stream_key)[1], connection)
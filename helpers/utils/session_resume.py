@@ -0,0 +1,94 @@
+import jwt
+from bson import ObjectId
+from datetime import datetime, timedelta
+from core.settings import settings
+from typing import Dict, Optional
+from .json_codec import dumps
+import random
+import time
+
+# Resume tokens carry this audience; the access token checks don't pass an audience, so
+# PyJWT rejects a resume token presented as an access token
+RESUME_TOKEN_AUDIENCE = "websocket-resume"
+
+def conversation_claim(chat_or_group_id, is_group: bool) -> str:
+  return f"{'group' if is_group else 'chat'}:{chat_or_group_id}"
+
+def issue_resume_token(user_id: ObjectId, chat_or_group_id, is_group: bool, participant_id: Optional[ObjectId] = None, auth_time: Optional[int] = None) -> str:
+  """
+  Short-lived token naming a user that was authorized for one conversation, handed to
+  the socket on connect. A resumed socket gets one carrying the auth_time of the full
+  connect it descends from, so every chain of resumes ends RESUME_TOKEN_LIFETIME after
+  the last real token check and membership lookup, and membership changes take effect.
+  """
+  auth_time = auth_time if auth_time is not None else int(time.time())
+  payload = {
+    'user_id': str(user_id),
+    'conversation': conversation_claim(chat_or_group_id, is_group),
+    'auth_time': auth_time,
+    'exp': datetime.utcfromtimestamp(auth_time) + timedelta(seconds=settings.RESUME_TOKEN_LIFETIME),
+    'aud': RESUME_TOKEN_AUDIENCE
+  }
+  if participant_id is not None:
+    payload['participant_id'] = str(participant_id)  # The other side of a chat, for its inbox updates
+  return jwt.encode(payload, settings.JWT_SECRET_KEY, algorithm=settings.JWT_ALGORITHM)
+
+def read_resume_token(token: Optional[str], chat_or_group_id, is_group: bool) -> Optional[Dict]:
+  """
+  The session a valid resume token for this conversation stands for, else None and the
+  socket goes through the full token check and membership lookup.
+  """
+  if not token:
+    return None
+  try:
+    payload = jwt.decode(token, settings.JWT_SECRET_KEY, algorithms=[settings.JWT_ALGORITHM], audience=RESUME_TOKEN_AUDIENCE)
+  except jwt.InvalidTokenError:
+    return None
+  if payload.get('conversation') != conversation_claim(chat_or_group_id, is_group):
+    return None
+  if 'auth_time' not in payload:
+    return None
+  return {
+    "user_id": ObjectId(payload['user_id']),
+    "participant_id": ObjectId(payload['participant_id']) if 'participant_id' in payload else None,
+    "auth_time": payload['auth_time']
+  }
+
+def session_frame(resume_token: str, auth_time: Optional[int] = None) -> str:
+  """
+  First frame of every socket: the token to reconnect with, and a random delay to wait
+  before reconnecting after an unannounced disconnect (a node crash can't send reconnect
+  frames), so the clients of a node come back spread out instead of all at once.
+  """
+  expires_in = settings.RESUME_TOKEN_LIFETIME
+  if auth_time is not None:
+    expires_in = max(0, auth_time + settings.RESUME_TOKEN_LIFETIME - int(time.time()))
+  return dumps({
+    "action": "session",
+    "resume_token": resume_token,
+    "expires_in": expires_in,
+    "reconnect_delay_ms": random.randint(0, settings.RECONNECT_DELAY_MAX_MS)
+  })
+
+class FullConnectLimiter:
+  """
+  Token bucket for sockets connecting without a resume token, the ones that cost a
+  mongo lookup. Resumed sockets are always let in; beyond FULL_CONNECTS_PER_SECOND the
+  rest are asked to retry later.
+  """
+
+  def __init__(self):
+    self.tokens = float(settings.FULL_CONNECTS_PER_SECOND)
+    self.updated = time.monotonic()
+
+  def admit(self) -> bool:
+    now = time.monotonic()
+    rate = settings.FULL_CONNECTS_PER_SECOND
+    self.tokens = min(rate, self.tokens + (now - self.updated) * rate)
+    self.updated = now
+    if self.tokens < 1:
+      return False
+    self.tokens -= 1
+    return True
+
+full_connect_limiter = FullConnectLimiter()
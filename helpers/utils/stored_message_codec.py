@@ -0,0 +1,69 @@
+from core.settings import settings
+from typing import Iterable, List, Optional
+from .json_codec import dumpb, loads
+
+try:
+  import msgpack
+except ImportError:
+  msgpack = None
+
+if settings.REDIS_MESSAGE_ENCODING == "msgpack" and msgpack is None:
+  raise RuntimeError("REDIS_MESSAGE_ENCODING=msgpack requires the msgpack package")
+
+# Fixed field orders for the messages kept in the redis hot-tail lists.
+# A compact message is stored as [layout, value, value, ...] instead of a JSON object,
+# so none of the keys are repeated in every list entry.
+CHAT_MESSAGE_LAYOUT = 1
+GROUP_MESSAGE_LAYOUT = 2
+
+MESSAGE_LAYOUTS = {
+  CHAT_MESSAGE_LAYOUT: (
+    "id", "sender_id", "reply_to_id", "reply_to_content", "content", "message_sequence",
+    "seen", "seen_timestamp", "action", "created_at"
+  ),
+  GROUP_MESSAGE_LAYOUT: (
+    "id", "sender_id", "reply_to_id", "content", "message_sequence", "created_at"
+  )
+}
+
+LAYOUTS_BY_FIELDS = {frozenset(fields): layout for layout, fields in MESSAGE_LAYOUTS.items()}
+
+def encode_stored_message(message: dict, encoded_json: Optional[bytes] = None, encoding: Optional[str] = None) -> bytes:
+  """
+  Encode a message for a redis messages list using REDIS_MESSAGE_ENCODING:
+  "json" (an object), "tuple" (a JSON array in layout order) or "msgpack" (the same array as msgpack).
+  Pass encoded_json when the caller already has the JSON form, it is reused for "json".
+  Messages that don't fit a known layout are always stored as JSON objects.
+  """
+  encoding = encoding or settings.REDIS_MESSAGE_ENCODING
+  layout = LAYOUTS_BY_FIELDS.get(frozenset(message))
+
+  if encoding == "json" or layout is None:
+    return encoded_json if encoded_json is not None else dumpb(message)
+
+  row = [layout] + [message[field] for field in MESSAGE_LAYOUTS[layout]]
+  if encoding == "msgpack":
+    return msgpack.packb(row)
+  return dumpb(row)
+
+def decode_stored_message(raw: bytes) -> dict:
+  """
+  Decode a messages list entry whatever encoding it was written with, so lists
+  can hold a mix of formats while a migration is running.
+  """
+  marker = raw[:1]
+  if marker == b"{":
+    return loads(raw)
+
+  if marker == b"[":
+    row = loads(raw)
+  else:
+    if msgpack is None:
+      raise RuntimeError("Found a msgpack encoded message but the msgpack package is not installed")
+    row = msgpack.unpackb(raw)
+
+  return dict(zip(MESSAGE_LAYOUTS[row[0]], row[1:]))
+
+def stored_messages_as_json(raw_messages: Iterable[bytes]) -> List[bytes]:
+  # JSON objects are passed through untouched, compact entries are expanded back into objects
+  return [raw if raw[:1] == b"{" else dumpb(decode_stored_message(raw)) for raw in raw_messages]
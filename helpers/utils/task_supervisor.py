@@ -0,0 +1,114 @@
+from core.settings import settings
+from typing import Awaitable, Callable, Dict, Optional
+from .metrics import Counter, Gauge
+import asyncio
+import random
+import time
+
+# First restart delay of a crashed task, doubled up to TASK_RESTART_BACKOFF_MAX
+INITIAL_BACKOFF_SECONDS = 0.5
+
+class SupervisedTask:
+  def __init__(self, name: str, factory: Callable[[], Awaitable], critical: bool, max_silence: Optional[float]):
+    self.name = name
+    self.factory = factory
+    self.critical = critical  # Readiness fails while it is down
+    self.max_silence = max_silence  # Seconds without a beat() before it counts as stuck, None to only require it running
+    self.state = "starting"  # running, restarting, finished
+    self.restarts = 0
+    self.last_error: Optional[str] = None
+    self.failing_since: Optional[float] = None
+    self.last_beat = time.monotonic()
+    self.task: Optional[asyncio.Task] = None
+
+  def silence(self) -> float:
+    return time.monotonic() - self.last_beat
+
+  def healthy(self) -> bool:
+    if self.state == "finished":
+      return True
+    if self.state != "running":
+      return False
+    return self.max_silence is None or self.silence() <= self.max_silence
+
+class TaskSupervisor:
+  """
+  Runs the background loops of a worker and restarts them with jittered exponential
+  backoff when they raise, so a redis hiccup or a malformed payload doesn't silently end
+  flushing or fan-out on the node. Loops call beat() whenever they make progress; a loop
+  that stops beating for max_silence seconds counts as stuck.
+  """
+
+  def __init__(self):
+    self.tasks: Dict[str, SupervisedTask] = {}
+
+  def start(self, name: str, factory: Callable[[], Awaitable], critical: bool = False, max_silence: Optional[float] = None) -> asyncio.Task:
+    supervised = SupervisedTask(name, factory, critical, max_silence)
+    self.tasks[name] = supervised
+    supervised.task = asyncio.create_task(self.supervise(supervised), name=name)
+    return supervised.task
+
+  def beat(self, name: str):
+    supervised = self.tasks.get(name)
+    if supervised:
+      supervised.last_beat = time.monotonic()
+
+  async def supervise(self, supervised: SupervisedTask):
+    backoff = INITIAL_BACKOFF_SECONDS
+    while True:
+      supervised.state = "running"
+      supervised.last_beat = started = time.monotonic()
+      try:
+        await supervised.factory()
+        # The loops only return when they are done, e.g. on shutdown
+        supervised.state = "finished"
+        return
+      except asyncio.CancelledError:
+        raise
+      except Exception as e:
+        print(f"Error: background task {supervised.name} crashed: {str(e)}")
+        supervised.state = "restarting"
+        supervised.restarts += 1
+        supervised.last_error = str(e)
+        task_restarts.inc(task=supervised.name)
+
+      # A task that ran fine for a while starts over with a short delay
+      if time.monotonic() - started > settings.TASK_RESTART_BACKOFF_MAX:
+        backoff = INITIAL_BACKOFF_SECONDS
+        supervised.failing_since = None
+      if supervised.failing_since is None:
+        supervised.failing_since = time.monotonic()
+      await asyncio.sleep(backoff * random.uniform(0.5, 1.5))
+      backoff = min(backoff * 2, settings.TASK_RESTART_BACKOFF_MAX)
+
+  def report(self) -> Dict[str, dict]:
+    return {
+      name: {
+        "state": supervised.state,
+        "critical": supervised.critical,
+        "healthy": supervised.healthy(),
+        "restarts": supervised.restarts,
+        "last_error": supervised.last_error,
+        "seconds_since_beat": round(supervised.silence(), 1)
+      }
+      for name, supervised in self.tasks.items()
+    }
+
+  def ready(self) -> bool:
+    # Every critical loop is running and beating
+    return all(supervised.healthy() for supervised in self.tasks.values() if supervised.critical)
+
+  def live(self) -> bool:
+    # A critical loop that keeps crashing past the grace period needs a fresh process
+    return not any(
+      supervised.critical and supervised.state == "restarting" and supervised.failing_since is not None
+      and time.monotonic() - supervised.failing_since > settings.LIVENESS_FAILING_GRACE
+      for supervised in self.tasks.values()
+    )
+
+task_supervisor = TaskSupervisor()
+
+task_restarts = Counter("talk_task_restarts_total", "Restarts of crashed background tasks (task_supervisor)")
+Gauge("talk_task_seconds_since_beat", "Seconds since a background task last made progress (task_supervisor)", collect=lambda: {
+  (("task", name),): supervised.silence() for name, supervised in task_supervisor.tasks.items()
+})
@@ -0,0 +1,93 @@
+from bson import ObjectId
+from core.database import db
+from core.redis import redis, unread_counts_key
+from core.settings import settings
+from typing import Dict, Iterable, List, Optional
+
+# Users whose counters changed since they were last copied to mongo
+UNREAD_DIRTY_KEY = "inbox:unread_dirty"
+
+# Set in a counter hash once mongo's counts are merged into it. Increments never wait
+# for that: a hash without it only holds what arrived since it was last loaded.
+LOADED_FIELD = "_loaded"
+
+merge_stored_counts = redis.register_script("""
+if redis.call('HEXISTS', KEYS[1], ARGV[1]) == 1 then
+  return 0
+end
+for i = 2, #ARGV, 2 do
+  redis.call('HINCRBY', KEYS[1], ARGV[i], ARGV[i + 1])
+end
+redis.call('HSET', KEYS[1], ARGV[1], 1)
+return 1
+""")
+
+# A counter read down to zero is removed
+decrement_counter = redis.register_script("""
+local left = redis.call('HINCRBY', KEYS[1], ARGV[1], -tonumber(ARGV[2]))
+if left <= 0 then
+  redis.call('HDEL', KEYS[1], ARGV[1])
+  return 0
+end
+return left
+""")
+
+def unread_for(messages: List[dict], member_ids: Iterable[ObjectId]) -> Dict[ObjectId, int]:
+  # Messages of the batch each member didn't send themselves
+  sent = {}
+  for message in messages:
+    sent[message["sender_id"]] = sent.get(message["sender_id"], 0) + 1
+  counts = {member_id: len(messages) - sent.get(str(member_id), 0) for member_id in member_ids}
+  return {member_id: count for member_id, count in counts.items() if count}
+
+async def count_unread(kind: str, conversation_id: ObjectId, counts: Dict[ObjectId, int]):
+  """
+  Add a committed batch to its recipients' counters, one pipelined HINCRBY per recipient.
+  """
+  if not counts:
+    return
+  async with redis.pipeline(transaction=False) as pipe:
+    for member_id, count in counts.items():
+      pipe.hincrby(unread_counts_key(member_id), f"{kind}:{conversation_id}", count)
+    pipe.sadd(UNREAD_DIRTY_KEY, *[str(member_id) for member_id in counts])
+    await pipe.execute()
+
+async def load_unread_counts(user_id: ObjectId) -> Dict[str, int]:
+  """
+  A user's counters by "chat:{id}" / "group:{id}", the ones at zero left out. A hash that
+  expired or was lost is merged with the counts last copied to mongo first.
+  """
+  key = unread_counts_key(user_id)
+  async with redis.pipeline(transaction=False) as pipe:
+    pipe.hgetall(key)
+    pipe.expire(key, settings.INBOX_INDEX_TTL)
+    counts, _ = await pipe.execute()
+
+  if LOADED_FIELD.encode('utf-8') not in counts:
+    stored = []
+    async for entry in db.inbox.find({"user_id": user_id, "unread_count": {"$gt": 0}}, {"kind": 1, "conversation_id": 1, "unread_count": 1}):
+      stored += [f"{entry['kind']}:{entry['conversation_id']}", entry["unread_count"]]
+    if await merge_stored_counts(keys=[key], args=[LOADED_FIELD, *stored]):
+      # What arrived while the hash was cold isn't in mongo yet
+      await redis.sadd(UNREAD_DIRTY_KEY, str(user_id))
+    await redis.expire(key, settings.INBOX_INDEX_TTL)
+    counts = await redis.hgetall(key)
+
+  return {
+    field.decode('utf-8'): int(count)
+    for field, count in counts.items()
+    if field.decode('utf-8') != LOADED_FIELD and int(count) > 0
+  }
+
+async def mark_read(user_id: ObjectId, kind: str, conversation_id: ObjectId, count: Optional[int] = None):
+  """
+  Reset a counter, or take count messages off it when the client read part of them.
+  """
+  # Loaded first, or the next load would bring back the counts read here from mongo
+  await load_unread_counts(user_id)
+  key = unread_counts_key(user_id)
+  if count is None:
+    await redis.hdel(key, f"{kind}:{conversation_id}")
+  else:
+    await decrement_counter(keys=[key], args=[f"{kind}:{conversation_id}", count])
+  await redis.sadd(UNREAD_DIRTY_KEY, str(user_id))
@@ -0,0 +1,283 @@
+from array import array
+from bisect import bisect_left, insort
+from collections import Counter, OrderedDict
+from itertools import islice
+from typing import Dict, List, Optional
+import asyncio
+import heapq
+
+def normalize_username(username: str) -> str:
+  return username.strip().lower()
+
+def username_trigrams(username: str) -> List[str]:
+  # Pad with two markers on each side so every character takes part in 3 trigrams
+  padded = f"$${username}$$"
+  return [padded[i:i + 3] for i in range(len(padded) - 2)]
+
+def max_edits_for(query: str) -> int:
+  # Same spirit as the Atlas fuzzy matcher: short terms tolerate fewer typos
+  if len(query) <= 2:
+    return 0
+  if len(query) <= 5:
+    return 1
+  return 2
+
+def bounded_edit_distance(a: str, b: str, max_edits: int) -> Optional[int]:
+  """
+  Levenshtein distance between a and b, or None as soon as it is known to exceed max_edits.
+  Only the diagonal band of width 2 * max_edits + 1 of the DP matrix is computed.
+  """
+  if abs(len(a) - len(b)) > max_edits:
+    return None
+
+  too_far = max_edits + 1
+  previous_row = [j if j <= max_edits else too_far for j in range(len(b) + 1)]
+  for i in range(1, len(a) + 1):
+    char_a = a[i - 1]
+    low = max(1, i - max_edits)
+    high = min(len(b), i + max_edits)
+    current_row = [too_far] * (len(b) + 1)
+    current_row[0] = i if i <= max_edits else too_far
+    row_min = current_row[0]
+    for j in range(low, high + 1):
+      cost = previous_row[j - 1] + (char_a != b[j - 1])
+      if previous_row[j] + 1 < cost:
+        cost = previous_row[j] + 1
+      if current_row[j - 1] + 1 < cost:
+        cost = current_row[j - 1] + 1
+      current_row[j] = cost
+      if cost < row_min:
+        row_min = cost
+    if row_min > max_edits:
+      return None
+    previous_row = current_row
+
+  distance = previous_row[-1]
+  return distance if distance <= max_edits else None
+
+class UsernameSearchIndex:
+  """
+  In-process username index used instead of the Atlas `$search` stage.
+
+  Prefix matches come from a sorted list of usernames, typo tolerant matches from a
+  trigram inverted index whose candidates are verified with a bounded edit distance.
+  """
+
+  def __init__(self, query_cache_size: int = 4096):
+    self.ready = False
+    # Documents are addressed by a dense integer so posting lists can be compact arrays
+    self.document_user_ids: List[Optional[str]] = []
+    self.document_usernames: List[str] = []
+    self.user_documents: Dict[str, int] = {}
+    self.sorted_usernames: List[tuple] = []  # [(normalized_username, document)]
+    self.postings: Dict[tuple, array] = {}  # {(trigram, position, username_length): documents}
+    self.query_cache_size = query_cache_size
+    self.query_cache: OrderedDict = OrderedDict()
+    # (user_id, username) added while a build runs, replayed over the built index
+    self.pending_updates: Optional[List[tuple]] = None
+
+  def __len__(self):
+    return len(self.user_documents)
+
+  async def build(self, db, chunk_size: int = 1000):
+    """
+    Load every username from the users collection into a fresh index and swap it in.
+    Built chunk by chunk, yielding to the event loop in between; usernames added
+    meanwhile are replayed over it, the users it read can be older than them.
+    """
+    self.pending_updates = []
+    try:
+      building = UsernameSearchIndex(self.query_cache_size)
+      # Each chunk's prefix entries are sorted on their own and merged at the end, sorting
+      # a million of them at once would hold the loop for seconds
+      runs, chunk = [], []
+      async for db_user in db.users.find({}, {"username": 1}):
+        if db_user.get("username"):
+          chunk.append((str(db_user["_id"]), db_user["username"]))
+        if len(chunk) == chunk_size:
+          runs.append(building.append_chunk(chunk))
+          chunk = []
+          await asyncio.sleep(0)
+      runs.append(building.append_chunk(chunk))
+
+      merged = heapq.merge(*runs)
+      while entries := list(islice(merged, chunk_size * 10)):
+        building.sorted_usernames += entries
+        await asyncio.sleep(0)
+
+      # No await from here on, an update can't slip between the replay and the swap
+      pending_updates, self.pending_updates = self.pending_updates, None
+      self.swap_in(building)
+      for user_id, username in pending_updates:
+        self.add(user_id, username)
+      self.ready = True
+    finally:
+      self.pending_updates = None
+
+  def append_chunk(self, users) -> List[tuple]:
+    # Prefix entries of the chunk, sorted, for build to merge
+    return sorted(
+      (self.document_usernames[document], document)
+      for document in [self.append_document(user_id, username) for user_id, username in users]
+    )
+
+  def swap_in(self, other: "UsernameSearchIndex"):
+    self.document_user_ids = other.document_user_ids
+    self.document_usernames = other.document_usernames
+    self.user_documents = other.user_documents
+    self.sorted_usernames = other.sorted_usernames
+    self.postings = other.postings
+    self.query_cache.clear()
+
+  def clear(self):
+    self.ready = False
+    self.document_user_ids.clear()
+    self.document_usernames.clear()
+    self.user_documents.clear()
+    self.sorted_usernames.clear()
+    self.postings.clear()
+    self.query_cache.clear()
+
+  def add(self, user_id: str, username: str):
+    """Index a new user or replace the username of an existing one."""
+    if self.pending_updates is not None:
+      self.pending_updates.append((user_id, username))
+    self.remove(user_id)
+    document = self.append_document(user_id, username)
+    insort(self.sorted_usernames, (self.document_usernames[document], document))
+    self.query_cache.clear()
+
+  def add_many(self, users):
+    """Bulk load (user_id, username) pairs, sorting the prefix list once at the end."""
+    for user_id, username in users:
+      self.remove(user_id)
+      document = self.append_document(user_id, username)
+      self.sorted_usernames.append((self.document_usernames[document], document))
+    self.sorted_usernames.sort()
+    self.query_cache.clear()
+
+  def append_document(self, user_id: str, username: str) -> int:
+    username = normalize_username(username)
+    document = len(self.document_user_ids)
+    self.document_user_ids.append(user_id)
+    self.document_usernames.append(username)
+    self.user_documents[user_id] = document
+
+    for position, trigram in enumerate(username_trigrams(username)):
+      key = (trigram, position, len(username))
+      if key not in self.postings:
+        self.postings[key] = array("I")
+      self.postings[key].append(document)
+
+    return document
+
+  def remove(self, user_id: str):
+    document = self.user_documents.pop(user_id, None)
+    if document is None:
+      return
+
+    username = self.document_usernames[document]
+    position = bisect_left(self.sorted_usernames, (username, document))
+    if position < len(self.sorted_usernames) and self.sorted_usernames[position] == (username, document):
+      del self.sorted_usernames[position]
+
+    # The posting list entries stay behind as tombstones and are skipped at query time
+    self.document_user_ids[document] = None
+    self.query_cache.clear()
+
+  def search(self, query: str, limit: int = 10) -> List[str]:
+    """
+    Return up to `limit` user ids ordered by exact match, prefix match and then edit distance.
+    """
+    query = normalize_username(query)
+    if not query:
+      return []
+
+    cache_key = (query, limit)
+    if cache_key in self.query_cache:
+      self.query_cache.move_to_end(cache_key)
+      return self.query_cache[cache_key]
+
+    results = self.search_prefix(query, limit)
+    if len(results) < limit:
+      seen = set(results)
+      for document in self.search_fuzzy(query, limit - len(results)):
+        if document not in seen:
+          results.append(document)
+          if len(results) == limit:
+            break
+
+    user_ids = [self.document_user_ids[document] for document in results]
+
+    self.query_cache[cache_key] = user_ids
+    if len(self.query_cache) > self.query_cache_size:
+      self.query_cache.popitem(last=False)
+
+    return user_ids
+
+  def search_prefix(self, query: str, limit: int) -> List[int]:
+    # Exact matches sort first because they are the shortest usernames with this prefix
+    documents = []
+    position = bisect_left(self.sorted_usernames, (query, -1))
+    while position < len(self.sorted_usernames) and len(documents) < limit:
+      username, document = self.sorted_usernames[position]
+      if not username.startswith(query):
+        break
+      documents.append(document)
+      position += 1
+    return documents
+
+  def search_fuzzy(self, query: str, wanted: int) -> List[int]:
+    """
+    Up to `wanted` documents within the edit budget of the query, closest first.
+    Each pass only looks for matches exactly one edit further away than the last,
+    so dense neighbourhoods stop before paying for the wider search.
+    """
+    matches = []
+    for max_edits in range(1, max_edits_for(query) + 1):
+      matches += self.search_at_distance(query, max_edits, wanted - len(matches))
+      if len(matches) >= wanted:
+        break
+
+    matches.sort()
+    return [document for _, _, document in matches]
+
+  def search_at_distance(self, query: str, max_edits: int, wanted: int) -> List[tuple]:
+    # Positional q-gram lemma: every edit destroys at most 3 padded trigrams and shifts
+    # the others by at most one position, so a match shares at least
+    # max(len) + 2 - 3 * max_edits trigrams that sit no further than max_edits positions away
+    # Exact matches are always prefix matches, so every pass only keeps its outermost ring
+    query_trigrams = username_trigrams(query)
+    matches = []
+
+    lengths = sorted(
+      range(max(1, len(query) - max_edits), len(query) + max_edits + 1),
+      key=lambda length: abs(length - len(query))
+    )
+    for length in lengths:
+      posting_keys = {
+        (trigram, shifted_position, length)
+        for position, trigram in enumerate(query_trigrams)
+        for shifted_position in range(max(0, position - max_edits), position + max_edits + 1)
+      }
+      shared_counts = Counter()
+      for key in posting_keys:
+        postings = self.postings.get(key)
+        if postings:
+          shared_counts.update(postings)
+
+      min_shared = max(len(query), length) + 2 - 3 * max_edits
+      candidates = [document for document, shared in shared_counts.items() if shared >= min_shared]
+      for document in candidates:
+        if self.document_user_ids[document] is None:
+          continue
+        username = self.document_usernames[document]
+        distance = bounded_edit_distance(query, username, max_edits)
+        if distance == max_edits:
+          matches.append((distance, username, document))
+          if len(matches) == wanted:
+            return matches
+
+    return matches
+
+username_search_index = UsernameSearchIndex()
@@ -1,29 +1,75 @@
 from fastapi import WebSocket, WebSocketDisconnect
 from starlette.websockets import WebSocketState
-from typing import Dict, List
-import json
+from core.settings import settings
+from typing import Dict, List, Optional, Union
+from .json_codec import dumps
+from .metrics import Gauge, broadcast_duration, broadcast_recipients, socket_flush_duration, socket_frame_events, socket_drops
+from .delivery_trace import finish_traces
+from functools import lru_cache
+import asyncio
+import random
+import time
+import zlib
+
+# Values of the "encoding" query param a socket can connect with
+FRAME_ENCODINGS = ("text", "binary", "deflate")
+
+def stream_id_tuple(event_id: str) -> tuple:
+  # Redis stream ids are "<milliseconds>-<sequence>" and compare numerically part by part
+  milliseconds, sequence = event_id.split("-")
+  return int(milliseconds), int(sequence)
+
+@lru_cache(maxsize=256)
+def deflate(text: str) -> bytes:
+  # Raw deflate (no zlib header) so browsers can read it with DecompressionStream("deflate-raw").
+  # Recipients of a conversation mostly get identical frames, each is compressed once
+  compressor = zlib.compressobj(wbits=-15)
+  return compressor.compress(text.encode('utf-8')) + compressor.flush()
 
 class ConnectionManager:
   def __init__(self):
-    # Dictionary to store active connections: {chat_id: [{websocket_id, websocket_obj}]}
+    # Dictionary to store active connections: {chat_id: [{websocket_id, websocket_obj, last_event_id, replaying, pending, outbox, ...}]}
     self.active_connections: Dict[str, List[Dict]] = {}
+    self.draining = False  # Set on shutdown, new sockets are sent elsewhere right away
 
-  async def connect(self, websocket: WebSocket, chat_or_group_id: str, websocket_id: str):
+  async def connect(self, websocket: WebSocket, chat_or_group_id: str, websocket_id: str, replaying: bool = False) -> Optional[Dict]:
+    """
+    Accept a WebSocket and register it. A connection registered with replaying=True
+    buffers live events until finish_replay() so missed events can be sent first.
+    Clients choose their frames with the query params coalesce=1 (events that queue up
+    together arrive as one JSON array) and encoding=text|binary|deflate. While the worker
+    drains for shutdown the socket gets a reconnect frame and None is returned.
+    """
     try:
       # Accept the WebSocket connection
       await websocket.accept()
 
+      if self.draining:
+        await self.send_elsewhere(websocket, 1012, "Server restarting")
+        return None
+
       # Initialize the connection list if this is the first connection for the chat_id
       if chat_or_group_id not in self.active_connections:
         self.active_connections[chat_or_group_id] = []
 
       # Append the connection details to active connections
-      self.active_connections[chat_or_group_id].append({
+      connection = {
         "id": websocket_id,
-        "websocket_obj": websocket
-      })
+        "websocket_obj": websocket,
+        "last_event_id": None,
+        "replaying": replaying,
+        "pending": [],
+        "outbox": [],  # (event text, delivery trace) waiting for the next frame
+        "flushing": False,
+        "flush_task": None,
+        "dropped": False,
+        "coalesce": websocket.query_params.get('coalesce') == '1',
+        "encoding": websocket.query_params.get('encoding') if websocket.query_params.get('encoding') in FRAME_ENCODINGS else "text"
+      }
+      self.active_connections[chat_or_group_id].append(connection)
+      return connection
     except Exception:
-      pass
+      return None
 
   def disconnect(self, chat_or_group_id: str, websocket_id: str):
     """
@@ -40,24 +86,154 @@ class ConnectionManager:
       else:
         del self.active_connections[chat_or_group_id]
 
-  async def broadcast(self, chat_or_group_id: str, message: dict):
+  def is_new_event(self, connection: Dict, event_id: Optional[str]) -> bool:
+    if event_id is None or connection["last_event_id"] is None:
+      return True
+    return stream_id_tuple(event_id) > stream_id_tuple(connection["last_event_id"])
+
+  def queue_event(self, chat_or_group_id: str, connection: Dict, text: str, event_id: Optional[str] = None, trace: Optional[Dict] = None):
+    """
+    Add an event to the connection's next frame. Events queued while a frame is being
+    written, or within OUTBOUND_COALESCE_WINDOW_MS, go out together.
+    """
+    if connection["dropped"] or not self.is_new_event(connection, event_id):
+      return
+    if len(connection["outbox"]) >= settings.OUTBOUND_MAX_QUEUED_EVENTS:
+      self.drop(chat_or_group_id, connection, 1013, "Too far behind")
+      return
+    connection["outbox"].append((text, trace))
+    if event_id is not None:
+      connection["last_event_id"] = event_id
+    if not connection["flushing"]:
+      connection["flushing"] = True
+      # Kept on the connection so the task isn't collected while it runs and drain() can wait for it
+      connection["flush_task"] = asyncio.create_task(self.flush(chat_or_group_id, connection))
+
+  async def flush(self, chat_or_group_id: str, connection: Dict):
+    if settings.OUTBOUND_COALESCE_WINDOW_MS:
+      await asyncio.sleep(settings.OUTBOUND_COALESCE_WINDOW_MS / 1000)
+    try:
+      while connection["outbox"]:
+        events, connection["outbox"] = connection["outbox"], []
+        socket_frame_events.observe(len(events))
+        started = time.perf_counter()
+        await self.send_frames(connection, [text for text, _ in events])
+        finished = time.perf_counter()
+        socket_flush_duration.observe(finished - started)
+        finish_traces([trace for _, trace in events if trace], started, finished, chat_or_group_id, connection['id'])
+    except WebSocketDisconnect:
+      # If disconnected during send, clean up the connection
+      self.disconnect(chat_or_group_id, connection['id'])
+    except Exception:
+      self.drop(chat_or_group_id, connection, 1011, "Send failed")
+    finally:
+      connection["flushing"] = False
+
+  def drop(self, chat_or_group_id: str, connection: Dict, code: int, reason: str):
+    """
+    Unregister a connection whose events can't be delivered and close its socket. Its
+    last_event_id already points past what was queued, so nothing is kept for it: the
+    client reconnects and replays from the lastEventId it actually has.
+    """
+    if connection["dropped"]:
+      return
+    connection["dropped"] = True
+    connection["outbox"].clear()
+    connection["pending"] = []
+    self.disconnect(chat_or_group_id, connection['id'])
+    socket_drops.inc()
+    connection["close_task"] = asyncio.create_task(self.close_socket(connection['websocket_obj'], code, reason))
+
+  async def close_socket(self, websocket: WebSocket, code: int, reason: str):
+    try:
+      await websocket.close(code=code, reason=reason)
+    except Exception:
+      pass  # Already closed by the client
+
+  async def send_frames(self, connection: Dict, texts: List[str]):
+    websocket = connection['websocket_obj']
+    # Events are JSON objects already, an array frame is only their concatenation
+    frames = [f"[{','.join(texts)}]"] if connection["coalesce"] and len(texts) > 1 else texts
+
+    for text in frames:
+      if connection["encoding"] == "deflate" and len(text) >= settings.OUTBOUND_DEFLATE_MIN_BYTES:
+        await websocket.send_bytes(deflate(text))
+      elif connection["encoding"] == "binary":
+        await websocket.send_bytes(text.encode('utf-8'))
+      else:
+        # Small frames of deflate connections stay text, so frame type tells them apart
+        await websocket.send_text(text)
+
+  def finish_replay(self, chat_or_group_id: str, connection: Dict):
+    # Queue what arrived live during the replay behind the replayed events, then switch
+    # the connection back to direct delivery
+    for event_id, text, trace in connection["pending"]:
+      self.queue_event(chat_or_group_id, connection, text, event_id, trace)
+    connection["pending"] = []
+    connection["replaying"] = False
+
+  async def broadcast(self, chat_or_group_id: str, message: Union[dict, str], event_id: Optional[str] = None, trace: Optional[Dict] = None):
     """
-    Send a message to all connected WebSockets for a given chat ID.
+    Queue a message for all connected WebSockets for a given chat ID.
+    The message is encoded once, not once per recipient; JSON text is sent as is.
+    Connections that already received event_id (e.g. through a replay) are skipped.
+    Writes happen in per-connection flush tasks, a slow recipient doesn't hold up the rest.
+    A delivery trace passed along is finished once the event is written to each socket.
     """
     if chat_or_group_id in self.active_connections:
+      started = time.perf_counter()
+      broadcast_recipients.observe(len(self.active_connections[chat_or_group_id]))
+      text = message if isinstance(message, str) else dumps(message)
       for connection in self.active_connections[chat_or_group_id][:]:  # Copy list to safely remove disconnected websockets
-        websocket = connection['websocket_obj']
-        try:
-          # Only send if WebSocket is connected
-          if websocket.client_state == WebSocketState.CONNECTED:
-            await websocket.send_text(json.dumps(message))
-          else:
-            # Remove the connection if it's no longer connected
-            self.disconnect(chat_or_group_id, connection['id'])
-        except WebSocketDisconnect:
-          # If disconnected during send, clean up the connection
+        if connection["replaying"]:
+          if len(connection["pending"]) >= settings.OUTBOUND_MAX_QUEUED_EVENTS:
+            self.drop(chat_or_group_id, connection, 1013, "Too far behind")
+            continue
+          connection["pending"].append((event_id, text, trace))
+        # Only send if WebSocket is connected
+        elif connection['websocket_obj'].client_state == WebSocketState.CONNECTED:
+          self.queue_event(chat_or_group_id, connection, text, event_id, trace)
+        else:
+          # Remove the connection if it's no longer connected
           self.disconnect(chat_or_group_id, connection['id'])
-        except Exception:
-          pass
+      broadcast_duration.observe(time.perf_counter() - started)
+
+  async def send_elsewhere(self, websocket: WebSocket, code: int, reason: str, accepted: bool = True):
+    # Close with a reconnect frame, so the client waits its jittered delay before retrying
+    if not accepted:
+      await websocket.accept()
+    await websocket.send_text(self.reconnect_frame())
+    await websocket.close(code=code, reason=reason)
+
+  def reconnect_frame(self) -> str:
+    # Every socket gets its own delay, so a deploy doesn't bring all clients back at once
+    retry_after_ms = random.randint(settings.SHUTDOWN_RECONNECT_MIN_MS, settings.SHUTDOWN_RECONNECT_MAX_MS)
+    return dumps({"action": "reconnect", "retry_after_ms": retry_after_ms})
+
+  async def drain(self, timeout: float):
+    """
+    Send every socket a reconnect frame behind the events it has queued, then close it
+    with 1012 (service restart). Stops waiting for slow sockets after timeout seconds.
+    """
+    self.draining = True
+    connections = [
+      (chat_or_group_id, connection)
+      for chat_or_group_id, chat_connections in self.active_connections.items()
+      for connection in chat_connections
+    ]
+    for chat_or_group_id, connection in connections:
+      # Events held back for a replay go out first, the client would lose them otherwise
+      self.finish_replay(chat_or_group_id, connection)
+      self.queue_event(chat_or_group_id, connection, self.reconnect_frame())
+
+    flush_tasks = [connection["flush_task"] for _, connection in connections if connection["flushing"]]
+    if flush_tasks:
+      await asyncio.wait(flush_tasks, timeout=timeout)
+
+    for _, connection in connections:
+      await self.close_socket(connection['websocket_obj'], 1012, "Server restarting")
 
 websocket_connection_manager = ConnectionManager()
+
+Gauge("talk_active_sockets", "Sockets connected to this worker", collect=lambda: {(): sum(len(connections) for connections in websocket_connection_manager.active_connections.values())})
+Gauge("talk_active_conversations", "Conversations with a socket on this worker", collect=lambda: {(): len(websocket_connection_manager.active_connections)})
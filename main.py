@@ -1,13 +1,26 @@
+import argparse
 import uvicorn
 import logging
-from routes.main import app
+from core.settings import settings
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 if __name__ == "__main__":
-  host = "0.0.0.0"
-  port = 8000
-  logger.info(f"Starting server at http://{host}:{port}")
-  uvicorn.run(app, host=host, port=port)
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--host", default="0.0.0.0")
+  parser.add_argument("--port", type=int, default=8000)
+  parser.add_argument("--workers", type=int, default=settings.WEB_CONCURRENCY)
+  args = parser.parse_args()
+
+  logger.info(f"Starting server at http://{args.host}:{args.port} with {args.workers} worker(s)")
+  # The app is passed as an import string so every worker process imports it, and with
+  # it creates its own redis and mongo clients and runs its own startup hooks
+  uvicorn.run(
+    "routes.main:app",
+    host=args.host,
+    port=args.port,
+    workers=args.workers,
+    ws_per_message_deflate=settings.WEBSOCKET_PER_MESSAGE_DEFLATE
+  )
@@ -1,18 +1,27 @@
 from bson import ObjectId
 from schemas.calls.call_schema import SignalingMessage
 from fastapi import APIRouter, WebSocket, WebSocketDisconnect
-from helpers.utils.websocket_connection_manager import websocket_connection_manager
-from helpers.utils.redis_pubsub_connection_manager import generate_websocket_id
-from helpers.utils.redis_pubsub import publish_message
+from pydantic import ValidationError
+from helpers.utils.redis_pubsub import call_channel_subscriber
+from helpers.utils.call_signaling import CALL_TYPES, call_connections, publish_signal, get_call_session, ring, answer, keep_call_alive, end_call, takes_part
+from helpers.utils.ingest_queue import send_frame_error
+from helpers.utils.json_codec import dumps, dumpb
 from helpers.middleware.authentication import validate_token_for_websockets
-from fastapi import APIRouter
 from core.database import db
-import json
+from core.settings import settings
+from uuid import uuid4
+import asyncio
 
 router = APIRouter()
 
-@router.websocket("/call/{call_type}/{chat_id}")
-async def websocket_endpoint(websocket: WebSocket, call_type: str, chat_id: str):
+async def keep_alive(chat_id: ObjectId):
+  # The answering socket keeps the call session from expiring while the call lasts
+  while True:
+    await asyncio.sleep(settings.CALL_SESSION_TTL / 3)
+    await keep_call_alive(chat_id)
+
+@router.websocket("/{call_type}/{chat_id}")
+async def websocket_call_endpoint(websocket: WebSocket, call_type: str, chat_id: str):
   auth_token = websocket.query_params.get('authToken')
   user_id = await validate_token_for_websockets(websocket, auth_token)
 
@@ -20,26 +29,73 @@ async def websocket_endpoint(websocket: WebSocket, call_type: str, chat_id: str)
     await websocket.close(code=4000, reason="Invalid token")
     return
 
+  if call_type not in CALL_TYPES:
+    await websocket.close(code=4000, reason="Unknown call type")
+    return
+
   chat_id = ObjectId(chat_id)
 
-  chat = await db.chats.find_one({"_id": chat_id})
+  # Only the two participants of the chat can call each other
+  chat = await db.chats.find_one({"_id": chat_id, "participants": user_id}, {"participants": 1})
 
   if not chat:
-    await websocket.close(code=4000, reason="Chat not found")
+    await websocket.close(code=4000, reason="Chat not found or user is not in the chat")
     return
 
-  websocket_id = generate_websocket_id()
-  await websocket_connection_manager.connect(websocket, str(chat_id), websocket_id)
+  peer_id = next(participant_id for participant_id in chat['participants'] if participant_id != user_id)
+
+  await websocket.accept()
+  websocket_id = str(uuid4())
+  call_connections.add(str(user_id), websocket_id, websocket)
+  await call_channel_subscriber.follow(str(user_id))
+  keeper = None
 
   try:
+    # A device joining late (e.g. to pick up a ringing call) learns the call's state
+    session = await get_call_session(chat_id)
+    if session:
+      await websocket.send_text(dumps({"type": "session", "data": session}))
+
     while True:
-      data = json.loads(await websocket.receive_text())
-      signaling_message = SignalingMessage.parse_raw(data)
+      frame = await websocket.receive_text()
+
+      try:
+        signal = SignalingMessage.model_validate_json(frame)
+      except ValidationError:
+        await send_frame_error(websocket, "Invalid signaling frame")
+        continue
+
+      if signal.type == "offer":
+        await ring(chat_id, user_id, peer_id, call_type, websocket_id)
+      elif signal.type == "answer":
+        await answer(chat_id, websocket_id)
+        if keeper is None:
+          keeper = asyncio.create_task(keep_alive(chat_id))
+      elif signal.type in ("reject", "hangup"):
+        await end_call(chat_id)
+
+      # Relayed to the peer's call sockets only, nothing of it is stored
+      await publish_signal(peer_id, dumpb({
+        "type": signal.type,
+        "data": signal.data,
+        "from": user_id,
+        "chat_id": chat_id,
+        "call_type": call_type
+      }))
 
-      # Publish the signaling message to Redis
-      await publish_message(chat_id, signaling_message.dict())
   except WebSocketDisconnect:
-    await websocket_connection_manager.disconnect(websocket, chat_id)
+    pass
   except Exception as e:
     print(f"Unexpected error: {e}")
     await websocket.close(code=1011, reason=str(e))
+  finally:
+    call_connections.remove(str(user_id), websocket_id)
+    if keeper:
+      keeper.cancel()
+
+    # The call ends with the socket of either side that took part in it, the peer is told
+    # so it doesn't wait on a dead connection
+    session = await get_call_session(chat_id)
+    if takes_part(session, websocket_id):
+      await end_call(chat_id)
+      await publish_signal(peer_id, dumpb({"type": "hangup", "data": {}, "from": user_id, "chat_id": chat_id, "call_type": call_type}))
@@ -1,99 +1,114 @@
 from fastapi import APIRouter, WebSocket, WebSocketDisconnect
 from helpers.utils.websocket_connection_manager import websocket_connection_manager
-from helpers.utils.redis_pubsub import publish_message
+from helpers.utils.redis_pubsub import publish_message, event_stream_key, conversation_event_reader, get_resume_position, replay_conversation_events
 from helpers.middleware.authentication import validate_token, validate_token_for_websockets
-from helpers.utils.convert_to_json_serializeble_object import convert_to_json_serializeble_object
+from helpers.utils.json_codec import JSONCodecResponse, raw_json_array_response, loads
+from helpers.utils.stored_message_codec import encode_stored_message, decode_stored_message, stored_messages_as_json
+from helpers.utils.message_archive import fetch_latest_bucket
+from helpers.utils.ingest_queue import ConnectionIngestQueue, send_frame_error
+from helpers.utils.session_resume import issue_resume_token, read_resume_token, session_frame, full_connect_limiter
 from motor.motor_asyncio import AsyncIOMotorDatabase
 from fastapi import APIRouter, Depends, HTTPException
 from fastapi.responses import JSONResponse
-from core.database import get_db, db
-from core.redis import redis
+from core.database import get_db, db, archive_db
+from core.redis import redis, messages_key, unseen_flag_key
+from helpers.utils.cleanup_jobs import enqueue_cleanup
+from helpers.utils.inbox import add_chat_to_inboxes, set_last_message, touch_chat, index_conversation, unindex_conversation
+from helpers.utils.unread_counters import mark_read
 from bson import ObjectId
 from datetime import datetime
-import json
 from uuid import uuid4
+import asyncio
 
 router = APIRouter()
 
-async def get_message_sequence_plus_one(chat_id: str) -> int:
-  redis_key = f"chat:{chat_id}:messages"
-  last_message = await redis.lindex(redis_key, -1)  # Get the last message
-  if last_message:
-    last_message = json.loads(last_message)
-    return last_message['message_sequence'] + 1
-  else:
-    return 0  # If no messages exist, start with sequence 0
-
 @router.websocket("/continue-chat/{chat_id}")
 async def websocket_chat_endpoint(websocket: WebSocket, chat_id: str):
-  auth_token = websocket.query_params.get('authToken')
-  user_id = await validate_token_for_websockets(websocket, auth_token)
+  chat_id = ObjectId(chat_id)
 
-  if user_id is None:
-    await websocket.close(code=4000, reason="Invalid token")
-    return
+  # A resume token from the previous socket stands in for the token check and the chat
+  # lookup, reconnect waves after a deploy don't reach mongo
+  session = read_resume_token(websocket.query_params.get('resumeToken'), chat_id, False)
+  if session:
+    user_id, participant_id, auth_time = session["user_id"], session["participant_id"], session["auth_time"]
+  else:
+    auth_time = None
+    if not full_connect_limiter.admit():
+      await websocket_connection_manager.send_elsewhere(websocket, 1013, "Try again later", accepted=False)
+      return
 
-  chat_id = ObjectId(chat_id)
+    auth_token = websocket.query_params.get('authToken')
+    user_id = await validate_token_for_websockets(websocket, auth_token)
+
+    if user_id is None:
+      await websocket.close(code=4000, reason="Invalid token")
+      return
 
-  chat = await db.chats.find_one({"_id": chat_id}) # checks if the chat is in the database or not
-  participant_id = next(participant_id for participant_id in chat['participants'] if participant_id != user_id)
+    chat = await db.chats.find_one({"_id": chat_id}) # checks if the chat is in the database or not
 
-  if not chat or (user_id and participant_id not in chat['participants']):
-    await websocket.close(code=4000, reason="Chat not found or user is not in the chat")
-    return
+    if not chat or user_id not in chat['participants']:
+      await websocket.close(code=4000, reason="Chat not found or user is not in the chat")
+      return
+
+    participant_id = next(participant_id for participant_id in chat['participants'] if participant_id != user_id)
 
   websocket_id = str(uuid4())
+  last_event_id, last_message_sequence = get_resume_position(websocket)
+  resuming = last_event_id is not None or last_message_sequence is not None
 
-  await websocket_connection_manager.connect(websocket, str(chat_id), websocket_id)
+  connection = await websocket_connection_manager.connect(websocket, str(chat_id), websocket_id, replaying=resuming)
+  if connection is None:
+    return  # The accept failed or the worker is shutting down and sent the client elsewhere
+  await conversation_event_reader.follow(event_stream_key(chat_id))
+  websocket_connection_manager.queue_event(str(chat_id), connection, session_frame(issue_resume_token(user_id, chat_id, False, participant_id, auth_time), auth_time))
 
-  try:
-    while True:
-      data = json.loads(await websocket.receive_text())
-
-      # Handle new message creation
-      message_data = {
-        "id": data['id'],
-        "sender_id": str(user_id),
-        "reply_to_id": data['reply_to_id'] if data['reply_to_id'] else None,
-        "reply_to_content": data['reply_to_content'] if data['reply_to_content'] else None,
-        "content": data['content'],
-        "message_sequence": await get_message_sequence_plus_one(str(chat_id)),
-        "seen": False,
-        "seen_timestamp": None,
-        "action": data['action'],
-        "created_at": data['created_at'],
-      }
+  async def update_last_message(messages: list):
+    # Runs once per committed batch: the newest message goes to both participants' inbox
+    # entries in one write, then their inbox indexes and unread counters
+    await touch_chat(chat_id, [user_id, participant_id], messages)
 
-      await redis.rpush(f"chat:{chat_id}:messages", json.dumps(message_data))
-      await publish_message(chat_id, message_data)
+  # Frames are parsed here and persisted by a worker, a slow redis or mongo never stalls the socket
+  ingest_queue = ConnectionIngestQueue(websocket, websocket_id, chat_id, False, after_commit=update_last_message)
+  ingest_queue.start()
 
-      last_message_data = {
-        "content": data['content'],
-        "sent_by": str(user_id),
-        "created_at": data['created_at']
-      }
+  try:
+    # A reconnecting client only gets the events it missed instead of refetching the history
+    if connection and resuming:
+      await replay_conversation_events(websocket, connection, event_stream_key(chat_id), last_event_id, last_message_sequence)
 
-      # Update for the user who sent the message
-      await db.users.update_one(
-        {"_id": user_id, "inbox.chats.chat_id": chat_id},
-        {"$set": {
-          "inbox.chats.$.last_message": last_message_data
-        }}
-      )
+    while True:
+      frame = await websocket.receive_text()
+
+      try:
+        data = loads(frame)
+
+        # Handle new message creation
+        message_data = {
+          "id": data['id'],
+          "sender_id": str(user_id),
+          "reply_to_id": data['reply_to_id'] if data['reply_to_id'] else None,
+          "reply_to_content": data['reply_to_content'] if data['reply_to_content'] else None,
+          "content": data['content'],
+          "message_sequence": None, # assigned when the ingest batch is committed
+          "seen": False,
+          "seen_timestamp": None,
+          "action": data['action'],
+          "created_at": data['created_at'],
+        }
+      except (ValueError, KeyError, TypeError):
+        await send_frame_error(websocket, "Invalid message frame")
+        continue
 
-      # Update for the participant receiving the message
-      await db.users.update_one(
-        {"_id": participant_id, "inbox.chats.chat_id": chat_id},
-        {"$set": {
-          "inbox.chats.$.last_message": last_message_data
-        }}
-      )
+      # Refused with a backpressure frame when the worker is too far behind
+      await ingest_queue.offer(message_data)
 
   except WebSocketDisconnect:
-    websocket_connection_manager.disconnect(websocket, chat_id)
+    websocket_connection_manager.disconnect(str(chat_id), websocket_id)
   except Exception as e:
     print(f"Unexpected error: {e}")
     await websocket.close(code=1011, reason=str(e))
+  finally:
+    ingest_queue.close()
 
 @router.post("/mark-as-seen/{chat_id}/{seen_timestamp}")
 async def mark_as_seen(
@@ -111,17 +126,17 @@ async def mark_as_seen(
     if not chat:
       return JSONResponse(status_code=404, content={"error": "Chat not found or Unauthorized"})
 
-    redis_chat_key = f"chat:{chat_id}:messages"
-    unseen_flag_key = f"chat:{chat_id}:unseen_in_mongo"
+    redis_chat_key = messages_key(chat_id)
+    unseen_key = unseen_flag_key(chat_id)
 
     # Step 1: Check for unseen_in_mongo flag, update MongoDB if it’s set
-    if await redis.exists(unseen_flag_key):
+    if await redis.exists(unseen_key):
       await db.messages.update_many(
         {
           "chat_id": chat_id,
           "messages": {
             "$elemMatch": {
-              "sender_id": {"$ne": user_id},
+              "sender_id": {"$ne": str(user_id)},
               "seen": False
             }
           }
@@ -132,24 +147,27 @@ async def mark_as_seen(
             "messages.$[msg].seen_timestamp": seen_timestamp
           }
         },
-        array_filters=[{"msg.sender_id": {"$ne": user_id}, "msg.seen": False}]
+        array_filters=[{"msg.sender_id": {"$ne": str(user_id)}, "msg.seen": False}]
       )
       # Clear the unseen flag
-      await redis.delete(unseen_flag_key)
+      await redis.delete(unseen_key)
 
     # Step 2: Update Redis messages as seen
     messages_in_redis = await redis.lrange(redis_chat_key, 0, -1)
 
     for index, msg in enumerate(messages_in_redis):
-      message_data = json.loads(msg)
+      message_data = decode_stored_message(msg)
       if (
-        message_data["sender_id"] != user_id and
+        message_data["sender_id"] != str(user_id) and
         not message_data.get("seen", False)
       ):
         # Update message as seen
         message_data["seen"] = True
         message_data["seen_timestamp"] = seen_timestamp
-        await redis.lset(redis_chat_key, index, json.dumps(message_data))
+        await redis.lset(redis_chat_key, index, encode_stored_message(message_data))
+
+    # The chat's badge is cleared with the messages
+    await mark_read(user_id, "chat", ObjectId(chat_id))
 
     # Optionally broadcast the seen event if needed
     await publish_message(
@@ -177,62 +195,30 @@ async def create_chat(
   if participant_id == user_id:
     return JSONResponse(status_code=400, content={"error": "Participant ID cannot be the same as user ID"})
 
-  # Validate if the participants are actual users
-  validate_participant = await db.users.find_one({"_id": participant_id})
+  # The three lookups don't depend on each other, they go out together
+  validate_participant, has_user_deleted_chat, does_chat_exist = await asyncio.gather(
+    # Validate if the participants are actual users
+    db.users.find_one({"_id": participant_id}, {"_id": 1}),
+    # Check if the user has deleted the chat with the specific participant_id
+    db.inbox.find_one({"user_id": user_id, "participant_id": participant_id, "deleted": True}, {"conversation_id": 1}),
+    db.chats.find_one({"participants": {"$all": [user_id, participant_id]}}, {"_id": 1})
+  )
 
   # validate participant and return error if not successfull
   if not validate_participant:
     return JSONResponse(status_code=400, content={"error": "Participant is not a valid user"})
 
-  # Check if the user has deleted the chat with the specific participant_id
-  has_user_deleted_chat = await db.users.find_one(
-    {
-      "_id": user_id,
-      "inbox.chats": {
-        "$elemMatch": {
-          "participant_id": participant_id,
-          "deleted": True
-        }
-      }
-    }
-  )
-
   try:
     if has_user_deleted_chat: # we check if the chat is already created and is also deleted or not
-      '''
-      e.g:
-      inbox: {
-        chats: [ this is what the chat object looks like and we can get the chat object using the participant_id and than easily get the chat_id also from it
-          {
-            chat_id
-            participant_id
-            deleted: true or the field is not present at all
-          },
-          {
-            chat_id
-            participant_id
-            deleted: true or the field is not present at all
-          },
-          ...
-        ]
-      }
-      '''
-
-      await db.users.update_one( # remove the deleted mark from the current user chat object in chats array which is in the inbox object
-        {
-          "_id": user_id,
-          "inbox.chats.participant_id": participant_id
-        },
-        {
-          "$unset": {"inbox.chats.$.deleted": ""}
-        }
+      await db.inbox.update_one( # remove the deleted mark from the current user's inbox entry of the chat
+        {"_id": has_user_deleted_chat["_id"]},
+        {"$unset": {"deleted": ""}}
       )
+      await index_conversation([user_id], "chat", has_user_deleted_chat["conversation_id"])
 
       return JSONResponse(status_code=200, content={"success": "User added in chat successfully"})
 
     else: # if the current user hasn't deleted the chat than this else block will be run
-      does_chat_exist = await db.chats.find_one({"participants": {"$all": [user_id, participant_id]}})
-
       if does_chat_exist:
         # Ensure the '_id' is retrieved properly
         return JSONResponse(status_code=409, content={"chat_id": str(does_chat_exist["_id"])})
@@ -243,29 +229,8 @@ async def create_chat(
         "created_at": datetime.utcnow().isoformat()
       })
 
-      # Add chat to user A inbox.chats array
-      await db.users.update_one(
-        {"_id": user_id},
-        {"$addToSet": {
-            "inbox.chats": {
-              "chat_id": new_chat.inserted_id,
-              "participant_id": participant_id
-            }
-          }
-        }
-      )
-
-      # Add chat to participant B inbox.chats array
-      await db.users.update_one(
-        {"_id": participant_id},
-        {"$addToSet": {
-            "inbox.chats": {
-              "chat_id": new_chat.inserted_id,
-              "participant_id": user_id
-            }
-          }
-        }
-      )
+      # Add the chat to both inboxes in one round trip
+      await add_chat_to_inboxes(new_chat.inserted_id, user_id, participant_id)
 
       return JSONResponse(status_code=201, content={"success": str(new_chat.inserted_id)})
 
@@ -285,7 +250,7 @@ async def unsend_recent_message(
 ):
   try:
     chat_id = ObjectId(chat_id)
-    chat_key = f"chat:{chat_id}:messages"
+    chat_key = messages_key(chat_id)
 
     # Fetch all messages in the chat
     messages = await redis.lrange(chat_key, 0, -1)
@@ -297,7 +262,7 @@ async def unsend_recent_message(
     # Collect updates to be made
     updates = []
     for index, message in enumerate(messages):
-      message_data = json.loads(message)
+      message_data = decode_stored_message(message)
 
       if message_data['id'] == message_id and message_data['sender_id'] == str(user_id):
         # Mark the message for deletion
@@ -306,7 +271,7 @@ async def unsend_recent_message(
         # Update reply_to_id and reply_to_content to None
         message_data['reply_to_id'] = None
         message_data['reply_to_content'] = None
-        updates.append((index, json.dumps(message_data)))
+        updates.append((index, encode_stored_message(message_data)))
 
     # Apply updates
     for index, new_message in updates:
@@ -329,20 +294,12 @@ async def unsend_recent_message(
       await publish_message(chat_id, message_deletion_data)
 
       # If we successfully removed the message, proceed with MongoDB updates
-      chat_data = await db.chats.find_one({"_id": chat_id})
-
-      # Get the participant other than the user who sent the message
-      participant_id = next((participant for participant in chat_data['participants'] if participant != ObjectId(user_id)), None)
-
-      if participant_id is None:
-        return JSONResponse(status_code=404, content={"error": "Participant not found"})
-
       # Fetch all messages in the chat
       messages = await redis.lrange(chat_key, 0, -1)
 
       # Update last message in MongoDB (for both sender and recipient)
       if len(messages) >= 1:
-        last_message_data = json.loads(messages[-1])  # Parse the second last message as the new "last message"
+        last_message_data = decode_stored_message(messages[-1])  # Parse the second last message as the new "last message"
         last_message_update = {
           "content": last_message_data['content'],
           "sent_by": last_message_data['sender_id'],
@@ -352,21 +309,8 @@ async def unsend_recent_message(
         # No more messages left in the chat after deletion
         last_message_update = {"content": "", "sent_by": "", "created_at": None}
 
-      # Update the last message for the user who sent the message
-      await db.users.update_one(
-        {"_id": ObjectId(user_id), "inbox.chats.chat_id": chat_id},
-        {"$set": {
-          "inbox.chats.$.last_message": last_message_update
-        }}
-      )
-
-      # Update the last message for the participant
-      await db.users.update_one(
-        {"_id": participant_id, "inbox.chats.chat_id": chat_id},
-        {"$set": {
-          "inbox.chats.$.last_message": last_message_update
-        }}
-      )
+      # Update the last message for both participants, the chat keeps its place in their inboxes
+      await set_last_message(chat_id, last_message_update, touch=False)
 
       return JSONResponse(status_code=200, content={"success": "Message unsent successfully from redis"})
     else:
@@ -459,14 +403,24 @@ async def fetch_recent_chat(
       return JSONResponse(status_code=401, content={"error": "Unauthorized"})
 
     # Fetch messages from Redis
-    redis_key = f"chat:{chat_id}:messages"
+    redis_key = messages_key(chat_id)
     messages = await redis.lrange(redis_key, 0, -1)
-    messages = [json.loads(message) for message in messages]
 
-    if not messages:  # Check if the messages list is empty
-      return JSONResponse(status_code=404, content={"error": "No messages found"})
+    if not messages:
+      # Idle conversations are archived out of redis, serve their newest mongo bucket instead
+      latest_bucket = await fetch_latest_bucket(str(chat_id), False)
+
+      if not latest_bucket:  # Check if the conversation has no messages at all
+        return JSONResponse(status_code=404, content={"error": "No messages found"})
 
-    return JSONResponse(status_code=200, content={"messages": messages})
+      return JSONCodecResponse(status_code=200, content={
+        "messages": latest_bucket["messages"],
+        "message_bucket_sequence": latest_bucket["message_bucket_sequence"],
+        "from_archive": True
+      })
+
+    # JSON list items are spliced into the body as is, only compact ones get expanded
+    return raw_json_array_response("messages", stored_messages_as_json(messages))
   except Exception as e:
     print(f"Error: {str(e)}")
     raise HTTPException(
@@ -492,8 +446,9 @@ async def fetch_older_messages(
     if user_id not in chat['participants']:
       return JSONResponse(status_code=401, content={"error": "Unauthorized"})
 
+    # Archived buckets are read with the archive read preference to keep them off the primary
     # Fetch the latest message bucket to determine the range
-    latest_bucket = await db.messages.find_one(
+    latest_bucket = await archive_db.messages.find_one(
       {"chat_id": str(chat_id)},
       sort=[("message_bucket_sequence", -1)]
     )
@@ -506,7 +461,7 @@ async def fetch_older_messages(
     target_sequence = latest_sequence - message_bucket_sequence
 
     # Fetch the target older message bucket
-    message_bucket = await db.messages.find_one({
+    message_bucket = await archive_db.messages.find_one({
       "chat_id": str(chat_id),
       "message_bucket_sequence": target_sequence
     })
@@ -514,7 +469,7 @@ async def fetch_older_messages(
     if not message_bucket:
       return JSONResponse(status_code=404, content={"error": "Older message bucket not found"})
 
-    return JSONResponse(status_code=200, content={"bucket": convert_to_json_serializeble_object(message_bucket)})
+    return JSONCodecResponse(status_code=200, content={"bucket": message_bucket})
 
   except Exception as e:
     print(f"Error: {str(e)}")
@@ -535,77 +490,39 @@ async def delete_chat(
     # Fetch the existing chat
     chat = await db.chats.find_one({"_id": chat_id})
 
+    if not chat:
+      return JSONResponse(status_code=404, content={"error": "Chat not found"})
+
     # Check if the user is a participant
-    if chat and user_id not in chat.get("participants", []):
+    if user_id not in chat.get("participants", []):
       return JSONResponse(status_code=403, content={"error": "User is not a participant of this chat"})
 
-    user_a = await db.users.find_one(
-      {
-        "_id": user_id,
-        "inbox.chats": {
-          "$elemMatch": {
-            "chat_id": chat_id,
-            "deleted": True
-          }
-        }
-      },
-      {
-        "inbox.chats.$": 1  # Project only the matched element in the array
-      }
-    )
     participant_id = next(participant for participant in chat['participants'] if participant != user_id)
-    user_b = await db.users.find_one(
-      {
-        "_id": participant_id,
-        "inbox.chats": {
-          "$elemMatch": {
-            "chat_id": chat_id,
-            "deleted": True
-          }
-        }
-      },
-      {
-        "inbox.chats.$": 1  # Project only the matched element in the array
-      }
-    )
+
+    # Which of the two already deleted the chat on their side, in one query
+    deleted_by = {
+      entry["user_id"] async for entry in db.inbox.find({"conversation_id": chat_id, "deleted": True}, {"user_id": 1})
+    }
+    user_a = user_id in deleted_by
+    user_b = participant_id in deleted_by
 
     if user_b and not user_a:
       # logic to remove the chat, messages, chat obj's, redis.
       await db.chats.delete_one({"_id": chat_id})
 
-      await db.users.update_one(
-        {
-          "_id": user_id
-        },
-        {
-          "$pull": {"inbox.chats": {"chat_id": chat_id}}
-        }
-      )
+      await db.inbox.delete_many({"conversation_id": chat_id})
+      await unindex_conversation(chat['participants'], "chat", chat_id)
 
-      await db.users.update_one(
-        {
-          "_id": participant_id
-        },
-        {
-          "$pull": {"inbox.chats": {"chat_id": chat_id}}
-        }
-      )
-
-      await db.messages.delete_many({"chat_id": chat_id})
-
-      await redis.delete(f"chat:{chat_id}:messages")
+      # Message buckets and redis keys are removed by the cleanup job worker
+      await enqueue_cleanup("delete_conversation", conversation_id=chat_id, is_group=False)
 
       return JSONResponse(status_code=200, content={"success": "Chat deleted successfully"})
     elif not user_b:
-      await db.users.update_one(
-        {
-          "_id": user_id,
-          "inbox.chats.chat_id": chat_id
-        },
-        {
-          "$set": {"inbox.chats.$.deleted": True}  # Adds the 'deleted' field with a value of True
-        }
+      await db.inbox.update_one(
+        {"user_id": user_id, "conversation_id": chat_id},
+        {"$set": {"deleted": True}}  # Adds the 'deleted' field with a value of True
       )
+      await unindex_conversation([user_id], "chat", chat_id)
 
       return JSONResponse(status_code=200, content={"success": "Chat marked as deleted for the user"})
 
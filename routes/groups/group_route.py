@@ -1,75 +1,112 @@
-from fastapi import APIRouter, WebSocket, WebSocketDisconnect, Depends, HTTPException
+from fastapi import APIRouter, WebSocket, WebSocketDisconnect, Depends, HTTPException, Query
 from helpers.utils.websocket_connection_manager import websocket_connection_manager
-from helpers.utils.redis_pubsub import publish_message
+from helpers.utils.redis_pubsub import event_stream_key, conversation_event_reader, get_resume_position, replay_conversation_events
 from helpers.utils.generate_unique_id import generate_unique_id
 from helpers.middleware.authentication import validate_token, validate_token_for_websockets
 from motor.motor_asyncio import AsyncIOMotorDatabase
 from fastapi.responses import JSONResponse
 from core.database import get_db, db
+from pymongo import DeleteMany, ReturnDocument
+from helpers.utils.inbox import add_group_to_inboxes, inbox_entry_upsert, index_conversation, unindex_conversation, touch_group, forget_group_members
+from helpers.utils.unread_counters import mark_read
+from helpers.utils.cleanup_jobs import enqueue_cleanup
 from bson import ObjectId
 from schemas.groups.group_schema import Group, GroupCreate, GroupUpdate
-from core.redis import redis
-import json
+from helpers.utils.json_codec import loads
+from helpers.utils.ingest_queue import ConnectionIngestQueue, send_frame_error
+from helpers.utils.session_resume import issue_resume_token, read_resume_token, session_frame, full_connect_limiter
 from datetime import datetime
 from uuid import uuid4
+from typing import Optional
+import asyncio
 
 router = APIRouter()
 
-async def get_message_sequence_plus_one(group_id: str) -> int:
-  redis_key = f"group:{group_id}:messages"
-  last_message = await redis.lindex(redis_key, -1)  # Get the last message
-  if last_message:
-    last_message = json.loads(last_message)
-    return last_message['message_sequence'] + 1
-  else:
-    return 0  # If no messages exist, start with sequence 0
-
 @router.websocket("/continue-group-chat/{group_id}")
 async def websocket_group_chat_endpoint(websocket: WebSocket, group_id: str):
-  auth_token = websocket.query_params.get('authToken')
-  user_id = await validate_token_for_websockets(websocket, auth_token)
+  group_id = ObjectId(group_id)
 
-  if user_id is None:
-    await websocket.close(code=4000, reason="Invalid token")
-    return
+  # A resume token from the previous socket stands in for the token check and the group
+  # lookup, reconnect waves after a deploy don't reach mongo
+  session = read_resume_token(websocket.query_params.get('resumeToken'), group_id, True)
+  if session:
+    user_id, auth_time = session["user_id"], session["auth_time"]
+  else:
+    auth_time = None
+    if not full_connect_limiter.admit():
+      await websocket_connection_manager.send_elsewhere(websocket, 1013, "Try again later", accepted=False)
+      return
 
-  group_id = ObjectId(group_id)
+    auth_token = websocket.query_params.get('authToken')
+    user_id = await validate_token_for_websockets(websocket, auth_token)
 
-  # Check if the user is a participant in the group
-  group = await db.groups.find_one({"_id": group_id})
+    if user_id is None:
+      await websocket.close(code=4000, reason="Invalid token")
+      return
+
+    # Check if the user is a participant in the group
+    group = await db.groups.find_one({"_id": group_id})
+
+    if not group:
+      await websocket.close(code=4000, reason="Group not found")
+      return
 
-  if group:
     if user_id not in group["participants"]:
       await websocket.close(code=4000, reason="User is not a participant in the group")
       return
 
-    websocket_id = str(uuid4())
-    await websocket_connection_manager.connect(websocket, str(group_id), websocket_id)
-    # await store_connection(group_id, websocket_id, user_id, is_group=True)
-  else:
-    await websocket.close(code=4000, reason="Group not found")
-    return
+  websocket_id = str(uuid4())
+  last_event_id, last_message_sequence = get_resume_position(websocket)
+  resuming = last_event_id is not None or last_message_sequence is not None
+
+  connection = await websocket_connection_manager.connect(websocket, str(group_id), websocket_id, replaying=resuming)
+  if connection is None:
+    return  # The accept failed or the worker is shutting down and sent the client elsewhere
+  await conversation_event_reader.follow(event_stream_key(group_id, True))
+  websocket_connection_manager.queue_event(str(group_id), connection, session_frame(issue_resume_token(user_id, group_id, True, auth_time=auth_time), auth_time))
+  # await store_connection(group_id, websocket_id, user_id, is_group=True)
+
+  # Frames are parsed here and persisted by a worker, a slow redis never stalls the socket
+  async def update_group_activity(messages: list):
+    # Runs once per committed batch: the members' unread counters, and now and then their
+    # inbox entries and indexes
+    await touch_group(group_id, messages)
+
+  ingest_queue = ConnectionIngestQueue(websocket, websocket_id, group_id, True, after_commit=update_group_activity)
+  ingest_queue.start()
 
   try:
+    # A reconnecting client only gets the events it missed instead of refetching the history
+    if connection and resuming:
+      await replay_conversation_events(websocket, connection, event_stream_key(group_id, True), last_event_id, last_message_sequence)
+
     while True:
-      data = json.loads(await websocket.receive_text())
-      message_data = {
-        "id": generate_unique_id(), # generates 6 bit random id
-        "sender_id": str(user_id),
-        "reply_to_id": data['reply_to_id'] if data['reply_to_id'] else None,
-        "content": data['content'],
-        "message_sequence": await get_message_sequence_plus_one(str(group_id)),
-        "created_at": datetime.now().isoformat()
-      }
-
-      await redis.rpush(f"group:{group_id}:messages", json.dumps(message_data))
-      await publish_message(group_id, message_data, is_group=True)
+      frame = await websocket.receive_text()
+
+      try:
+        data = loads(frame)
+        message_data = {
+          "id": generate_unique_id(), # generates 6 bit random id
+          "sender_id": str(user_id),
+          "reply_to_id": data['reply_to_id'] if data['reply_to_id'] else None,
+          "content": data['content'],
+          "message_sequence": None, # assigned when the ingest batch is committed
+          "created_at": datetime.now().isoformat()
+        }
+      except (ValueError, KeyError, TypeError):
+        await send_frame_error(websocket, "Invalid message frame")
+        continue
+
+      # Refused with a backpressure frame when the worker is too far behind
+      await ingest_queue.offer(message_data)
   except WebSocketDisconnect:
-    websocket_connection_manager.disconnect(websocket, group_id)
+    websocket_connection_manager.disconnect(str(group_id), websocket_id)
     # await remove_connection(group_id, websocket_id, is_group=True)
   except Exception as e:
     print(f"Unexpected error: {e}")
     await websocket.close(code=1011, reason=str(e))
+  finally:
+    ingest_queue.close()
 
 @router.post("/create-group")
 async def create_group(
@@ -108,15 +145,8 @@ async def create_group(
     group_insert_result = await db.groups.insert_one(new_group.dict())
     group_id = group_insert_result.inserted_id
 
-    group_info = {
-      "group_id": group_id
-    }
-
-    # Update users' inbox.groups field
-    await db.users.update_many(
-      {"_id": {"$in": req_body.participants}},
-      {"$addToSet": {"inbox.groups": group_info}}
-    )
+    # Add the group to every participant's inbox
+    await add_group_to_inboxes(group_id, req_body.participants)
 
     return JSONResponse(status_code=201, content={"success": "Group created successfully"})
   except Exception as e:
@@ -137,8 +167,21 @@ async def update_group(
     update_fields = {}
     group_id = ObjectId(group_id)
 
-    # Fetch the existing group chat
-    existing_group = await db.groups.find_one({"_id": group_id})
+    # Ensure participants is a list and convert to ObjectId
+    if req_body.participants is not None:
+      req_body.participants = [ObjectId(participant) for participant in req_body.participants]
+
+    async def count_valid_users():
+      # Validate if the new participants are actual users
+      if req_body.participants is None:
+        return 0
+      return await db.users.count_documents({"_id": {"$in": req_body.participants}})
+
+    # Fetch the existing group chat, the participant check doesn't wait on it
+    existing_group, valid_users = await asyncio.gather(
+      db.groups.find_one({"_id": group_id}, {"group_admin": 1, "participants": 1}),
+      count_valid_users()
+    )
     if not existing_group:
       return JSONResponse(status_code=404, content={"error": "Group chat not found"})
 
@@ -146,22 +189,18 @@ async def update_group(
     if existing_group.get("group_admin") != user_id:
       return JSONResponse(status_code=403, content={"error": "Only the group admin can update the group chat"})
 
-    # Ensure participants is a list and convert to ObjectId
+    participants_to_add = participants_to_remove = set()
     if req_body.participants is not None:
-      req_body.participants = [ObjectId(participant) for participant in req_body.participants]
-
-      # Validate if the new participants are actual users
-      users_cursor = db.users.find({"_id": {"$in": req_body.participants}})
-      valid_users = [user async for user in users_cursor]
-      if len(valid_users) != len(req_body.participants):
+      if valid_users != len(set(req_body.participants)):
         return JSONResponse(status_code=400, content={"error": "Some participants are not valid users"})
 
-      # Merge new participants with existing participants
-      new_participants = set(req_body.participants)
+      # The list sent replaces the participants, the ones left out are removed. The admin
+      # always stays, leaving themselves out would lock them out of the group they run
+      new_participants = set(req_body.participants) | {existing_group["group_admin"]}
       existing_participants = set(existing_group.get("participants", []))
       participants_to_add = new_participants - existing_participants
       participants_to_remove = existing_participants - new_participants
-      update_fields["participants"] = list(existing_participants | new_participants - participants_to_remove)
+      update_fields["participants"] = list(new_participants)
 
     if req_body.group_name:
       update_fields["group_name"] = req_body.group_name
@@ -185,24 +224,15 @@ async def update_group(
       {"$set": update_fields}
     )
 
-    # Update group info in the users' inbox.groups field
-    group_info = {
-      "group_id": group_id
-    }
-
-    # Add group info for new participants
-    if participants_to_add:
-      await db.users.update_many(
-        {"_id": {"$in": list(participants_to_add)}},
-        {"$addToSet": {"inbox.groups": group_info}}
-      )
-
-    # Remove group info for removed participants
+    # Inbox entries of added and removed participants in one round trip
+    inbox_updates = [inbox_entry_upsert(participant_id, group_id, "group") for participant_id in participants_to_add]
     if participants_to_remove:
-      await db.users.update_many(
-        {"_id": {"$in": list(participants_to_remove)}},
-        {"$pull": {"inbox.groups": {"group_id": str(group_id)}}}
-      )
+      inbox_updates.append(DeleteMany({"conversation_id": group_id, "user_id": {"$in": list(participants_to_remove)}}))
+    if inbox_updates:
+      await db.inbox.bulk_write(inbox_updates, ordered=False)
+      forget_group_members(group_id)
+      await index_conversation(participants_to_add, "group", group_id)
+      await unindex_conversation(participants_to_remove, "group", group_id)
 
     return JSONResponse(status_code=200, content={"success": "Group updated successfully"})
   except Exception as e:
@@ -221,26 +251,19 @@ async def delete_group(
   try:
     group_id = ObjectId(group_id)
 
-    # Fetch the existing group chat
-    existing_group = await db.groups.find_one({"_id": group_id})
+    # Only the admin's delete goes through, checked and done in one write
+    existing_group = await db.groups.find_one_and_delete(
+      {"_id": group_id, "group_admin": user_id},
+      projection={"_id": 1}
+    )
     if not existing_group:
+      if await db.groups.count_documents({"_id": group_id}, limit=1):
+        return JSONResponse(status_code=403, content={"error": "Only the group admin can delete the group chat"})
       return JSONResponse(status_code=404, content={"error": "Group chat not found"})
 
-    # Check if the current user is the group admin
-    if existing_group.get("group_admin") != user_id:
-      return JSONResponse(status_code=403, content={"error": "Only the group admin can delete the group chat"})
-
-    # Perform the deletion
-    await db.groups.delete_one({"_id": group_id})
-
-    # delete all the message buckets of the group
-    await db.messages.delete_many({"group_id": group_id})
-
-    # Remove the group info from all participants' chats field
-    await db.users.update_many(
-      {"_id": {"$in": existing_group["participants"]}},
-      {"$pull": {"inbox.groups": {"group_id": group_id}}}
-    )
+    # Message buckets, redis keys and the members' inbox entries are removed by the
+    # cleanup job worker, the request doesn't wait on thousands of members
+    await enqueue_cleanup("delete_conversation", conversation_id=group_id, is_group=True)
 
     return JSONResponse(status_code=200, content={"success": "Group deleted successfully"})
   except Exception as e:
@@ -277,22 +300,23 @@ async def leave_group(
         return JSONResponse(status_code=403, content={"error": "Group admin cannot leave the group if there are other participants remaining"})
 
     # Remove the user from the group's participants list
-    await db.groups.update_one(
+    group = await db.groups.find_one_and_update(
       {"_id": group_id},
-      {"$pull": {"participants": user_id}}
+      {"$pull": {"participants": user_id}},
+      projection={"group_admin": 1, "participants": 1},
+      return_document=ReturnDocument.AFTER
     )
 
     # If the user was the group admin and they are the only participant left, delete the group
-    group = await db.groups.find_one({"_id": group_id})
     if group and group.get("group_admin") == user_id and len(group.get("participants", [])) == 0:
       await db.groups.delete_one({"_id": group_id})
+      await enqueue_cleanup("delete_conversation", conversation_id=group_id, is_group=True)
       return JSONResponse(status_code=200, content={"success": "Group deleted successfully"})
 
-    # Remove the group info from the user's inbox.groups field
-    await db.users.update_one(
-      {"_id": user_id},
-      {"$pull": {"inbox.groups": {"id": group_id}}}
-    )
+    # Remove the group from the user's inbox
+    await db.inbox.delete_one({"user_id": user_id, "conversation_id": group_id})
+    forget_group_members(group_id)
+    await unindex_conversation([user_id], "group", group_id)
 
     return JSONResponse(status_code=200, content={"success": "Successfully left the group"})
   except Exception as e:
@@ -301,3 +325,27 @@ async def leave_group(
       status_code=500,
       detail="Internal Server Error",
     ) from e
+
+@router.post("/mark-as-read/{group_id}")
+async def mark_group_as_read(
+  group_id: str,
+  count: Optional[int] = Query(None, ge=1, description="Messages read, omit when the user caught up"),
+  db: AsyncIOMotorDatabase = Depends(get_db),
+  user_id: str = Depends(validate_token)
+):
+  try:
+    group_id = ObjectId(group_id)
+
+    # Members have an inbox entry for the group
+    if not await db.inbox.find_one({"user_id": user_id, "conversation_id": group_id}, {"_id": 1}):
+      return JSONResponse(status_code=404, content={"error": "Group not found or user is not a participant"})
+
+    await mark_read(user_id, "group", group_id, count)
+
+    return JSONResponse(status_code=200, content={"success": "Group marked as read"})
+  except Exception as e:
+    print(f"Error: {str(e)}")
+    raise HTTPException(
+      status_code=500,
+      detail="Internal Server Error",
+    ) from e
@@ -1,15 +1,67 @@
-from fastapi import FastAPI
+from fastapi import Depends, FastAPI, HTTPException, Query
+from fastapi.responses import JSONResponse, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
-import asyncio
+from contextlib import asynccontextmanager
 from background_tasks.batch_save_messages import batch_save_messages
-from helpers.utils.redis_pubsub import redis_subscriber
+from background_tasks.archive_idle_conversations import archive_idle_conversations
+from background_tasks.run_cleanup_jobs import run_cleanup_jobs
+from background_tasks.reconcile_unread_counts import reconcile_unread_counts
+from helpers.utils.redis_pubsub import redis_subscriber, conversation_event_reader, call_channel_subscriber
+from helpers.utils.username_search_index import username_search_index
+from helpers.utils.inbox import ensure_inbox_indexes
+from helpers.utils.ingest_queue import ingest_queue_stats
+from helpers.utils.metrics import push_metrics_snapshots, remove_metrics_snapshot, render_host_metrics
+from helpers.utils.profiling import event_loop_watchdog, sampling_profiler
+from helpers.utils.graceful_shutdown import drain_before_server_exit, shut_down
+from helpers.utils.task_supervisor import task_supervisor
+from helpers.utils.websocket_connection_manager import websocket_connection_manager
+from helpers.middleware.authentication import validate_admin
+from helpers.middleware.profiling import ProfilingMiddleware
+from core.database import client, db, mongo_pool_stats
+from core.redis import redis, redis_pool_stats
+from core.settings import settings
 from .users.user_route import router as user_router
 from .chats.chat_route import router as chat_router
 from .groups.group_route import router as group_router
 from .upload_image.upload_image_route import router as upload_image_router
 from .search.search_route import router as search_router
+from .calls.call_route import router as call_router
 
-app = FastAPI()
+# Background tasks of this worker process, every worker starts its own
+running_tasks = []
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+  # Supervised: restarted with backoff when they crash, /health/ready follows the critical ones
+  background_jobs = [
+    task_supervisor.start("batch_save_messages", batch_save_messages, critical=True, max_silence=300),
+    task_supervisor.start("archive_idle_conversations", archive_idle_conversations, max_silence=settings.IDLE_CONVERSATION_ARCHIVE_INTERVAL * 2),
+    task_supervisor.start("run_cleanup_jobs", run_cleanup_jobs, max_silence=settings.CLEANUP_JOB_LEASE),
+    task_supervisor.start("reconcile_unread_counts", reconcile_unread_counts, max_silence=settings.UNREAD_RECONCILE_INTERVAL * 2)
+  ]
+  running_tasks.extend(background_jobs)
+  running_tasks.append(task_supervisor.start("redis_subscriber", redis_subscriber, critical=True, max_silence=30))
+  running_tasks.append(task_supervisor.start("conversation_event_reader", conversation_event_reader.run, critical=True, max_silence=30))
+  running_tasks.append(task_supervisor.start("call_channel_subscriber", call_channel_subscriber.run, critical=True, max_silence=30))
+  running_tasks.append(task_supervisor.start("push_metrics_snapshots", push_metrics_snapshots))
+  running_tasks.append(task_supervisor.start("event_loop_watchdog", event_loop_watchdog.run))
+  running_tasks.append(task_supervisor.start("ensure_inbox_indexes", ensure_inbox_indexes))
+  if settings.USERNAME_SEARCH_BACKEND == "local":
+    running_tasks.append(task_supervisor.start("username_search_index", lambda: username_search_index.build(db)))
+  drain_before_server_exit()
+
+  yield
+
+  # Sockets, pending writes and the current job pass are drained before anything stops
+  await shut_down(background_jobs, running_tasks)
+  running_tasks.clear()
+
+  # Each worker closes the clients it created on import
+  await remove_metrics_snapshot()
+  await redis.aclose()
+  client.close()
+
+app = FastAPI(lifespan=lifespan)
 
 origins = [
   "http://localhost:5173",  # Allow requests from your frontend domain
@@ -23,17 +75,69 @@ app.add_middleware(
   allow_headers=["*"],  # Allow all headers
 )
 
-@app.on_event("startup")
-async def startup_event():
-  asyncio.create_task(batch_save_messages())
-  asyncio.create_task(redis_subscriber())
+if settings.PROFILING_ENABLED:
+  app.add_middleware(ProfilingMiddleware)
 
 @app.get('/')
 async def get_homeage():
   return "meow homeage"
 
+@app.get('/health/live')
+async def get_liveness():
+  # Fails only when a restart of the process would help: a critical task keeps crashing
+  status_code = 200 if task_supervisor.live() else 503
+  return JSONResponse(status_code=status_code, content={"live": status_code == 200, "tasks": task_supervisor.report()})
+
+@app.get('/health/ready')
+async def get_readiness():
+  # Load balancers route away while the worker drains, a critical task is down or stuck,
+  # or the event loop is lagging
+  loop_lag_ms = event_loop_watchdog.recent_lag() * 1000
+  checks = {
+    "accepting_sockets": not websocket_connection_manager.draining,
+    "tasks": task_supervisor.ready(),
+    "event_loop": loop_lag_ms <= settings.READINESS_MAX_LOOP_LAG_MS
+  }
+  status_code = 200 if all(checks.values()) else 503
+  return JSONResponse(status_code=status_code, content={
+    "ready": status_code == 200,
+    "checks": checks,
+    "event_loop_lag_ms": round(loop_lag_ms, 1),
+    "tasks": task_supervisor.report()
+  })
+
+@app.get('/ingest-stats')
+async def get_ingest_stats(user_id=Depends(validate_admin)):
+  # Queue depths of this process, to see where message latency builds up under load.
+  # Admins only, it names the busiest chats and groups
+  return ingest_queue_stats()
+
+@app.get('/metrics', response_class=PlainTextResponse)
+async def get_metrics():
+  # Prometheus text format, covering every worker process of this host
+  return PlainTextResponse(await render_host_metrics(), media_type="text/plain; version=0.0.4")
+
+@app.get('/pool-stats')
+async def get_pool_stats(user_id=Depends(validate_admin)):
+  # Connection pool usage of this process, to size pools to the worker count
+  return {"mongo": mongo_pool_stats.stats(), "redis": redis_pool_stats()}
+
+@app.get('/debug/profile', response_class=PlainTextResponse)
+async def get_profile(
+  seconds: float = Query(10, gt=0),
+  interval_ms: int = Query(5, ge=1),
+  user_id=Depends(validate_admin)
+):
+  # Collapsed stacks of this worker process, pipe them into flamegraph.pl or open them in speedscope
+  if not settings.PROFILING_ENABLED:
+    raise HTTPException(status_code=404, detail="Profiling is disabled")
+  if sampling_profiler.lock.locked():
+    raise HTTPException(status_code=409, detail="A profile is already running")
+  return PlainTextResponse(await sampling_profiler.profile(min(seconds, settings.PROFILER_MAX_SECONDS), interval_ms))
+
 app.include_router(user_router, prefix="/api/user", tags=["users"])
 app.include_router(chat_router, prefix="/api/chat", tags=["chats"])
 app.include_router(group_router, prefix="/api/group", tags=["groups"])
 app.include_router(upload_image_router, prefix="/api/upload", tags=["upload-image"])
 app.include_router(search_router, prefix="/api/search", tags=["search"])
+app.include_router(call_router, prefix="/api/call", tags=["calls"])
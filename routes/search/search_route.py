@@ -2,7 +2,10 @@ from helpers.middleware.authentication import validate_token
 from motor.motor_asyncio import AsyncIOMotorDatabase
 from fastapi import APIRouter, Depends, HTTPException, Query
 from fastapi.responses import JSONResponse
+from helpers.utils.username_search_index import username_search_index
+from helpers.utils.profile_summary_cache import get_profile_summaries
 from core.database import get_db
+from core.settings import settings
 from bson import ObjectId
 
 router = APIRouter()
@@ -19,6 +22,14 @@ async def search_users(
   username: str = Query(..., description="Username to search for")
 ):
   try:
+    # Serve from the in-process index once it has been built, Atlas otherwise
+    if settings.USERNAME_SEARCH_BACKEND == "local" and username_search_index.ready:
+      matched_ids = username_search_index.search(username, limit=10)
+      summaries = await get_profile_summaries(db, [ObjectId(matched_id) for matched_id in matched_ids])
+      results = [summaries[matched_id] for matched_id in matched_ids if matched_id in summaries]
+
+      return JSONResponse(content={"results": results})
+
     # Construct the Atlas Search query using the vector search index
     search_pipeline = [
         {
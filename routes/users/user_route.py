@@ -1,11 +1,19 @@
-from schemas.users.user_schema import UserCreate, UserLogin, UserUpdate, User
+from schemas.users.user_schema import UserCreate, UserLogin, UserUpdate, User, ProfileSummaryBatch
 from helpers.utils.generate_jwt_token import generate_jwt_token
+from helpers.utils.profile_summary_cache import get_profile_summaries, invalidate_profile_summary
+from helpers.utils.username_search_index import username_search_index
+from helpers.utils.redis_pubsub import publish_username_change
+from helpers.utils.inbox import fetch_inbox_page
+from helpers.utils.unread_counters import load_unread_counts
 from helpers.middleware.authentication import validate_token
 from motor.motor_asyncio import AsyncIOMotorDatabase
 from passlib.context import CryptContext
 from fastapi import APIRouter, Depends, HTTPException, Query
 from fastapi.responses import JSONResponse
+from helpers.utils.json_codec import JSONCodecResponse
+from helpers.utils.metrics import bcrypt_duration
 from core.database import get_db
+from core.settings import settings
 from bson import ObjectId
 from typing import Optional
 
@@ -13,6 +21,18 @@ router = APIRouter()
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
+MAX_PROFILE_IDS_PER_BATCH = 200
+
+
+def hash_password(password: str) -> str:
+    with bcrypt_duration.time(operation="hash"):
+        return pwd_context.hash(password)
+
+
+def verify_password(password: str, hashed_password: str) -> bool:
+    with bcrypt_duration.time(operation="verify"):
+        return pwd_context.verify(password, hashed_password)
+
 
 @router.get("/fetch-user", status_code=200)
 async def fetch_user(
@@ -25,40 +45,115 @@ async def fetch_user(
     try:
         # If profile_id is provided, fetch the summary of that user profile
         if profile_id:
-            profile_id = ObjectId(profile_id)
-            db_user = await db.users.find_one(
-                {"_id": profile_id}, {"username": 1, "profile_image": 1}
-            )
+            profile_id = str(ObjectId(profile_id))
+            summaries = await get_profile_summaries(db, [ObjectId(profile_id)])
 
-            if not db_user:
+            if profile_id not in summaries:
                 return JSONResponse(
                     status_code=404, content={"error": "Profile not found"}
                 )
 
-            db_user["_id"] = str(db_user["_id"])
-            return db_user
+            return summaries[profile_id]
 
-        # If profile_id is not provided, fetch the full user details for the authenticated user
-        db_user = await db.users.find_one({"_id": user_id})
+        # If profile_id is not provided, fetch the full user details for the authenticated user.
+        # The inbox is paged from /inbox, an embedded one left from before the migration is skipped
+        db_user = await db.users.find_one({"_id": user_id}, {"password": 0, "inbox": 0})
 
         if not db_user:
             return JSONResponse(status_code=401, content={"error": "Unauthorized"})
 
-        del db_user["password"]
-        db_user["_id"] = str(db_user["_id"])
+        # ObjectId and datetime fields are encoded by the codec
+        return JSONCodecResponse(status_code=200, content=db_user)
+
+    except Exception as e:
+        print(f"Error: {str(e)}")
+        raise HTTPException(
+            status_code=500,
+            detail="Internal Server Error",
+        ) from e
+
+
+@router.get("/inbox", status_code=200)
+async def fetch_inbox(
+    cursor: Optional[str] = Query(
+        None, description="next_cursor of the previous page, omit for the first page"
+    ),
+    limit: int = Query(
+        settings.INBOX_PAGE_SIZE, ge=1, le=settings.INBOX_MAX_PAGE_SIZE
+    ),
+    user_id: str = Depends(validate_token),
+):
+    # The user's chats and groups, most recently active first
+    try:
+        entries, next_cursor = await fetch_inbox_page(user_id, limit, cursor)
+
+        return JSONCodecResponse(
+            status_code=200, content={"entries": entries, "next_cursor": next_cursor}
+        )
+    except ValueError:
+        return JSONResponse(status_code=400, content={"error": "Invalid cursor"})
+    except Exception as e:
+        print(f"Error: {str(e)}")
+        raise HTTPException(
+            status_code=500,
+            detail="Internal Server Error",
+        ) from e
+
 
-        # Convert ObjectId fields in inbox.chats to strings
-        if "inbox" in db_user and "chats" in db_user["inbox"]:
-            for chat in db_user["inbox"]["chats"]:
-                if "chat_id" in chat and isinstance(chat["chat_id"], ObjectId):
-                    chat["chat_id"] = str(chat["chat_id"])
-                if "participant_id" in chat and isinstance(
-                    chat["participant_id"], ObjectId
-                ):
-                    chat["participant_id"] = str(chat["participant_id"])
+@router.get("/unread-counts", status_code=200)
+async def fetch_unread_counts(user_id: str = Depends(validate_token)):
+    # Badges of the whole inbox from one hash read, keyed "chat:<id>" / "group:<id>"
+    try:
+        return JSONResponse(
+            status_code=200, content={"counts": await load_unread_counts(user_id)}
+        )
+    except Exception as e:
+        print(f"Error: {str(e)}")
+        raise HTTPException(
+            status_code=500,
+            detail="Internal Server Error",
+        ) from e
 
-        return db_user
 
+@router.post("/fetch-users", status_code=200)
+async def fetch_users(
+    req_body: ProfileSummaryBatch,
+    db: AsyncIOMotorDatabase = Depends(get_db),
+    user_id: str = Depends(validate_token),
+):
+    # Resolve the profile summaries of many users (e.g. every inbox contact) in one request
+    if len(req_body.profile_ids) > MAX_PROFILE_IDS_PER_BATCH:
+        return JSONResponse(
+            status_code=400,
+            content={
+                "error": f"At most {MAX_PROFILE_IDS_PER_BATCH} profile ids can be fetched at once"
+            },
+        )
+
+    if not all(ObjectId.is_valid(profile_id) for profile_id in req_body.profile_ids):
+        return JSONResponse(status_code=400, content={"error": "Invalid profile id"})
+
+    try:
+        profile_ids = [str(ObjectId(profile_id)) for profile_id in req_body.profile_ids]
+        summaries = await get_profile_summaries(
+            db, [ObjectId(profile_id) for profile_id in profile_ids]
+        )
+
+        return JSONResponse(
+            status_code=200,
+            content={
+                "profiles": [
+                    summaries[profile_id]
+                    for profile_id in dict.fromkeys(profile_ids)
+                    if profile_id in summaries
+                ],
+                "not_found": [
+                    profile_id
+                    for profile_id in dict.fromkeys(profile_ids)
+                    if profile_id not in summaries
+                ],
+            },
+        )
     except Exception as e:
         print(f"Error: {str(e)}")
         raise HTTPException(
@@ -78,14 +173,18 @@ async def signup(req_body: UserCreate, db: AsyncIOMotorDatabase = Depends(get_db
         )
 
     # Hash the password
-    hashed_password = pwd_context.hash(req_body.password)
+    hashed_password = hash_password(req_body.password)
 
     # Create a new user instance
     new_user = User(
         username=req_body.username, email=req_body.email, password=hashed_password
     )
 
-    await db.users.insert_one(new_user.dict())
+    insert_result = await db.users.insert_one(new_user.dict())
+
+    if settings.USERNAME_SEARCH_BACKEND == "local":
+        username_search_index.add(str(insert_result.inserted_id), req_body.username)
+        await publish_username_change(insert_result.inserted_id, req_body.username)
 
     return JSONResponse(
         status_code=201, content={"success": "User created successfully"}
@@ -102,7 +201,7 @@ async def login(req_body: UserLogin, db: AsyncIOMotorDatabase = Depends(get_db))
                 status_code=400, content={"error": "Invalid username or password"}
             )
 
-        if not pwd_context.verify(req_body.password, db_user["password"]):
+        if not verify_password(req_body.password, db_user["password"]):
             # Password is incorrect
             return JSONResponse(
                 status_code=400, content={"error": "Invalid username or password"}
@@ -137,8 +236,8 @@ async def update_user(
         if req_body.old_password and req_body.new_password:
             db_user = await db.users.find_one({"_id": user_id})
 
-            if pwd_context.verify(req_body.old_password, db_user["password"]):
-                update_data["password"] = pwd_context.hash(req_body.new_password)
+            if verify_password(req_body.old_password, db_user["password"]):
+                update_data["password"] = hash_password(req_body.new_password)
             else:
                 return JSONResponse(
                     status_code=401, content={"error": "Incorrect old password"}
@@ -160,6 +259,14 @@ async def update_user(
                     status_code=404, content={"error": "User not found"}
                 )
 
+            # Drop the cached profile summary so batch lookups see the new name/image
+            if "username" in update_data or "profile_image" in update_data:
+                await invalidate_profile_summary(user_id)
+
+            if "username" in update_data and settings.USERNAME_SEARCH_BACKEND == "local":
+                username_search_index.add(str(user_id), update_data["username"])
+                await publish_username_change(user_id, update_data["username"])
+
         return JSONResponse(
             status_code=200, content={"success": "User updated successfully"}
         )
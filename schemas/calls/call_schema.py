@@ -1,5 +1,6 @@
 from pydantic import BaseModel
+from typing import Literal
 
 class SignalingMessage(BaseModel):
-  type: str  # e.g., 'offer', 'answer', 'ice-candidate'
-  data: dict  # Contains the actual offer, answer, or ICE candidate
+  type: Literal['offer', 'answer', 'ice-candidate', 'reject', 'hangup']
+  data: dict = {}  # Contains the actual offer, answer, or ICE candidate
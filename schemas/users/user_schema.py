@@ -1,6 +1,6 @@
 from pydantic import BaseModel, Field, constr, root_validator, EmailStr
 from datetime import datetime
-from typing import List, Dict, Optional, Any
+from typing import List, Optional
 from bson import ObjectId
 
 class UserCreate(BaseModel):
@@ -48,9 +48,9 @@ class User(BaseModel):
   status: Optional[str] = None
   created_at: datetime = Field(default_factory=datetime.utcnow)
   profile_image: Optional[str] = None  # URL or path to profile picture
-  inbox: Dict[str, List[Dict[str, Any]]] = Field(
-    default_factory=lambda: {"chats": [], "groups": []}
-  )
 
   class Config:
     arbitrary_types_allowed = True
+
+class ProfileSummaryBatch(BaseModel):
+  profile_ids: List[str]
@@ -0,0 +1,139 @@
+"""
+Redis Cluster behaviour of the key layout, the per-slot event stream reads and the
+sharded call channels. Runs against a real cluster and is skipped without one:
+
+  REDIS_CLUSTER_TEST_URL=redis://localhost:7000 python -m pytest tests/test_redis_cluster.py
+
+Every key and channel it uses is tagged with a fresh ObjectId, the keys are deleted
+afterwards.
+"""
+import asyncio
+import os
+import pytest
+
+CLUSTER_URL = os.environ.get("REDIS_CLUSTER_TEST_URL")
+if not CLUSTER_URL:
+  pytest.skip("REDIS_CLUSTER_TEST_URL isn't set", allow_module_level=True)
+
+# The redis client is created from Settings when core.redis is first imported
+os.environ["REDIS_CLUSTER"] = "true"
+os.environ["REDIS_CONNECTION_URL"] = CLUSTER_URL
+
+from bson import ObjectId
+from redis.exceptions import RedisClusterException
+from core.redis import (
+  redis, messages_key, event_stream_key, unseen_flag_key, call_session_key,
+  inbox_fanout_flag_key, inbox_index_key, unread_counts_key, call_channel
+)
+from helpers.utils.call_signaling import call_connections, publish_signal
+from helpers.utils.json_codec import dumpb, loads
+from helpers.utils.redis_pubsub import CallChannelSubscriber, ConversationEventReader
+
+@pytest.fixture(scope="module")
+def run():
+  # One loop for the module, the cluster client's connections are bound to it
+  loop = asyncio.new_event_loop()
+  yield loop.run_until_complete
+  loop.run_until_complete(redis.aclose())
+  loop.close()
+
+def ids_on_distinct_nodes(make_key, wanted: int = 2) -> list:
+  # Fresh ids until their keys live on at least `wanted` primaries
+  ids = []
+  while len({redis.get_node_from_key(make_key(new_id)).name for new_id in ids}) < wanted:
+    ids.append(ObjectId())
+  return ids
+
+def test_conversation_keys_share_a_slot():
+  chat_id, group_id, user_id = ObjectId(), ObjectId(), ObjectId()
+  key_groups = [
+    [messages_key(chat_id), event_stream_key(chat_id), unseen_flag_key(chat_id), call_session_key(chat_id)],
+    [messages_key(group_id, True), event_stream_key(group_id, True), unseen_flag_key(group_id, True), inbox_fanout_flag_key(group_id)],
+    [inbox_index_key(user_id), unread_counts_key(user_id), call_channel(user_id)]
+  ]
+  for keys in key_groups:
+    assert len({redis.keyslot(key) for key in keys}) == 1, keys
+
+  # Only the hash tag decides the slot, not the kind or the suffix
+  assert redis.keyslot(messages_key(chat_id)) == redis.keyslot(f"{{{chat_id}}}")
+  assert redis.keyslot(messages_key(chat_id)) != redis.keyslot(messages_key(group_id))
+
+def test_conversation_keys_share_a_multi(run):
+  chat_id = ObjectId()
+  keys = [messages_key(chat_id), event_stream_key(chat_id), unseen_flag_key(chat_id)]
+
+  async def write_conversation():
+    try:
+      async with redis.pipeline(transaction=True) as pipe:
+        pipe.rpush(keys[0], b"message")
+        pipe.xadd(keys[1], {"data": b"{}"})
+        pipe.set(keys[2], 1)
+        return await pipe.execute()
+    finally:
+      await redis.delete(*keys)
+
+  pushed, _, flagged = run(write_conversation())
+  assert pushed == 1 and flagged is True
+
+def test_read_by_slot_reads_streams_of_every_slot(run):
+  stream_keys = [event_stream_key(chat_id) for chat_id in ids_on_distinct_nodes(event_stream_key)]
+  reader = ConversationEventReader()
+
+  async def read_new_entries():
+    try:
+      for stream_key in stream_keys:
+        await redis.xadd(stream_key, {"data": b"{}"})
+        await reader.follow(stream_key)
+
+      # One XREAD across slots is refused, which is why the reader splits it up
+      with pytest.raises(RedisClusterException):
+        await redis.xread(dict(reader.cursors))
+
+      added = {}
+      for stream_key in stream_keys:
+        added[stream_key] = [(await redis.xadd(stream_key, {"data": dumpb({"n": n})})).decode('utf-8') for n in range(2)]
+      return added, await reader.read_by_slot()
+    finally:
+      await asyncio.gather(*[redis.delete(stream_key) for stream_key in stream_keys])
+
+  added, response = run(read_new_entries())
+  # Only what was added after follow(), every stream, in order
+  read = {stream_key.decode('utf-8'): [entry_id.decode('utf-8') for entry_id, _ in entries] for stream_key, entries in response}
+  assert read == added
+
+def test_call_signals_reach_sockets_through_ssubscribe(run):
+  version = run(redis.info("server"))["redis_version"]
+  if int(version.split(".")[0]) < 7:
+    pytest.skip(f"sharded pub/sub needs Redis 7, the cluster runs {version}")
+
+  user_ids = [str(user_id) for user_id in ids_on_distinct_nodes(call_channel)]
+  subscriber = CallChannelSubscriber()
+
+  class RecordingSocket:
+    def __init__(self):
+      self.received = asyncio.Queue()
+
+    async def send_text(self, text: str):
+      self.received.put_nowait(text)
+
+  async def signal_every_user():
+    sockets = {user_id: RecordingSocket() for user_id in user_ids}
+    for user_id, websocket in sockets.items():
+      call_connections.add(user_id, "test", websocket)
+      await subscriber.follow(user_id)
+    task = asyncio.create_task(subscriber.run())
+    try:
+      await asyncio.sleep(0.2)  # SSUBSCRIBE confirmed on each shard
+      for user_id in user_ids:
+        await publish_signal(user_id, dumpb({"action": "offer", "to": user_id}))
+      return {
+        user_id: loads(await asyncio.wait_for(websocket.received.get(), 5))
+        for user_id, websocket in sockets.items()
+      }
+    finally:
+      task.cancel()
+      for user_id in user_ids:
+        call_connections.remove(user_id, "test")
+
+  received = run(signal_every_user())
+  assert {user_id: signal["to"] for user_id, signal in received.items()} == {user_id: user_id for user_id in user_ids}